@@ -0,0 +1,149 @@
+'''TwoStackVirtualMachine Tests
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Checks that every superinstruction of the virtual machine finishes a program exactly like
+the plain interpreter, including the cases in which it falls through to the instructions of
+its idiom: stacks that have to be promoted to Python integers and too few elements.
+
+Run with: python -m unittest test_twostack_vm
+'''
+
+import io
+import sys
+import unittest
+
+from twostack_budget import TwoStackBudget
+from twostack_compiler import (compile_program, OP_JUMP, OP_CROSSALL, OP_PRINTALL, OP_MODADD,
+    OP_SUMLOOP, OP_PRODUCTLOOP, OP_RANGELOOP)
+from twostack_interpreter import TwoStackInterpreter
+from twostack_io import TwoStackInput
+from twostack_vm import TwoStackVirtualMachine
+
+# the largest value that fits into a machine integer
+MACHINE_MAX = (1 << 63) - 1
+
+def run(engine, program, max_depth=None, limits=None):
+    '''Runs a program on a fresh engine, returning what it wrote and printed, the error it raised
+    and the stacks it finished with.
+    '''
+    output = io.BytesIO()
+    if max_depth is None:
+        interpreter = engine(output, TwoStackInput(b''))
+    else:
+        interpreter = engine(output, TwoStackInput(b''), max_depth)
+    if limits is not None:
+        interpreter.set_budget(TwoStackBudget(**limits))
+
+    exception = None
+    old_stdout = sys.stdout
+    sys.stdout = messages = io.StringIO()
+    try:
+        interpreter.execute(program)
+    except Exception as error:
+        exception = type(error).__name__
+    finally:
+        sys.stdout = old_stdout
+
+    return output.getvalue(), messages.getvalue(), exception, list(interpreter.stack), list(interpreter.ztack)
+
+class SuperinstructionTest(unittest.TestCase):
+    '''Runs every program on the interpreter and the virtual machine and compares the results.'''
+
+    def assertEquivalent(self, opcode, program, max_depth=None, limits=None):
+        '''Checks that the program is compiled to the superinstruction and that both engines agree.'''
+        self.assertIn(opcode, compile_program(program).code, 'the idiom was not compiled')
+        expected = run(TwoStackInterpreter, program, max_depth, limits)
+        actual = run(TwoStackVirtualMachine, program, max_depth, limits)
+        self.assertEqual(expected, actual)
+        return actual
+
+    def test_jump(self):
+        # comments that cut through a block are the only ones that are not stripped
+        self.assertEquivalent(OP_JUMP, '1 {0[}]; 2')
+        self.assertEquivalent(OP_JUMP, '{0[}];@ 3')
+
+    def test_crossall(self):
+        self.assertEquivalent(OP_CROSSALL, '0 1 2 3[`]')
+        self.assertEquivalent(OP_CROSSALL, '1 2 3[`]')
+        self.assertEquivalent(OP_CROSSALL, '0 {}1 {} 0[`] 5')
+
+    def test_crossall_promoted(self):
+        self.assertEquivalent(OP_CROSSALL, '0 1 {} 2[`]'.format(MACHINE_MAX + 1))
+
+    def test_crossall_too_few(self):
+        self.assertEquivalent(OP_CROSSALL, '[`]')
+
+    def test_printall(self):
+        self.assertEquivalent(OP_PRINTALL, '0 10 66 65[.;]')
+        self.assertEquivalent(OP_PRINTALL, '66 65[.;]')
+        self.assertEquivalent(OP_PRINTALL, '0 {} 65[.;]'.format(0x110000))
+
+    def test_printall_promoted(self):
+        self.assertEquivalent(OP_PRINTALL, '0 {} 65[.;]'.format(MACHINE_MAX + 1))
+
+    def test_printall_overflow(self):
+        # a value that is too large for a character fails after everything above it was printed
+        output, _, _, stack, _ = self.assertEquivalent(OP_PRINTALL, '0 {} 65[.;]'.format(1 << 31))
+        self.assertEqual((output, stack), (b'A', [0, 1 << 31]))
+
+    def test_printall_too_few(self):
+        self.assertEquivalent(OP_PRINTALL, '[.;]')
+
+    # the values are duplicated so that the idioms are not folded into constants
+    def test_modadd(self):
+        self.assertEquivalent(OP_MODADD, '123:10%48+')
+        self.assertEquivalent(OP_MODADD, '-7:10%48+')
+
+    def test_modadd_overflow(self):
+        *_, stack, _ = self.assertEquivalent(OP_MODADD, '5:10%{}+'.format(MACHINE_MAX))
+        self.assertEqual(stack, [5, MACHINE_MAX + 5])
+
+    def test_modadd_too_few(self):
+        self.assertEquivalent(OP_MODADD, '10%48+')
+
+    def test_sumloop(self):
+        self.assertEquivalent(OP_SUMLOOP, '0 1 2 3 4[\\+\\]')
+        self.assertEquivalent(OP_SUMLOOP, '0 ' + ' '.join(str(value) for value in range(1, 1000)) + '[\\+\\]')
+
+    def test_sumloop_overflow(self):
+        *_, stack, _ = self.assertEquivalent(OP_SUMLOOP, '0 {0} {0} {0}[\\+\\]'.format(MACHINE_MAX))
+        self.assertEqual(stack, [3 * MACHINE_MAX, 0])
+
+    def test_sumloop_too_few(self):
+        self.assertEquivalent(OP_SUMLOOP, '[\\+\\]')
+        self.assertEquivalent(OP_SUMLOOP, '5[\\+\\]')
+        self.assertEquivalent(OP_SUMLOOP, '1 2 3[\\+\\]')
+
+    def test_productloop(self):
+        self.assertEquivalent(OP_PRODUCTLOOP, '0 1 2 3 4[\\*\\]')
+
+    def test_productloop_overflow(self):
+        *_, stack, _ = self.assertEquivalent(OP_PRODUCTLOOP, '0 1 {0} {0} {0}[\\*\\]'.format(1 << 32))
+        self.assertEqual(stack, [1 << 96, 0])
+
+    def test_productloop_too_few(self):
+        self.assertEquivalent(OP_PRODUCTLOOP, '[\\*\\]')
+        self.assertEquivalent(OP_PRODUCTLOOP, '5[\\*\\]')
+
+    def test_productloop_limited(self):
+        self.assertEquivalent(OP_PRODUCTLOOP, '0 1 {0} {0} {0}[\\*\\]'.format(1 << 32), limits=dict(max_bits=64))
+
+    def test_rangeloop(self):
+        self.assertEquivalent(OP_RANGELOOP, '5[:1-]')
+        self.assertEquivalent(OP_RANGELOOP, '0 5[:1-]')
+        self.assertEquivalent(OP_RANGELOOP, '0[:1-]')
+
+    def test_rangeloop_too_few(self):
+        self.assertEquivalent(OP_RANGELOOP, '[:1-]')
+
+    def test_rangeloop_too_deep(self):
+        # the range does not fit, so the loop runs instruction by instruction until the stack is too deep
+        self.assertEquivalent(OP_RANGELOOP, '100[:1-]', max_depth=10)
+
+    def test_rangeloop_budgeted(self):
+        # the depth limit of a budget is checked before every step, so both engines stop at the same element
+        *_, stack, _ = self.assertEquivalent(OP_RANGELOOP, '3000[:1-]', limits=dict(max_depth=100))
+        self.assertEqual(len(stack), 101)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,94 @@
 import argparse
 import sys
 
+from twostack_budget import TwoStackBudget
 from twostack_interpreter import TwoStackInterpreter
+from twostack_errors import TwoStackSnapshotError
+from twostack_jit import TwoStackJit
+from twostack_snapshot import TwoStackCheckpoint, load_snapshot, rewind_output
+from twostack_source import load_source
+from twostack_transpiler import TwoStackTranspiler
 
 def main():
     '''The main entrypoint for the interpreter running on the terminal.'''
-    interpreter = TwoStackInterpreter()
+    parser = argparse.ArgumentParser(description='Runs a TwoStack program.')
+    parser.add_argument('filename', nargs='?', help='the program to run')
+    parser.add_argument('--profile', action='store_true',
+        help='print the time spent per operator and the hot spots of the program to stderr')
+    parser.add_argument('--transpile', action='store_true',
+        help='translate the program into Python before running it')
+    parser.add_argument('--jit', action='store_true',
+        help='compile the hot loops and blocks of the program while it runs')
+    parser.add_argument('--jit-stats', action='store_true',
+        help='compile the hot loops and blocks and print the hit counts, traces and deopts to stderr')
+    parser.add_argument('--check', action='store_true',
+        help='warn about operators that can never find enough elements on the stack instead of running the program')
+    parser.add_argument('--no-cache', action='store_true',
+        help='prepare the program from scratch instead of using the cache of prepared programs')
+    parser.add_argument('--max-steps', type=int, help='stop the program after this many steps')
+    parser.add_argument('--time-limit', type=float, metavar='SECONDS', help='stop the program after this many seconds')
+    parser.add_argument('--max-elements', type=int, help='stop the program once the stacks hold this many elements together')
+    parser.add_argument('--max-bits', type=int, help='stop the program before it computes an integer larger than this')
+    parser.add_argument('--checkpoint', metavar='FILENAME', help='save snapshots of the run to this file to resume from later')
+    parser.add_argument('--checkpoint-steps', type=int, help='take a snapshot every this many steps')
+    parser.add_argument('--checkpoint-seconds', type=float, metavar='SECONDS',
+        help='take a snapshot every this many seconds (default every 60 seconds unless --checkpoint-steps is given)')
+    parser.add_argument('--resume', metavar='FILENAME',
+        help='continue the run from a snapshot, reading the same input and cutting a redirected output back to the snapshot')
+    options = parser.parse_args()
 
-    if len(sys.argv) >= 2:
-        interpreter.execute_file(sys.argv[1])
-    # TODO: work out a scheme for printing help
+    if options.transpile:
+        interpreter = TwoStackTranspiler()
+    else:
+        interpreter = TwoStackInterpreter()
+
+    if options.no_cache:
+        interpreter.disable_cache()
+
+    if options.profile:
+        interpreter.enable_profiling()
+
+    if options.jit or options.jit_stats:
+        interpreter.set_jit(TwoStackJit())
+
+    checkpoint = None
+    if options.checkpoint:
+        checkpoint = TwoStackCheckpoint(options.checkpoint, options.checkpoint_steps, options.checkpoint_seconds)
+
+    limits = (options.max_steps, options.time_limit, options.max_elements, options.max_bits)
+    if checkpoint is not None or any(limit is not None for limit in limits):
+        interpreter.set_budget(TwoStackBudget(*limits, checkpoint=checkpoint))
+
+    snapshot = None
+    if options.resume:
+        try:
+            snapshot = load_snapshot(options.resume)
+        except (OSError, TwoStackSnapshotError) as error:
+            print('error: cannot resume from {}: {}'.format(options.resume, getattr(error, 'message', error)))
+            sys.exit(1)
+
+    # the output is only cut back once the snapshot is known to belong to this run
+    if snapshot is not None and options.filename and not options.check:
+        try:
+            snapshot.check(interpreter, load_source(options.filename))
+        except (OSError, TwoStackSnapshotError) as error:
+            print('error: cannot resume from {}: {}'.format(options.resume, getattr(error, 'message', error)))
+            sys.exit(1)
+        rewind_output(sys.stdout, snapshot.output_position)
+
+    if options.check:
+        if options.filename:
+            sys.exit(1 if interpreter.check(load_source(options.filename)) else 0)
+        return
+
+    if options.filename:
+        interpreter.execute_file(options.filename, snapshot)
+
+    if options.profile:
+        interpreter.print_profile(sys.stderr)
+
+    if options.jit_stats:
+        interpreter.print_jit(sys.stderr)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,203 @@
+'''TwoStackAnalysis
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the analysis which bounds the depth of both stacks before every token of a program.
+The bounds prove which operators always find the elements they need, so that the check
+can be left out, and find the operators that can never find them.
+'''
+
+from twostack_feature_provider import MINIMUM
+from twostack_lexer import ALIAS_DEF, ALIAS_RECALL, INTEGER, STRING, DEBUG, UNKNOWN
+
+# the change in depth of the stack caused by the operators that only touch the stack
+NET_EFFECT = {
+    '+': -1, '-': -1, '*': -1, '/': -1, '%': -1, '**': -1,
+    '=': -1, '<': -1, '>': -1, '&': -1, '|': -1, '^': -1,
+    '!': 0, ':': 1, ';': -1, '\\': 0, '\\\\': 0, '.': 0, ',': 1,
+    INTEGER: 1
+}
+
+# the bounds of both stacks as (stack low, stack high, ztack low, ztack high)
+# a high bound of None means that the stack could be any size
+FRESH = (0, 0, 0, 0)
+UNBOUNDED = (0, None, 0, None)
+
+# the number of times the bounds of a token may change before the ones still changing are given up
+WIDENING_LIMIT = 4
+
+class Analysis(object):
+    '''The bounds on the depth of both stacks before every token of a program.
+
+    bounds: the bounds before each token, or None if the token can never be reached
+    safe: whether each token is certain to find the elements that it needs
+    diagnostics: the source offset and message of every operator that can never find its elements
+
+    The bounds hold for any run, as long as blocks are only called at their beginning.
+    The high bounds assume a fresh interpreter, so they are only used for the diagnostics.
+    '''
+
+    def __init__(self, tokens):
+        self.bounds = [None] * len(tokens)
+        self.safe = [False] * len(tokens)
+        self.diagnostics = []
+
+def shift(low, high, change):
+    '''Moves the bounds of a stack by a number of elements.'''
+    return max(0, low + change), None if high is None else high + change
+
+def join(first, second):
+    '''Returns the bounds that cover both bounds.'''
+    return (
+        min(first[0], second[0]),
+        None if first[1] is None or second[1] is None else max(first[1], second[1]),
+        min(first[2], second[2]),
+        None if first[3] is None or second[3] is None else max(first[3], second[3])
+    )
+
+def widen(old, new):
+    '''Gives up on the bounds that are still changing, so that loops settle quickly.'''
+    return (
+        0 if new[0] != old[0] else new[0],
+        None if new[1] != old[1] else new[1],
+        0 if new[2] != old[2] else new[2],
+        None if new[3] != old[3] else new[3]
+    )
+
+def successors(tokens, jumps, index, bounds):
+    '''Returns the tokens that can run after a token along with the bounds before each of them.'''
+    token = tokens[index]
+    key = token.key
+
+    if key == UNKNOWN or key == '}':
+        # unknown symbols stop the program and blocks return to wherever they were called from
+        return []
+
+    if key == DEBUG:
+        return [(index + 1, bounds)]
+
+    stack_low, stack_high, ztack_low, ztack_high = bounds
+
+    # only an operator that found enough elements lets the program continue
+    minimum = MINIMUM[key]
+    if stack_high is not None and stack_high < minimum:
+        return []
+    stack_low = max(stack_low, minimum)
+
+    if key == '[':
+        # the loop is only entered when there is a non-zero element on top
+        skip = (jumps[index] + 1, bounds)
+        if stack_high == 0:
+            return [skip]
+        return [(index + 1, (max(stack_low, 1), stack_high, ztack_low, ztack_high)), skip]
+
+    if key == ']':
+        return [(jumps[index], (stack_low, stack_high, ztack_low, ztack_high))]
+
+    if key == '{':
+        return [(jumps[index] + 1, shift(stack_low, stack_high, 1) + (ztack_low, ztack_high))]
+
+    if key == '@' or key == '?':
+        # the block that is called could leave the stacks in any state
+        return [(index + 1, UNBOUNDED)]
+
+    if key == '$':
+        return [(index + 1, (ztack_low, ztack_high, stack_low, stack_high))]
+
+    if key == '`':
+        return [(index + 1, shift(stack_low, stack_high, -1) + shift(ztack_low, ztack_high, 1))]
+
+    if key == ALIAS_RECALL:
+        # an alias that has not been defined pushes nothing
+        change_low, change_high = 0, 1
+    elif key == ALIAS_DEF:
+        change_low = change_high = -1 if token.value >= 0 else 0
+    elif key == STRING:
+        change_low = change_high = len(token.value)
+    else:
+        change_low = change_high = NET_EFFECT[key]
+
+    stack_low = max(0, stack_low + change_low)
+    if stack_high is not None:
+        stack_high += change_high
+
+    return [(index + 1, (stack_low, stack_high, ztack_low, ztack_high))]
+
+def analyse(tokens, jumps):
+    '''Bounds the depth of both stacks before every token of a stripped program with resolved aliases.
+    The program starts with empty stacks and every block starts with stacks of any size.
+    '''
+    analysis = Analysis(tokens)
+    bounds = analysis.bounds
+    changes = [0] * len(tokens)
+    worklist = []
+
+    def merge(index, new):
+        if index >= len(tokens):
+            return
+
+        old = bounds[index]
+        if old is not None:
+            new = join(old, new)
+            if new == old:
+                return
+            changes[index] += 1
+            if changes[index] > WIDENING_LIMIT:
+                new = widen(old, new)
+
+        bounds[index] = new
+        worklist.append(index)
+
+    merge(0, FRESH)
+    for index, token in enumerate(tokens):
+        if token.key == '{':
+            merge(index + 1, UNBOUNDED)
+
+    while worklist:
+        index = worklist.pop()
+        for successor, new in successors(tokens, jumps, index, bounds[index]):
+            merge(successor, new)
+
+    for index, token in enumerate(tokens):
+        if bounds[index] is None or token.key == UNKNOWN or token.key == DEBUG:
+            continue
+
+        minimum = MINIMUM[token.key]
+        stack_low, stack_high = bounds[index][:2]
+        analysis.safe[index] = stack_low >= minimum
+
+        if stack_high is not None and stack_high < minimum:
+            analysis.diagnostics.append((token.offset, 'not enough elements on the stack'))
+
+    return analysis
+
+def block_effect(tokens, jumps, index):
+    '''Checks whether the block opened by the { at the token index is pure, that is whether it only
+    works on the top elements of the stack without any output, input, aliases, loops or calls.
+    Returns the number of elements that the block consumes, or None if it is not pure.
+    '''
+    height = 0
+    consumed = 0
+    inner = index + 1
+
+    while inner < jumps[index]:
+        token = tokens[inner]
+        key = token.key
+
+        if key == '{':
+            # a nested block only pushes its offset
+            height += 1
+            inner = jumps[inner] + 1
+            continue
+
+        if key == STRING:
+            change = len(token.value)
+        elif key in NET_EFFECT and key not in ('.', ','):
+            change = NET_EFFECT[key]
+        else:
+            return None
+
+        consumed = max(consumed, MINIMUM[key] - height)
+        height += change
+        inner += 1
+
+    return consumed
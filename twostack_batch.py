@@ -0,0 +1,256 @@
+'''TwoStackBatch
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the batch runner which runs a single program against many input files.
+The program is prepared once and then handed to a pool of worker processes,
+each of which runs it with the contents of one input file as stdin.
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+from twostack_budget import TwoStackBudget
+from twostack_errors import TwoStackSyntaxError, TwoStackBudgetError
+from twostack_interpreter import TwoStackInterpreter
+from twostack_io import ENCODING
+from twostack_memo import TwoStackMemo, DEFAULT_SIZE
+from twostack_program import Program
+from twostack_stack import DEFAULT_MAX_DEPTH
+from twostack_transpiler import TwoStackTranspiler
+from twostack_vm import TwoStackVirtualMachine
+
+# the engines that a batch can be run on
+ENGINES = {
+    'interpreter': TwoStackInterpreter,
+    'vm': TwoStackVirtualMachine,
+    'transpiler': TwoStackTranspiler
+}
+
+DEFAULT_ENGINE = 'vm'
+
+# the number of inputs that are sent to a worker at once
+DEFAULT_CHUNK_SIZE = 8
+
+# the state of a worker process, set up once by initialize_worker
+worker = {}
+
+class JobTimeout(Exception):
+    '''Raised inside of a worker when a job has run for longer than its timeout.'''
+
+def raise_timeout(signum, frame):
+    '''Handles the alarm that goes off once a job runs out of time.'''
+    raise JobTimeout()
+
+def initialize_worker(engine, prepared, timeout, max_depth, budget, memo_size):
+    '''Sets up a worker process with the prepared program.
+    The results of pure blocks are remembered across all of the jobs of the worker.
+    '''
+    worker['engine'] = ENGINES[engine]
+    worker['timeout'] = timeout
+    worker['max_depth'] = max_depth
+    worker['budget'] = budget
+    worker['memo'] = TwoStackMemo(memo_size) if memo_size > 0 else None
+    worker['program'] = Program(create_engine, None, prepared)
+
+    # jobs are stopped by an alarm, this is not available on every platform
+    if timeout and hasattr(signal, 'setitimer'):
+        signal.signal(signal.SIGALRM, raise_timeout)
+
+def create_engine():
+    '''Creates the engine that runs the jobs of a worker, with the limits of the batch.'''
+    interpreter = worker['engine'](max_depth=worker['max_depth'])
+    interpreter.set_budget(worker['budget'])
+    interpreter.set_memo(worker['memo'])
+    return interpreter
+
+def run_job(filename):
+    '''Runs the prepared program with the contents of a file as its input.
+    Returns a dictionary describing the result. The status is ok when the program finished,
+    even if it reported an error, failed when the engine raised an unexpected exception,
+    budget when the run exceeded its budget and timeout when the job ran for longer than the timeout.
+    '''
+    result = {'input': filename, 'status': 'ok'}
+    stdout = io.BytesIO()
+    messages = io.StringIO()
+    timeout = worker['timeout'] if hasattr(signal, 'setitimer') else None
+
+    start = time.perf_counter()
+    try:
+        with open(filename, 'rb') as file:
+            data = file.read()
+
+        with contextlib.redirect_stdout(messages):
+            if timeout:
+                signal.setitimer(signal.ITIMER_REAL, timeout)
+            try:
+                worker['program'].run(data, stdout)
+            finally:
+                if timeout:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+
+    except JobTimeout:
+        result['status'] = 'timeout'
+    except TwoStackBudgetError as error:
+        result['status'] = 'budget'
+        result['error'] = error.message
+    except SystemExit:
+        # the debug menu quits the program, not the worker
+        pass
+    except Exception as error:
+        result['status'] = 'failed'
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+
+    result['seconds'] = time.perf_counter() - start
+    result['output'] = stdout.getvalue()
+    result['messages'] = messages.getvalue()
+    return result
+
+def prepare_program(program, engine=DEFAULT_ENGINE, cache=True):
+    '''Prepares a program for the engine, through the cache unless it is turned off.
+    Raises a TwoStackSyntaxError if the brackets of the program are unbalanced.
+    '''
+    interpreter = ENGINES[engine]()
+    if cache and interpreter.cache is not None:
+        return interpreter.cache.fetch(program, interpreter)
+    return interpreter.prepare(program)
+
+def run_batch(program, filenames, engine=DEFAULT_ENGINE, jobs=None, ordered=True, timeout=None,
+        max_depth=DEFAULT_MAX_DEPTH, chunk_size=DEFAULT_CHUNK_SIZE, cache=True, budget=None, memo_size=DEFAULT_SIZE):
+    '''Runs a program against every input file on a pool of worker processes.
+    Yields the result of every job, in the order of the files if ordered is set,
+    otherwise as soon as each one is finished. Every job is limited to the budget if there is one.
+    Each worker remembers up to memo_size results of pure blocks, 0 turns memoization off.
+    Raises a TwoStackSyntaxError if the brackets of the program are unbalanced.
+    '''
+    prepared = prepare_program(program, engine, cache)
+
+    with multiprocessing.Pool(jobs, initialize_worker,
+            (engine, prepared, timeout, max_depth, budget, memo_size)) as pool:
+        if ordered:
+            results = pool.imap(run_job, filenames, chunk_size)
+        else:
+            results = pool.imap_unordered(run_job, filenames, chunk_size)
+
+        for result in results:
+            yield result
+
+def encode_result(result):
+    '''Returns a result as a line of JSON, the output is decoded as text.'''
+    document = dict(result)
+    document['output'] = result['output'].decode(ENCODING, 'replace')
+    return json.dumps(document)
+
+def save_result(directory, result):
+    '''Writes the output of a job to <input name>.out in the directory.
+    The messages and any failure are written to <input name>.err next to it.
+    '''
+    name = os.path.join(directory, os.path.basename(result['input']))
+
+    with open(name + '.out', 'wb') as file:
+        file.write(result['output'])
+
+    problems = result['messages']
+    if result['status'] == 'timeout':
+        problems += 'timed out\n'
+    elif result['status'] in ('failed', 'budget'):
+        problems += result['error'] + '\n'
+
+    if problems:
+        with open(name + '.err', 'w') as file:
+            file.write(problems)
+    elif os.path.exists(name + '.err'):
+        os.remove(name + '.err')
+
+def read_filenames(filename):
+    '''Reads the names of input files, one per line.'''
+    with open(filename) as file:
+        return [line.rstrip('\n') for line in file if line.strip()]
+
+def main():
+    '''The main entrypoint for the batch runner.'''
+    parser = argparse.ArgumentParser(description='Runs a TwoStack program against many input files.')
+    parser.add_argument('program', help='the program to run')
+    parser.add_argument('inputs', nargs='*', help='the files to use as the input of each run')
+    parser.add_argument('--inputs-from', metavar='FILENAME',
+        help='read the names of the input files from a file, one per line')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default=DEFAULT_ENGINE,
+        help='the engine that runs the program (default %(default)s)')
+    parser.add_argument('--jobs', type=int, help='the number of worker processes (default: one per CPU)')
+    parser.add_argument('--unordered', action='store_true',
+        help='report every result as soon as it is finished instead of in the order of the inputs')
+    parser.add_argument('--timeout', type=float, metavar='SECONDS', help='stop any run that takes longer than this')
+    parser.add_argument('--max-depth', type=int, default=DEFAULT_MAX_DEPTH,
+        help='the number of elements that a single stack may hold')
+    parser.add_argument('--max-steps', type=int, help='stop any run after this many steps')
+    parser.add_argument('--time-limit', type=float, metavar='SECONDS',
+        help='stop any run after this many seconds, checked by the interpreter itself')
+    parser.add_argument('--max-elements', type=int, help='stop any run once its stacks hold this many elements together')
+    parser.add_argument('--max-bits', type=int, help='stop any run before it computes an integer larger than this')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+        help='the number of inputs sent to a worker at once (default %(default)s)')
+    parser.add_argument('--output-dir', metavar='DIRECTORY',
+        help='write the output of every run to a file instead of printing JSON lines')
+    parser.add_argument('--jsonl', metavar='FILENAME', help='write the JSON lines to a file instead of stdout')
+    parser.add_argument('--no-cache', action='store_true',
+        help='prepare the program from scratch instead of using the cache of prepared programs')
+    parser.add_argument('--memo-size', type=int, default=DEFAULT_SIZE,
+        help='the number of results of pure blocks each worker remembers on the vm, 0 turns it off (default %(default)s)')
+    options = parser.parse_args()
+
+    filenames = list(options.inputs)
+    if options.inputs_from:
+        filenames.extend(read_filenames(options.inputs_from))
+
+    if options.output_dir:
+        names = [os.path.basename(filename) for filename in filenames]
+        if len(set(names)) != len(names):
+            parser.error('the inputs must have distinct names to be saved to a directory')
+        os.makedirs(options.output_dir, exist_ok=True)
+
+    with open(options.program) as file:
+        program = file.read()
+
+    budget = None
+    limits = (options.max_steps, options.time_limit, options.max_elements, options.max_bits)
+    if any(limit is not None for limit in limits):
+        budget = TwoStackBudget(*limits)
+
+    jsonl = None
+    if not options.output_dir:
+        jsonl = open(options.jsonl, 'w') if options.jsonl else sys.stdout
+
+    failures = 0
+    try:
+        results = run_batch(program, filenames, options.engine, options.jobs, not options.unordered,
+            options.timeout, options.max_depth, max(1, options.chunk_size), not options.no_cache, budget, options.memo_size)
+
+        for result in results:
+            failures += result['status'] != 'ok'
+            if jsonl is None:
+                save_result(options.output_dir, result)
+            else:
+                jsonl.write(encode_result(result) + '\n')
+                jsonl.flush()
+
+    except TwoStackSyntaxError as error:
+        # report it exactly like running the program on its own would
+        interpreter = TwoStackInterpreter()
+        interpreter.program = program
+        interpreter.error(error.message, error.offset)
+        sys.exit(1)
+
+    finally:
+        if jsonl is not None and jsonl is not sys.stdout:
+            jsonl.close()
+
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
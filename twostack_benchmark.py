@@ -0,0 +1,572 @@
+'''TwoStackBenchmark
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Times the TwoStack execution engines against each other.
+Usage: python twostack_benchmark.py [--lex | --cat MEGABYTES | --verify] [program.ts ...]
+
+By default every program in programs/ and every parameterized workload is run on every engine,
+recording the wall time, steps per second and peak memory. The results can be saved as JSON
+with --json and compared against an earlier run with --baseline.
+'''
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from twostack_budget import TwoStackBudget
+from twostack_interpreter import TwoStackInterpreter
+from twostack_jit import TwoStackJit, HOT_LOOP, HOT_BLOCK
+from twostack_vm import TwoStackVirtualMachine
+from twostack_transpiler import TwoStackTranspiler
+from twostack_lexer import lex
+from twostack_cache import TwoStackCache
+
+def traced(hot_loop=HOT_LOOP, hot_block=HOT_BLOCK):
+    '''Returns an engine that interprets programs while tracing their hot loops and blocks.'''
+    def engine(output=None, input=None):
+        interpreter = TwoStackInterpreter(output, input)
+        interpreter.set_jit(TwoStackJit(hot_loop, hot_block))
+        return interpreter
+    return engine
+
+# the engines that are compared, the first one is the reference
+ENGINES = (
+    ('interpreter', TwoStackInterpreter),
+    ('vm', TwoStackVirtualMachine),
+    ('transpiler', TwoStackTranspiler),
+    ('jit', traced())
+)
+
+# verification also traces every loop and block as soon as possible, so that most code runs in traces
+VERIFY_ENGINES = ENGINES + (('jit-eager', traced(1, 1)),)
+
+# the input given to programs that read from stdin
+SAMPLE_INPUT = 'The quick brown fox jumps over the lazy dog.\n' * 20
+
+PROGRAM_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'programs')
+
+# the programs used by the lexer micro-benchmark
+# along with the code that pushes their arguments
+LEX_PROGRAMS = (
+    ('fizzbuzz.ts', ''),
+    ('factorial.ts', '200 ')
+)
+
+# the patterns that were matched against the rest of the program on every step
+# before programs were lexed, kept here as the baseline for the lexer micro-benchmark
+LEGACY_PATTERNS = ('^[a-zA-Z]+', '^[0-9]+')
+
+# small programs that exercise the rewrites of the compiler, including the cases
+# where a superinstruction has to fall back to the instructions it replaced
+VERIFY_PROGRAMS = (
+    # [`] and [.;]
+    '0$0$"Hello, World!"[`]$[.;]$',
+    '[`]$[.;]$',
+    '65 66 0 67 68[`]$[.;]$',
+    # 10%48+
+    '12345 10%48+.',
+    '0 17-10%48+.',
+    '10%48+',
+    '7 3%48+ 5 0%48+',
+    # [\+\] and [\*\]
+    '0 1 2 3 4\\[\\+\\];',
+    '5\\[\\+\\];',
+    '1 2\\[\\+\\];',
+    '0 1 2 3 4\\[\\*\\];',
+    '6 0\\[:1-];[\\*\\];',
+    # 0[ ... ];
+    '1 0[ this is "ignored" ];2+.',
+    '0[ unbalanced { brace ];1',
+    '{0[ } ];1 0 65 ~b b@ b@',
+    '0[ 0[ nested ]; "and" {blocks} ];1',
+    # idioms inside blocks
+    '{[.;]}~p 0 65 66 p@ 0 67 p@',
+    # values that do not fit into a machine integer
+    '9223372036854775807 1+ 2 64** 0 5 3\\[\\*\\];',
+    '3 99999999999999999999 10%48+ 0 9223372036854775807 9223372036854775807\\[\\+\\];',
+    '"big"[`]$ 2 63**[`]$',
+    # jumps into code whose checks were left out by the analysis
+    '1 2+ ;3@',
+    '{;;}~b 1 2 b@ b@ 0 3 -@',
+    # constant expressions, folded where that cannot change the result
+    '10 10 = 3 4 < 5 ! 0 ! & | 2 ^ 0 1- 2 * 5 / 3 %',
+    '"hi" "" 48 1+. 3 62** 2 62** 1- 2 0 1- **',
+    '{1 2+}@ 4 5* [1-] 7 0 1- % 7 2 - 0 =',
+    # [:1-] and bulk reductions large enough for numpy
+    '5[:1-]; 0[:1-] 1000[:1-];\\[\\+\\]; 0 1 1 1000[:1-];\\[\\+\\];',
+    '3000[:1-];[\\*\\]; 1 2 3 1000[:1-];[\\*\\];',
+    '0 9223372036854775807 300[:1-];\\[\\+\\]; 0 1000[:1-]; 0 7[`]$[.;]$',
+    '300[:1-]\\[\\+\\];',
+    # pure blocks, called again with the same elements on top
+    '{:2%0=\\3%0=+}~e 20[:e@.;1-] 20[:e@.;1-]',
+    '{"ab"+:*1+}~f 5[:f@.;1-] f@ f@ 1 2 3 f@',
+    '{1+2*3-4+}~g g@ 1 g@ 1 g@ 0 1 g?',
+    '{:62**:*1+}~h 1 h@ 1 h@ 2 h@ 2 h@',
+    '{1 2 3 {7}@ +}~n n@ n@ 5 1 {\\ 2 * - 3 +}@@',
+    '{:1+ 0/ 1+}~z 2 z@ 2 z@',
+)
+
+# programs run with a budget, given as the arguments of TwoStackBudget, where the bulk loops
+# of the virtual machine have to pay for every element and fall back to the loop they replaced
+VERIFY_BUDGETED_PROGRAMS = (
+    ('3000000[:1-];', dict(max_steps=100000, max_depth=1000)),
+    ('0 1000[:1-];\\[\\+\\];', dict(max_depth=5000)),
+    ('0 5000[:1-];\\[\\+\\];', dict(max_depth=10000)),
+    ('0 1000[:1-];\\[\\+\\];', dict(max_steps=500)),
+    ('1 2 3 900[:1-];[\\*\\]; 0 100[:1-];\\[\\+\\];', dict(max_steps=2000000, max_depth=2000)),
+)
+
+# the line that is repeated to make up the input of the cat benchmark
+CAT_LINE = b'The quick brown fox jumps over the lazy dog.\n'
+
+# the default size of each parameterized workload
+WORKLOAD_SIZES = (
+    ('fizzbuzz', 1000),
+    ('factorial', 300),
+    ('sum', 20000),
+    ('cat', 64 * 1024)
+)
+
+# a workload that takes this much longer than in the baseline is a regression
+DEFAULT_TOLERANCE = 0.1
+
+def read_program(name):
+    '''Returns the source of one of the programs in programs/.'''
+    with open(os.path.join(PROGRAM_DIRECTORY, name)) as file:
+        return file.read()
+
+def fizzbuzz_workload(size):
+    '''Plays fizzbuzz up to size with programs/fizzbuzz.ts.'''
+    program = read_program('fizzbuzz.ts')
+
+    # the loop of the program stops once the counter reaches 100
+    limit = '$1+:100<'
+    if limit not in program:
+        raise ValueError('the loop condition of fizzbuzz.ts could not be found')
+
+    return program.replace(limit, '$1+:{}<'.format(size)), ''
+
+def factorial_workload(size):
+    '''Computes the factorial of size with programs/factorial.ts.'''
+    return '{} {}'.format(size, read_program('factorial.ts')), ''
+
+def sum_workload(size):
+    '''Sums the numbers from 1 to size with programs/sum.ts.'''
+    return '{} 0\\[:1-];{}'.format(size, read_program('sum.ts')), ''
+
+def cat_workload(size):
+    '''Copies size bytes from the input to the output with programs/cat.ts.'''
+    data = (CAT_LINE * (size // len(CAT_LINE) + 1))[:size]
+    return read_program('cat.ts'), data
+
+# the parameterized workloads, each builds a program and its input from a size
+WORKLOADS = {
+    'fizzbuzz': fizzbuzz_workload,
+    'factorial': factorial_workload,
+    'sum': sum_workload,
+    'cat': cat_workload
+}
+
+def run_engine(engine, program, stdin=SAMPLE_INPUT):
+    '''Runs a program on a fresh instance of the engine.
+    Returns the elapsed time and everything that was written to stdout.
+    '''
+    stdout = io.BytesIO()
+    interpreter = engine(stdout, stdin)
+
+    start = time.perf_counter()
+    interpreter.execute(program)
+    elapsed = time.perf_counter() - start
+
+    return elapsed, stdout.getvalue()
+
+def best_time(engine, program, repeat, stdin=SAMPLE_INPUT):
+    '''Returns the fastest of several runs along with the output of the last run.'''
+    times = []
+    for _ in range(repeat):
+        elapsed, output = run_engine(engine, program, stdin)
+        times.append(elapsed)
+    return min(times), output
+
+def peak_memory(engine, program, stdin=SAMPLE_INPUT):
+    '''Returns the largest number of bytes that were allocated at once while running a program.'''
+    tracemalloc.start()
+    try:
+        run_engine(engine, program, stdin)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def measure(name, program, stdin, repeat=5):
+    '''Runs a workload on every engine.
+    Returns a dictionary of measurements for each engine and raises an AssertionError
+    if an engine does not produce the same output as the reference engine.
+    The steps are the operators run by the reference engine, so that engines
+    which fuse operators together are still measured against the same amount of work.
+    '''
+    results = []
+    expected = None
+
+    # the error messages of the programs would only clutter the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        steps = len(execution_trace(program, stdin))
+
+        for engine_name, engine in ENGINES:
+            elapsed, output = best_time(engine, program, repeat, stdin)
+            if expected is None:
+                expected = output
+            elif output != expected:
+                raise AssertionError('{} produced different output'.format(engine_name))
+
+            results.append({
+                'workload': name,
+                'engine': engine_name,
+                'steps': steps,
+                'seconds': elapsed,
+                'steps_per_second': steps / elapsed if elapsed else 0.0,
+                'peak_memory': peak_memory(engine, program, stdin)
+            })
+
+    return results
+
+def collect_workloads(filenames, sizes):
+    '''Returns the name, program and input of every workload to run.
+    These are the given programs, or every program in programs/ followed by
+    the parameterized workloads at the given sizes if no programs are given.
+    '''
+    workloads = []
+
+    for filename in filenames or sorted(glob.glob(os.path.join(PROGRAM_DIRECTORY, '*.ts'))):
+        with open(filename) as file:
+            workloads.append((os.path.basename(filename), file.read(), SAMPLE_INPUT))
+
+    if not filenames:
+        for name, size in sizes:
+            program, stdin = WORKLOADS[name](size)
+            workloads.append(('{}({})'.format(name, size), program, stdin))
+
+    return workloads
+
+def load_baseline(filename):
+    '''Loads the results of an earlier run, keyed by workload and engine.'''
+    with open(filename) as file:
+        document = json.load(file)
+
+    return dict(((result['workload'], result['engine']), result)
+        for result in document['results'] if 'error' not in result)
+
+def save_results(filename, results, repeat):
+    '''Saves the results of a run as JSON, along with a description of the machine.'''
+    document = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'results': results
+    }
+
+    with open(filename, 'w') as file:
+        json.dump(document, file, indent=2)
+        file.write('\n')
+
+def run_suite(workloads, repeat=5, baseline=None, tolerance=DEFAULT_TOLERANCE):
+    '''Measures every workload and prints a report, comparing against the baseline if there is one.
+    Returns the results and the number of workloads that failed or got slower than the tolerance allows.
+    '''
+    results = []
+    failures = 0
+
+    for name, program, stdin in workloads:
+        try:
+            measurements = measure(name, program, stdin, repeat)
+        except Exception as error:
+            # a broken engine is reported rather than hidden like execute_file would
+            print('{}\n  error: {}: {}'.format(name, type(error).__name__, error))
+            results.append({'workload': name, 'error': '{}: {}'.format(type(error).__name__, error)})
+            failures += 1
+            continue
+
+        reference = measurements[0]['seconds']
+        print('{} ({} steps)'.format(name, measurements[0]['steps']))
+
+        for result in measurements:
+            line = '  {:<12} {:9.3f} ms  {:7.3f} Msteps/s  {:9.1f} KB  {:6.2f}x'.format(
+                result['engine'],
+                result['seconds'] * 1000,
+                result['steps_per_second'] / 1e6,
+                result['peak_memory'] / 1024,
+                reference / result['seconds'] if result['seconds'] else 0.0)
+
+            previous = baseline and baseline.get((name, result['engine']))
+            if previous:
+                change = result['seconds'] / previous['seconds'] - 1
+                line += '  {:+7.1%}'.format(change)
+                if change > tolerance:
+                    line += '  REGRESSION'
+                    failures += 1
+
+            print(line)
+
+        results.extend(measurements)
+
+    return results, failures
+
+def parse_size(text):
+    '''Parses the size of a parameterized workload given as name=size.'''
+    name, _, size = text.partition('=')
+    if name not in WORKLOADS or not size.isdigit():
+        raise argparse.ArgumentTypeError('expected one of {} followed by =size'.format(', '.join(sorted(WORKLOADS))))
+    return name, int(size)
+
+def execution_trace(program, stdin=SAMPLE_INPUT):
+    '''Runs a program and returns the source offset of every executed step.'''
+    interpreter = TwoStackInterpreter(io.BytesIO(), stdin)
+    trace = []
+
+    # wrap every operator so that it records where it was executed from
+    def record(function):
+        def recorded():
+            trace.append(interpreter.token.offset)
+            return function()
+        return recorded
+
+    for command in interpreter.commands.values():
+        command['function'] = record(command['function'])
+
+    interpreter.execute(program)
+
+    return trace
+
+def legacy_classify(program, trace):
+    '''Classifies the symbol at every executed step the way execute used to.
+    The remaining source is sliced at every step and anything that is not an operator
+    is tested against every regular expression of the command manifest.
+    '''
+    operators = set(TwoStackInterpreter().commands) - set(LEGACY_PATTERNS)
+
+    for offset in trace:
+        rest = program[offset:]
+        if rest[:2] in operators or rest[0] in operators:
+            continue
+        for pattern in LEGACY_PATTERNS:
+            if re.match(pattern, rest):
+                break
+
+def lexed_classify(program, trace):
+    '''Classifies the symbol at every executed step the way execute does now.
+    The program is lexed once and every step is a lookup of the current token.
+    '''
+    commands = TwoStackInterpreter().commands
+    tokens = lex(program)
+    indexes = dict((token.offset, index) for index, token in enumerate(tokens))
+
+    # translate the trace up front so that only the lookups are timed below
+    for index in [indexes[offset] for offset in trace]:
+        commands.get(tokens[index].key)
+
+def lex_benchmark(filenames, repeat=5):
+    '''Compares lexing once with classifying the source on every executed step.
+    Each filename is paired with a prefix that is prepended to the program.
+    '''
+    for filename, prefix in filenames:
+        with open(filename) as file:
+            program = prefix + file.read()
+
+        trace = execution_trace(program)
+
+        results = []
+        for name, function in (('regex scan', legacy_classify), ('lexer', lexed_classify)):
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                function(program, trace)
+                times.append(time.perf_counter() - start)
+            results.append((name, min(times)))
+
+        reference = results[0][1]
+
+        print('{} ({} steps)'.format(os.path.basename(filename), len(trace)))
+        for name, elapsed in results:
+            print('  {:<12} {:9.3f} ms  {:6.2f}x'.format(name, elapsed * 1000, reference / elapsed))
+
+class CountingSink(object):
+    '''A binary sink that throws its data away, only counting the bytes.'''
+
+    def __init__(self):
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+
+def cat_benchmark(megabytes):
+    '''Pushes the given number of megabytes through programs/cat.ts on every engine.'''
+    size = int(megabytes * 1024 * 1024)
+    program, data = cat_workload(size)
+
+    print('cat.ts ({:.1f} MB)'.format(size / (1024 * 1024)))
+    for name, engine in ENGINES:
+        sink = CountingSink()
+        interpreter = engine(sink, data)
+
+        start = time.perf_counter()
+        interpreter.execute(program)
+        elapsed = time.perf_counter() - start
+
+        if sink.count != size:
+            raise AssertionError('{} wrote {} of {} bytes'.format(name, sink.count, size))
+
+        print('  {:<12} {:9.3f} s  {:8.3f} MB/s'.format(name, elapsed, size / elapsed / (1024 * 1024)))
+
+def start_file(engine, filename, cache):
+    '''Runs a file on a fresh instance of the engine through execute_file, returning the elapsed time.'''
+    interpreter = engine(CountingSink(), SAMPLE_INPUT)
+    interpreter.cache = cache
+
+    start = time.perf_counter()
+    interpreter.execute_file(filename)
+    return time.perf_counter() - start
+
+def startup_benchmark(filenames, repeat=5):
+    '''Compares running files without the cache, with an empty cache and with a filled cache.
+    The cache lives in a temporary directory so that the cache of the user is left alone.
+    '''
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()) as messages:
+        cache = TwoStackCache(directory)
+        results = []
+
+        for filename in filenames:
+            for name, engine in ENGINES:
+                uncached = min(start_file(engine, filename, None) for _ in range(repeat))
+
+                cold = []
+                for _ in range(repeat):
+                    cache.clear()
+                    cold.append(start_file(engine, filename, cache))
+
+                warm = min(start_file(engine, filename, cache) for _ in range(repeat))
+                results.append((filename, name, uncached, min(cold), warm))
+
+    for filename, name, uncached, cold, warm in results:
+        if name == ENGINES[0][0]:
+            print(os.path.basename(filename))
+        print('  {:<12} uncached {:8.3f} ms  cold {:8.3f} ms  warm {:8.3f} ms  {:6.2f}x'.format(
+            name, uncached * 1000, cold * 1000, warm * 1000, uncached / warm if warm else 0.0))
+
+def run_captured(engine, program, limits=None):
+    '''Runs a program, returning everything it printed and the state it finished in.
+    The run is limited to a budget with the given limits if there are any.
+    Unexpected exceptions are part of the result so that engines must also fail alike,
+    the stacks are left out in that case as they are only partially updated.
+    '''
+    stdout = io.BytesIO()
+    interpreter = engine(stdout, SAMPLE_INPUT)
+    if limits is not None:
+        interpreter.set_budget(TwoStackBudget(**limits))
+    exception = None
+
+    old_stdout = sys.stdout
+    sys.stdout = messages = io.StringIO()
+    try:
+        interpreter.execute(program)
+    except Exception as error:
+        exception = type(error).__name__
+    finally:
+        sys.stdout = old_stdout
+
+    if exception is not None:
+        return stdout.getvalue(), messages.getvalue(), exception
+
+    aliases = dict(zip(interpreter.aliases, interpreter.store))
+    return stdout.getvalue(), messages.getvalue(), exception, list(interpreter.stack), list(interpreter.ztack), aliases
+
+def verify(programs, budgeted=()):
+    '''Checks that every engine finishes the programs exactly like the reference engine,
+    followed by the budgeted programs, each given along with its limits.
+    Returns the number of programs that did not match.
+    '''
+    failures = 0
+
+    for program, limits in [(program, None) for program in programs] + list(budgeted):
+        results = [(name, run_captured(engine, program, limits)) for name, engine in VERIFY_ENGINES]
+        reference = results[0][1]
+        mismatched = [name for name, result in results if result != reference]
+
+        title = program.strip().splitlines()[0]
+        if limits is not None:
+            title += '  ' + ' '.join('{}={}'.format(name, value) for name, value in sorted(limits.items()))
+        print('{:<6} {}'.format('FAIL' if mismatched else 'ok', title))
+        for name in mismatched:
+            print('  {} does not match {}'.format(name, results[0][0]))
+        failures += bool(mismatched)
+
+    return failures
+
+def main():
+    '''The main entrypoint for the benchmark.'''
+    parser = argparse.ArgumentParser(description='Benchmarks the TwoStack engines.')
+    parser.add_argument('--lex', action='store_true',
+        help='compare the lexer against the old per-step regex classification')
+    parser.add_argument('--cat', type=float, metavar='MEGABYTES',
+        help='push this many megabytes of input through programs/cat.ts')
+    parser.add_argument('--startup', action='store_true',
+        help='compare running files without the cache, with an empty cache and with a filled cache')
+    parser.add_argument('--verify', action='store_true',
+        help='check that every engine gives the same results instead of timing them')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='the number of times each workload is run, the fastest run counts')
+    parser.add_argument('--size', type=parse_size, action='append', default=[], metavar='NAME=SIZE',
+        help='change the size of a parameterized workload ({})'.format(', '.join(name for name, _ in WORKLOAD_SIZES)))
+    parser.add_argument('--json', metavar='FILENAME', help='save the results to a JSON file')
+    parser.add_argument('--baseline', metavar='FILENAME', help='compare the results against an earlier JSON file')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help='how much slower than the baseline a workload may get, as a fraction (default %(default)s)')
+    parser.add_argument('filenames', nargs='*', help='the programs to benchmark')
+    options = parser.parse_args()
+
+    if options.verify:
+        programs = list(VERIFY_PROGRAMS)
+        for filename in options.filenames or sorted(glob.glob(os.path.join(PROGRAM_DIRECTORY, '*.ts'))):
+            with open(filename) as file:
+                programs.append(file.read())
+        sys.exit(1 if verify(programs, VERIFY_BUDGETED_PROGRAMS) else 0)
+
+    if options.cat:
+        cat_benchmark(options.cat)
+        return
+
+    if options.startup:
+        startup_benchmark(options.filenames or sorted(glob.glob(os.path.join(PROGRAM_DIRECTORY, '*.ts'))), max(1, options.repeat))
+        return
+
+    if options.lex:
+        if options.filenames:
+            filenames = [(filename, '') for filename in options.filenames]
+        else:
+            filenames = [(os.path.join(PROGRAM_DIRECTORY, name), prefix) for name, prefix in LEX_PROGRAMS]
+        lex_benchmark(filenames)
+        return
+
+    sizes = dict(WORKLOAD_SIZES)
+    sizes.update(options.size)
+    workloads = collect_workloads(options.filenames, [(name, sizes[name]) for name, _ in WORKLOAD_SIZES])
+    baseline = load_baseline(options.baseline) if options.baseline else None
+
+    results, failures = run_suite(workloads, max(1, options.repeat), baseline, options.tolerance)
+
+    if options.json:
+        save_results(options.json, results, options.repeat)
+
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+'''TwoStackBudget
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the budget which limits the resources a single run of a program may use.
+'''
+
+import time
+
+from twostack_errors import TwoStackError, TwoStackBudgetError
+
+# the number of steps between two checks of the budget
+DEFAULT_INTERVAL = 1024
+
+def bits(value):
+    '''Returns the number of bits of an integer, other values are not limited.'''
+    if isinstance(value, int):
+        return value.bit_length()
+    return 0
+
+class TwoStackBudget(object):
+    '''The limits of a single run of a program, each of which may be None for no limit.
+
+    max_steps: the number of operators the interpreter may execute
+        (the virtual machine counts its instructions instead)
+    seconds: the wall clock time that the run may take
+    max_depth: the number of elements that the stack and the ztack may hold together
+    max_bits: the size of the largest integer that a multiplication or power may produce
+    interval: the number of steps between two checks of the deadline and the depth
+    checkpoint: a TwoStackCheckpoint that snapshots the run whenever the budget is checked, or None
+
+    The step count is exact, but the deadline is only looked at every interval steps so that
+    the budget costs next to nothing per step. The depth is checked before every step once it is limited.
+    The steps are counted by a StepCounter that only budgeted runs go through, runs without a budget
+    do no extra work at all. The integer size is checked by the multiplication and power operators,
+    the only ones that can grow a value by more than a bit in a single step, and a power that is
+    certain to be too large is never computed. Integer literals are checked as they are pushed,
+    as constant folding turns multiplications and powers of literals into literals of their own.
+    A budget without any limits only drives its checkpoint.
+    '''
+
+    def __init__(self, max_steps=None, seconds=None, max_depth=None, max_bits=None,
+            interval=DEFAULT_INTERVAL, timer=time.monotonic, checkpoint=None):
+        self.max_steps = max_steps
+        self.seconds = seconds
+        self.max_depth = max_depth
+        self.max_bits = max_bits
+        self.interval = max(1, interval)
+        self.timer = timer
+        self.checkpoint = checkpoint
+
+        # the state of the current run
+        self.steps = 0
+        self.pending = 0
+        self.deadline = None
+
+        # the step count and the deadline that the next run continues from
+        self.resumed = 0
+        self.resumed_deadline = None
+
+    def resume(self, steps, deadline=None):
+        '''Lets the next run continue counting from the steps of a snapshot,
+        and keep the deadline of the run it takes over from if one is given.
+        '''
+        self.resumed = steps
+        self.resumed_deadline = deadline
+
+    def deadline_only(self):
+        '''Returns whether the deadline is the only limit, such a budget can also be kept
+        by code that does not count its steps.
+        '''
+        return (self.max_steps is None and self.max_depth is None
+            and self.max_bits is None and self.checkpoint is None)
+
+    def start(self):
+        '''Starts a run, returning the number of steps until the first check.'''
+        self.steps = self.resumed
+        self.deadline = self.resumed_deadline
+        self.resumed = 0
+        self.resumed_deadline = None
+        if self.seconds is not None and self.deadline is None:
+            self.deadline = self.timer() + self.seconds
+        if self.checkpoint is not None:
+            self.checkpoint.start(self.steps)
+        return self.schedule()
+
+    def schedule(self):
+        '''Returns the number of steps until the next check, which falls on the step limit
+        and on the step interval of the checkpoint.
+        '''
+        pending = self.interval
+        if self.max_steps is not None:
+            pending = min(pending, self.max_steps - self.steps)
+        if self.checkpoint is not None and self.checkpoint.next_step is not None:
+            pending = min(pending, self.checkpoint.next_step - self.steps)
+        self.pending = max(0, pending)
+        return self.pending
+
+    def check(self, interpreter):
+        '''Checks the budget before the next step of the interpreter is executed.
+        Returns the number of steps until the next check.
+        Raises a TwoStackBudgetError if any limit has been reached.
+        '''
+        self.steps += self.pending
+
+        if self.max_steps is not None and self.steps >= self.max_steps:
+            raise TwoStackBudgetError('step limit of {} exceeded'.format(self.max_steps), 'steps', self.max_steps)
+
+        if self.expired():
+            raise self.out_of_time()
+
+        if self.too_deep(interpreter):
+            raise self.out_of_depth()
+
+        if self.checkpoint is not None:
+            self.checkpoint.check(interpreter, self.steps)
+
+        return self.schedule()
+
+    def expired(self):
+        '''Returns whether the deadline of the current run has passed.'''
+        return self.deadline is not None and self.timer() > self.deadline
+
+    def out_of_time(self):
+        '''Returns the error raised once the deadline has passed.'''
+        return TwoStackBudgetError('time limit of {} seconds exceeded'.format(self.seconds), 'seconds', self.seconds)
+
+    def too_deep(self, interpreter):
+        '''Returns whether the stacks of the interpreter hold more than max_depth elements together.'''
+        return self.max_depth is not None and len(interpreter.stack) + len(interpreter.ztack) > self.max_depth
+
+    def out_of_depth(self):
+        '''Returns the error raised for stacks that hold more than max_depth elements.'''
+        return TwoStackBudgetError('more than {} elements on the stacks'.format(self.max_depth), 'depth', self.max_depth)
+
+    def too_large(self):
+        '''Returns the error raised for an integer larger than max_bits.'''
+        return TwoStackBudgetError('integer larger than {} bits'.format(self.max_bits), 'bits', self.max_bits)
+
+    def multiply(self, first, second):
+        '''Multiplies two values, raising a TwoStackBudgetError if the product is too large.'''
+        result = first * second
+        if bits(result) > self.max_bits:
+            raise self.too_large()
+        return result
+
+    def power(self, base, exponent):
+        '''Raises the base to the exponent, raising a TwoStackBudgetError if the result is too large.'''
+        # the result has at least this many bits, so the check comes before the work
+        size = bits(base)
+        if size > 1 and isinstance(exponent, int) and (size - 1) * exponent + 1 > self.max_bits:
+            raise self.too_large()
+
+        result = base ** exponent
+        if bits(result) > self.max_bits:
+            raise self.too_large()
+        return result
+
+    def instrument(self, interpreter):
+        '''Starts a run of the interpreter and returns a copy of its command manifest in which
+        every operator counts a step and multiplication and powers are limited to max_bits.
+        The operators check their own elements after counting, so that a step that fails counts as well.
+        '''
+        commands = dict(interpreter.commands)
+        counter = StepCounter(self, interpreter)
+
+        def counted(function, minimum):
+            def step():
+                counter.step()
+                if len(interpreter.stack) < minimum:
+                    raise TwoStackError('not enough elements on the stack')
+                try:
+                    function()
+                except OverflowError:
+                    # the operator is run again, which must not count twice
+                    counter.refund()
+                    raise
+            return step
+
+        if self.max_bits is not None:
+            self.limit_integers(interpreter, commands)
+
+        for key, command in commands.items():
+            commands[key] = dict(command, function=counted(command['function'], command['min']), min=0)
+
+        return commands
+
+    def limit_integers(self, interpreter, commands):
+        '''Replaces multiplication, powers and integer literals in a command manifest with operators limited to max_bits.'''
+        def op_intliteral():
+            value = interpreter.token.value
+            if bits(value) > self.max_bits:
+                raise self.too_large()
+            interpreter.stack.append(value)
+
+        def op_multiply():
+            stack = interpreter.stack
+            stack[-2] = self.multiply(stack[-1], stack[-2])
+            stack.pop()
+
+        def op_power():
+            stack = interpreter.stack
+            stack[-2] = self.power(stack[-2], stack[-1])
+            stack.pop()
+
+        for key, function in (('^[0-9]+', op_intliteral), ('*', op_multiply), ('**', op_power)):
+            commands[key] = dict(commands[key], function=function)
+
+class StepCounter(object):
+    '''Counts the steps of a run against a budget, which is checked whenever the countdown runs out.
+
+    The interpreter counts through the commands of its manifest. The virtual machine looks up the
+    number of elements each instruction requires through the counter, which stands in for the table
+    and counts a step with every lookup. The virtual machine also passes the instructions that would
+    push a literal larger than max_bits, which fail as soon as they are reached.
+
+    When the depth is limited, it is checked before every step, so both engines stop at the step
+    after the one that pushed too much.
+    '''
+
+    def __init__(self, budget, interpreter, required=None, oversized=()):
+        self.budget = budget
+        self.interpreter = interpreter
+        self.required = required
+        self.oversized = frozenset(oversized)
+        self.watch = budget.max_depth is not None or bool(self.oversized)
+        self.countdown = budget.start()
+
+    def inspect(self, pc=None):
+        '''Raises a TwoStackBudgetError before a step if the stacks are too deep
+        or the instruction pushes a literal larger than max_bits.
+        '''
+        budget = self.budget
+        if pc in self.oversized:
+            self.interpreter.index = pc
+            raise budget.too_large()
+        if budget.too_deep(self.interpreter):
+            if pc is not None:
+                self.interpreter.index = pc
+            raise budget.out_of_depth()
+
+    def step(self):
+        '''Counts a step, checking the budget first if it is due.'''
+        if self.countdown == 0:
+            self.countdown = self.budget.check(self.interpreter)
+        self.countdown -= 1
+        if self.watch:
+            self.inspect()
+
+    def refund(self):
+        '''Takes back a step that is about to be run again.'''
+        self.countdown += 1
+
+    def allowance(self, push=False):
+        '''Returns the number of elements that an instruction doing the work of a whole loop
+        may handle in a single step, one step per element. That is at most an interval,
+        so that the deadline is still looked at in time, no more than are left of the step limit
+        and, if the elements are pushed, no more than fit under the depth limit.
+        '''
+        budget = self.budget
+        limit = budget.interval
+        if budget.max_steps is not None:
+            limit = min(limit, budget.max_steps - self.counted())
+        if push and budget.max_depth is not None:
+            limit = min(limit, budget.max_depth - len(self.interpreter.stack) - len(self.interpreter.ztack))
+        return limit
+
+    def counted(self):
+        '''Returns the number of steps counted so far.'''
+        return self.budget.steps + self.budget.pending - self.countdown
+
+    def charge(self, count):
+        '''Counts the elements handled by an instruction that did the work of a whole loop,
+        the budget is checked before the next step.
+        '''
+        budget = self.budget
+        budget.steps = self.counted() + count
+        budget.pending = 0
+        self.countdown = 0
+
+    def __getitem__(self, pc):
+        if self.countdown == 0:
+            self.interpreter.index = pc
+            self.countdown = self.budget.check(self.interpreter)
+        self.countdown -= 1
+        if self.watch:
+            self.inspect(pc)
+        return self.required[pc]
@@ -0,0 +1,248 @@
+'''TwoStackCache
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the cache which keeps the parsed or compiled form of programs on disk,
+so that running the same file again skips lexing, scanning and compiling it.
+'''
+
+import glob
+import hashlib
+import os
+import pickle
+import stat
+import sys
+import tempfile
+
+from twostack_source import source_chunks
+
+# the directory used when TWOSTACK_CACHE is not set
+DEFAULT_DIRECTORY = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'twostack')
+
+# increase this whenever the layout of the cache files changes
+CACHE_FORMAT = 2
+
+# the persistent id that stands in for the source of the program in an entry
+SOURCE_ID = 'source'
+
+# the suffix of every cache file
+SUFFIX = '.cache'
+
+# the number of characters of the interpreter version that begin the name of every cache file
+VERSION_PREFIX = 16
+
+# the total size of the entries after which the least recently used ones are removed
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+def interpreter_version():
+    '''Returns a hash of the source of the interpreter.
+    Any change to the lexer, the compiler and so on invalidates the whole cache,
+    so that an old parsed form can never be run by a newer interpreter.
+    '''
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    for filename in sorted(glob.glob(os.path.join(directory, 'twostack*.py'))):
+        with open(filename, 'rb') as file:
+            digest.update(os.path.basename(filename).encode())
+            digest.update(file.read())
+
+    return digest.hexdigest()
+
+class SourcePickler(pickle.Pickler):
+    '''Pickles a prepared program without the source of the program, which can be very large
+    and is always at hand when the entry is loaded again.
+    '''
+
+    def __init__(self, file, program):
+        pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+        self.program = program
+
+    def persistent_id(self, obj):
+        if obj is self.program and obj is not None:
+            return SOURCE_ID
+        return None
+
+class SourceUnpickler(pickle.Unpickler):
+    '''Unpickles a prepared program, putting the source of the program back into it.'''
+
+    def __init__(self, file, program):
+        pickle.Unpickler.__init__(self, file)
+        self.program = program
+
+    def persistent_load(self, pid):
+        if pid != SOURCE_ID or self.program is None:
+            raise pickle.UnpicklingError('unknown persistent id')
+        return self.program
+
+class TwoStackCache(object):
+    '''A directory of parsed programs keyed by the hash of their source.
+    The key also covers the engine, the interpreter version and the version of Python,
+    an entry that cannot be read for any reason is treated as missing and replaced.
+
+    Entries are unpickled, so the cache is only used if the directory belongs to the current
+    user and nobody else can write to it. Whenever an entry is stored, the entries of other
+    interpreter versions are removed, followed by the least recently used entries until
+    the cache is no larger than max_size bytes.
+    '''
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        if directory is None:
+            directory = os.environ.get('TWOSTACK_CACHE') or DEFAULT_DIRECTORY
+
+        self.directory = directory
+        self.max_size = max_size
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+        # whether the directory is safe to use, looked at once
+        self.safe = None
+
+    def usable(self):
+        '''Creates the directory if it is missing and returns whether it is safe to use.
+        The directory must be a real directory owned by the current user that neither
+        the group nor anyone else can write to.
+        '''
+        if self.safe is not None:
+            return self.safe
+
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            info = os.lstat(self.directory)
+        except OSError:
+            self.safe = False
+            return False
+
+        getuid = getattr(os, 'getuid', None)
+        self.safe = (stat.S_ISDIR(info.st_mode)
+            and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+            and (getuid is None or info.st_uid == getuid()))
+        return self.safe
+
+    def key(self, program, engine):
+        '''Returns the key of a program prepared by the engine.'''
+        if self.version is None:
+            self.version = interpreter_version()
+
+        digest = hashlib.sha256()
+        for part in (str(CACHE_FORMAT), sys.implementation.cache_tag or '', self.version, type(engine).__name__):
+            digest.update(part.encode())
+            digest.update(b'\0')
+        for text in source_chunks(program):
+            digest.update(text.encode('utf-8', 'surrogatepass'))
+        return '{}-{}'.format(self.version[:VERSION_PREFIX], digest.hexdigest())
+
+    def path(self, key):
+        '''Returns the filename of an entry.'''
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def load(self, key, program=None):
+        '''Returns the prepared program stored under the key, or None if there is none.
+        The source that was left out of the entry is replaced by the program.
+        '''
+        if not self.usable():
+            return None
+
+        try:
+            with open(self.path(key), 'rb') as file:
+                stored_key, prepared = SourceUnpickler(file, program).load()
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # a damaged entry is dropped so that it is written again
+            self.remove(key)
+            return None
+
+        if stored_key != key:
+            return None
+
+        # the modification time tells which entries were used least recently
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            pass
+
+        return prepared
+
+    def store(self, key, prepared, program=None):
+        '''Stores a prepared program under the key, leaving out the program source it refers to.
+        The entry is written to a temporary file first and then renamed, so that another
+        process can never read half an entry. A cache that cannot be written is ignored.
+        '''
+        if not self.usable():
+            return
+
+        try:
+            handle, temporary = tempfile.mkstemp(dir=self.directory, prefix='.', suffix='.tmp')
+        except OSError:
+            return
+
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                SourcePickler(file, program).dump((key, prepared))
+            os.replace(temporary, self.path(key))
+        except Exception:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+            return
+
+        self.prune()
+
+    def prune(self):
+        '''Removes the entries of other interpreter versions, then the least recently used
+        entries until the rest fit into the maximum size.
+        '''
+        prefix = self.version[:VERSION_PREFIX] + '-' if self.version is not None else None
+        entries = []
+        for filename in glob.glob(os.path.join(self.directory, '*' + SUFFIX)):
+            try:
+                if prefix is not None and not os.path.basename(filename).startswith(prefix):
+                    os.remove(filename)
+                    continue
+                info = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, filename))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+
+    def remove(self, key):
+        '''Removes an entry if it exists.'''
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        '''Removes every entry.'''
+        for filename in glob.glob(os.path.join(self.directory, '*' + SUFFIX)):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def fetch(self, program, engine):
+        '''Returns the program prepared by the engine, preparing and storing it if it is not cached.
+        Raises a TwoStackSyntaxError if the program is malformed, these are never cached.
+        '''
+        key = self.key(program, engine)
+
+        prepared = self.load(key, program)
+        if prepared is not None:
+            self.hits += 1
+            return prepared
+
+        self.misses += 1
+        prepared = engine.prepare(program)
+        self.store(key, prepared, program)
+        return prepared
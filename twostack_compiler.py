@@ -0,0 +1,268 @@
+'''TwoStackCompiler
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the compiler which lowers a TwoStack program into a flat bytecode array.
+The bytecode is executed by TwoStackVirtualMachine.
+'''
+
+from array import array
+
+from twostack_analysis import analyse, block_effect
+from twostack_feature_provider import MINIMUM
+from twostack_lexer import lex, ALIAS_DEF, ALIAS_RECALL, INTEGER, STRING, DEBUG, UNKNOWN
+from twostack_parser import strip_tokens, resolve_aliases, fold_constants
+from twostack_stack import new_stack
+
+# ===== Opcodes ===== #
+# the opcodes are numbered roughly in order of how often they are executed
+# so that the dispatch loop in the virtual machine tests the common ones first
+OP_INT = 0
+OP_ALIAS = 1
+OP_STACKSWAP = 2
+OP_DUPLICATE = 3
+OP_DISCARD = 4
+OP_LOOPBEGIN = 5
+OP_LOOPEND = 6
+OP_CROSSPOP = 7
+OP_OUTPUT = 8
+OP_ADD = 9
+OP_SUBTRACT = 10
+OP_MODULO = 11
+OP_DIVIDE = 12
+OP_EQUAL = 13
+OP_SWAP = 14
+OP_EXECBLOCK = 15
+OP_CONDJUMP = 16
+OP_BLOCKBEGIN = 17
+OP_BLOCKEND = 18
+OP_STRING = 19
+OP_MULTIPLY = 20
+OP_LESSTHAN = 21
+OP_GREATERTHAN = 22
+OP_NOT = 23
+OP_AND = 24
+OP_OR = 25
+OP_XOR = 26
+OP_3SWAP = 27
+OP_POWER = 28
+OP_INPUT = 29
+OP_ALIASDEF = 30
+OP_DEBUG = 31
+
+# ===== Superinstructions ===== #
+# each of these replaces a common idiom, they are placed directly in front of
+# the instructions of the idiom which only run if a guard of the superinstruction fails
+OP_JUMP = 32
+OP_CROSSALL = 33
+OP_PRINTALL = 34
+OP_MODADD = 35
+OP_SUMLOOP = 36
+OP_PRODUCTLOOP = 37
+OP_RANGELOOP = 38
+
+OP_UNKNOWN = 39
+
+# maps the keys of the command manifest onto opcodes
+OPCODES = {
+    INTEGER: OP_INT,
+    ALIAS_RECALL: OP_ALIAS,
+    '$': OP_STACKSWAP,
+    ':': OP_DUPLICATE,
+    ';': OP_DISCARD,
+    '[': OP_LOOPBEGIN,
+    ']': OP_LOOPEND,
+    '`': OP_CROSSPOP,
+    '.': OP_OUTPUT,
+    '+': OP_ADD,
+    '-': OP_SUBTRACT,
+    '%': OP_MODULO,
+    '/': OP_DIVIDE,
+    '=': OP_EQUAL,
+    '\\': OP_SWAP,
+    '@': OP_EXECBLOCK,
+    '?': OP_CONDJUMP,
+    '{': OP_BLOCKBEGIN,
+    '}': OP_BLOCKEND,
+    STRING: OP_STRING,
+    '*': OP_MULTIPLY,
+    '<': OP_LESSTHAN,
+    '>': OP_GREATERTHAN,
+    '!': OP_NOT,
+    '&': OP_AND,
+    '|': OP_OR,
+    '^': OP_XOR,
+    '\\\\': OP_3SWAP,
+    '**': OP_POWER,
+    ',': OP_INPUT,
+    ALIAS_DEF: OP_ALIASDEF,
+    DEBUG: OP_DEBUG,
+    UNKNOWN: OP_UNKNOWN
+}
+
+# the minimum number of stack elements required by each opcode
+ARITY = [0] * (OP_UNKNOWN + 1)
+for key, minimum in MINIMUM.items():
+    if key in OPCODES:
+        ARITY[OPCODES[key]] = minimum
+ARITY = tuple(ARITY)
+
+# loops with one of these bodies are run by a single superinstruction
+LOOP_IDIOMS = (
+    (('`',), OP_CROSSALL),
+    (('.', ';'), OP_PRINTALL),
+    (('\\', '+', '\\'), OP_SUMLOOP),
+    (('\\', '*', '\\'), OP_PRODUCTLOOP),
+    ((':', INTEGER, '-'), OP_RANGELOOP)
+)
+
+# pure blocks with at most this many tokens are not memoized
+PURE_MIN_LENGTH = 4
+
+class Bytecode(object):
+    '''A program that has been compiled for the virtual machine.
+
+    code: the opcode of each instruction
+    args: the operand of each instruction, this is an index into the pool for literals,
+        the slot of an alias or the index of the matching instruction for brackets,
+        superinstructions hold the index of the instruction after their idiom or a pool index
+    pool: the constants referred to by the instructions
+    aliases: the name of each alias slot
+    offsets: the source offset of each instruction, used for errors and jumps
+    arity: the number of elements each instruction needs on the stack
+    required: the number of elements that have to be checked for before each instruction,
+        0 where the analysis proved that they are always there
+    diagnostics: the source offset and message of every operator that can never find its elements
+    pure: the number of elements consumed by every pure block, keyed by the index of its {
+    '''
+
+    def __init__(self, program):
+        self.program = program
+        self.code = array('i')
+        self.args = array('i')
+        self.pool = []
+        self.offsets = array('i')
+        self.aliases = []
+        # these are lists as they are indexed for every instruction that is executed
+        self.arity = []
+        self.required = []
+        self.diagnostics = []
+        self.pure = {}
+
+    def __len__(self):
+        return len(self.code)
+
+    def emit(self, opcode, arg, offset, safe=False):
+        '''Appends an instruction, returning its index.
+        The elements that the instruction needs are only checked for if it is not known to be safe.
+        '''
+        self.code.append(opcode)
+        self.args.append(arg)
+        self.offsets.append(offset)
+        self.arity.append(ARITY[opcode])
+        self.required.append(0 if safe else ARITY[opcode])
+        return len(self.code) - 1
+
+    def constant(self, value):
+        '''Adds a value to the constant pool, returning its index.'''
+        self.pool.append(value)
+        return len(self.pool) - 1
+
+def find_idiom(tokens, jumps, index):
+    '''Checks whether one of the idioms with a superinstruction begins at the token index.
+    Returns the superinstruction, the index of the token after the idiom
+    and the constants of the superinstruction, or None if there is no idiom.
+    '''
+    token = tokens[index]
+
+    if token.key == '[':
+        end = jumps[index]
+        body = tuple(other.key for other in tokens[index + 1:end])
+        for keys, opcode in LOOP_IDIOMS:
+            # [:1-] is the only range that counts down in steps of one
+            if body == keys and (opcode != OP_RANGELOOP or tokens[index + 2].value == 1):
+                return opcode, end + 1, None
+
+    elif token.key == INTEGER and index + 1 < len(tokens):
+        keys = tuple(other.key for other in tokens[index + 1:index + 4])
+
+        # a comment 0[ ... ]; never does anything, most are already stripped
+        # but those that cut through a block have to stay
+        if token.value == 0 and keys[0] == '[':
+            end = jumps[index + 1]
+            if end + 1 < len(tokens) and tokens[end + 1].key == ';':
+                return OP_JUMP, end + 2, None
+
+        # 10%48+ converts the least significant digit to ascii
+        # a modulo by zero is left alone so that it still fails
+        elif token.value != 0 and keys == ('%', INTEGER, '+'):
+            return OP_MODADD, index + 4, (token.value, tokens[index + 2].value)
+
+    return None
+
+def compile_program(program):
+    '''Compiles a program into bytecode.
+    Raises a TwoStackSyntaxError if the brackets of the program are unbalanced.
+    '''
+    bytecode = Bytecode(program)
+    constants = {}
+
+    # every remaining token becomes one instruction, some are preceded by a superinstruction
+    tokens, jumps = fold_constants(*strip_tokens(lex(program)))
+    bytecode.aliases, tokens = resolve_aliases(tokens)
+
+    analysis = analyse(tokens, jumps)
+    bytecode.diagnostics = analysis.diagnostics
+
+    # lay the instructions out first so that jumps can be translated into instruction indexes
+    layout = []
+    positions = []
+    for index in range(len(tokens)):
+        idiom = find_idiom(tokens, jumps, index)
+        if idiom is not None:
+            layout.append((idiom, index))
+        positions.append(len(layout))
+        layout.append((None, index))
+    positions.append(len(layout))
+
+    for idiom, index in layout:
+        token = tokens[index]
+
+        if idiom is not None:
+            opcode, end, values = idiom
+            if values is None:
+                # continue after the instructions of the idiom
+                arg = positions[end]
+            else:
+                arg = bytecode.constant(values)
+            bytecode.emit(opcode, arg, token.offset)
+            continue
+
+        opcode = OPCODES[token.key]
+        arg = 0
+
+        if jumps[index] >= 0:
+            arg = positions[jumps[index]]
+
+        elif opcode in (OP_ALIAS, OP_ALIASDEF):
+            arg = token.value
+
+        elif opcode in (OP_INT, OP_STRING, OP_UNKNOWN):
+            # share a single pool entry between identical literals
+            constant_key = (opcode, token.value)
+            if constant_key not in constants:
+                value = token.value
+                if opcode == OP_STRING:
+                    # strings are pushed in bulk straight from the pool
+                    value = new_stack(value)
+                constants[constant_key] = bytecode.constant(value)
+            arg = constants[constant_key]
+
+        position = bytecode.emit(opcode, arg, token.offset, analysis.safe[index])
+
+        # blocks that are too short are quicker to run again than to look up
+        if opcode == OP_BLOCKBEGIN and jumps[index] - index - 1 > PURE_MIN_LENGTH:
+            consumed = block_effect(tokens, jumps, index)
+            if consumed is not None:
+                bytecode.pure[position] = consumed
+
+    return bytecode
@@ -0,0 +1,35 @@
+'''TwoStackErrors
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the exceptions raised while preparing or running a TwoStack program.
+'''
+
+class TwoStackError(Exception):
+    '''The base class of all TwoStack errors.
+    The offset is the position in the source that the error should be reported at.
+    '''
+
+    def __init__(self, message, offset=None):
+        Exception.__init__(self, message)
+        self.message = message
+        self.offset = offset
+
+class TwoStackSyntaxError(TwoStackError):
+    '''Raised when a program is malformed and cannot be run.'''
+
+class TwoStackDepthError(TwoStackError):
+    '''Raised when a stack grows beyond its maximum depth.'''
+
+class TwoStackBudgetError(TwoStackError):
+    '''Raised when a run exceeds one of the limits of its budget.
+    The budget is the name of the limit (steps, seconds, depth or bits) and the limit is its value.
+    These are not handled by the interpreter itself, they end the run and propagate to the caller.
+    '''
+
+    def __init__(self, message, budget, limit, offset=None):
+        TwoStackError.__init__(self, message, offset)
+        self.budget = budget
+        self.limit = limit
+
+class TwoStackSnapshotError(TwoStackError):
+    '''Raised when a snapshot cannot be read or does not belong to the program it is resumed with.'''
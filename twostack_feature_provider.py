@@ -4,8 +4,52 @@ Author: Jesse Sheehan <jesse@sheehan.nz>
 Contains the TwoStackFeatureProvider which defines most of the operators in the language.
 '''
 
-import sys
-import os
+from bisect import bisect_left
+
+from twostack_cache import TwoStackCache
+from twostack_errors import TwoStackDepthError
+from twostack_io import TwoStackInput, TwoStackOutput
+from twostack_memo import TwoStackMemo
+from twostack_program import ExecutionState
+from twostack_stack import DEFAULT_MAX_DEPTH, is_compact, promote
+
+# the minimum number of stack elements required by each operator,
+# the command manifest, the analysis, the compiler and the transpiler all take it from here
+MINIMUM = {
+    '+': 2,
+    '-': 2,
+    '*': 2,
+    '/': 2,
+    '%': 2,
+    '**': 2,
+    ';': 1,
+    ':': 1,
+    '\\': 2,
+    '\\\\': 3,
+    '`': 1,
+    '$': 0,
+    '!': 1,
+    '=': 2,
+    '<': 2,
+    '>': 2,
+    '&': 2,
+    '|': 2,
+    '^': 2,
+    '?': 2,
+    '@': 0,
+    '{': 0,
+    '}': 0,
+    '[': 0,
+    ']': 0,
+    '.': 1,
+    ',': 0,
+    '~': 1,
+    '"': 0,
+    '\n': 0,
+    ' ': 0,
+    '^[a-zA-Z]+': 0,
+    '^[0-9]+': 0
+}
 
 class TwoStackFeatureProvider(object):
     '''Implements the core language functionailty.'''
@@ -14,14 +58,85 @@ class TwoStackFeatureProvider(object):
         '''Raises an interpreter error.'''
         raise NotImplementedError('TwoStackFeatureProvider.error is not implemented')
 
-    def __init__(self):
+    def locate(self, offset):
+        '''Returns the index of the first token after the source offset.
+        Jumping to the offset of a { therefore lands on the first token of the block.
+        An offset inside a token that spans several characters, such as an integer,
+        lands on the next token rather than on the rest of the token.
+        '''
+        return bisect_left(self.offsets, offset + 1)
+
+    def load_state(self, state):
+        '''Continues from an ExecutionState, which is used in place rather than copied.'''
+        self.stack = state.stack
+        self.ztack = state.ztack
+        self.aliases = state.aliases
+        self.store = state.store
+        self.callstack = state.callstack
+        self.index = state.index
+
+    def save_state(self, state=None):
+        '''Stores the current state in an ExecutionState, a new one unless one is given, and returns it.'''
+        if state is None:
+            state = ExecutionState()
+        state.stack = self.stack
+        state.ztack = self.ztack
+        state.aliases = self.aliases
+        state.store = self.store
+        state.callstack = self.callstack
+        state.index = self.index
+        return state
+
+    def promote_stacks(self):
+        '''Switches both stacks over to Python integers once a value does not fit into a machine integer.
+        Returns False if the stacks were already holding Python integers.
+        '''
+        if not is_compact(self.stack) and not is_compact(self.ztack):
+            return False
+
+        self.stack = promote(self.stack)
+        self.ztack = promote(self.ztack)
+        return True
+
+    def check_depth(self):
+        '''Raises a TwoStackDepthError if a stack has grown beyond the maximum depth.
+        This is checked whenever control jumps backwards, as a stack can only grow
+        without bound through a loop or a block that is run again and again.
+        '''
+        max_depth = self.max_depth
+        if len(self.stack) > max_depth or len(self.ztack) > max_depth:
+            raise TwoStackDepthError('too many elements on the stack')
+        if len(self.callstack) > max_depth:
+            raise TwoStackDepthError('too many nested blocks')
+
+    def __init__(self, output=None, input=None, max_depth=DEFAULT_MAX_DEPTH):
+        '''Creates the provider.
+        The output can be any binary sink or a configured TwoStackOutput,
+        by default the output is written to stdout.
+        The input can be a stream, bytes, a string or a configured TwoStackInput,
+        by default the input is read from stdin.
+        The max depth is the number of elements that a single stack may hold.
+        '''
+        if not isinstance(output, TwoStackOutput):
+            output = TwoStackOutput(output)
+
+        if not isinstance(input, TwoStackInput):
+            input = TwoStackInput(input)
+
+        self.output = output
+        self.input = input
+        self.max_depth = max_depth
+        self.profiler = None
+        self.budget = None
+        self.jit = None
+        self.cache = TwoStackCache()
+        self.memo = TwoStackMemo()
         self.program = ''
-        self.loop = {}
-        self.index = 0
-        self.stack = []
-        self.ztack = []
-        self.store = {}
-        self.callstack = []
+        self.tokens = []
+        self.offsets = []
+        self.token = None
+        self.jumps = []
+        self.load_state(ExecutionState())
 
         # the command manifest contains some basic data about each operator
         # such as the minimum number of elements on the stack, etc
@@ -30,101 +145,101 @@ class TwoStackFeatureProvider(object):
             # ===== Mathematical Operators ===== #
             '+': {
                 'name': 'add',
-                'min': 2,
+                'min': MINIMUM['+'],
                 'function': self.op_add
             },
             '-': {
                 'name': 'subtract',
-                'min': 2,
+                'min': MINIMUM['-'],
                 'function': self.op_subtract
             },
             '*': {
                 'name': 'multiply',
-                'min': 2,
+                'min': MINIMUM['*'],
                 'function': self.op_multiply
             },
             '/': {
                 'name': 'divide',
-                'min': 2,
+                'min': MINIMUM['/'],
                 'function': self.op_divide
             },
             '%': {
                 'name': 'modulo',
-                'min': 2,
+                'min': MINIMUM['%'],
                 'function': self.op_modulo
             },
             '**': {
                 'name': 'power',
-                'min': 2,
+                'min': MINIMUM['**'],
                 'function': self.op_power
             },
 
             # ===== Stack Operators ===== #
             ';': {
                 'name': 'discard',
-                'min': 1,
+                'min': MINIMUM[';'],
                 'function': self.op_discard
             },
             ':': {
                 'name': 'duplicate',
-                'min': 1,
+                'min': MINIMUM[':'],
                 'function': self.op_duplicate
             },
             '\\': {
                 'name': 'swap',
-                'min': 2,
+                'min': MINIMUM['\\'],
                 'function': self.op_swap
             },
             '\\\\': {
                 'name': '3-swap',
-                'min': 3,
+                'min': MINIMUM['\\\\'],
                 'function': self.op_3swap
             },
             '`': {
                 'name': 'crosspop',
-                'min': 1,
+                'min': MINIMUM['`'],
                 'function': self.op_crosspop
             },
             '$': {
                 'name': 'stackswap',
-                'min': 0,
+                'min': MINIMUM['$'],
                 'function': self.op_stackswap
             },
 
             # ===== Boolean/Conditional Operators ===== #
             '!': {
                 'name': 'not',
-                'min': 1,
+                'min': MINIMUM['!'],
                 'function': self.op_not
             },
             '=': {
                 'name': 'equal to',
-                'min': 2,
+                'min': MINIMUM['='],
                 'function': self.op_condequal
             },
             '<': {
                 'name': 'less than',
-                'min': 2,
+                'min': MINIMUM['<'],
                 'function': self.op_condlessthan
             },
             '>': {
                 'name': 'greater than',
-                'min': 2,
+                'min': MINIMUM['>'],
                 'function': self.op_condgreaterthan
             },
             '&': {
                 'name': 'logical and',
-                'min': 2,
+                'min': MINIMUM['&'],
                 'function': self.op_logicaland
             },
             '|': {
                 'name': 'logical or',
-                'min': 2,
+                'min': MINIMUM['|'],
                 'function': self.op_logicalor
             },
             '^': {
                 'name': 'logical xor',
-                'min': 2,
+                'min': MINIMUM['^'],
                 'function': self.op_logicalxor
             },
 
@@ -132,138 +247,138 @@ class TwoStackFeatureProvider(object):
 
             '?': {
                 'name': 'cond jump',
-                'min': 2,
+                'min': MINIMUM['?'],
                 'function': self.op_condjump
             },
             '@': {
                 'name': 'exec block',
-                'min': 0,
+                'min': MINIMUM['@'],
                 'function': self.op_execblock
             },
 
             # ===== Blocks ===== #
             '{': {
                 'name': 'block begin',
-                'min': 0,
+                'min': MINIMUM['{'],
                 'function': self.op_blockbegin
             },
             '}': {
                 'name': 'block end',
-                'min': 0,
+                'min': MINIMUM['}'],
                 'function': self.op_blockend
             },
             '[': {
                 'name': 'loop begin',
-                'min': 0,
+                'min': MINIMUM['['],
                 'function': self.op_loopbegin
             },
             ']': {
                 'name': 'loop end',
-                'min': 0,
+                'min': MINIMUM[']'],
                 'function': self.op_loopend
             },
 
             # ===== Input/Output ===== #
             '.': {
                 'name': 'output',
-                'min': 1,
+                'min': MINIMUM['.'],
                 'function': self.op_output
             },
             ',': {
                 'name': 'input',
-                'min': 0,
+                'min': MINIMUM[','],
                 'function': self.op_input
             },
 
             # ===== Miscellaneous ===== #
             '~': {
                 'name': 'alias def',
-                'min': 1,
+                'min': MINIMUM['~'],
                 'function': self.op_aliasdef
             },
             '"': {
                 'name': 'string literal',
-                'min': 0,
+                'min': MINIMUM['"'],
                 'function': self.op_stringliteral
             },
             '\n': {
                 'name': 'newline',
-                'min': 0,
+                'min': MINIMUM['\n'],
                 'function': self.op_newline
             },
             ' ': {
                 'name': 'whitespace',
-                'min': 0,
+                'min': MINIMUM[' '],
                 'function': self.op_whitespace
             },
             '^[a-zA-Z]+': {
                 'name': 'alias recall',
-                'min': 0,
-                'function': self.op_aliasrecall,
-                'is_regex': True
+                'min': MINIMUM['^[a-zA-Z]+'],
+                'function': self.op_aliasrecall
             },
             '^[0-9]+': {
                 'name': 'integer literal',
-                'min': 0,
-                'function': self.op_intliteral,
-                'is_regex': True
+                'min': MINIMUM['^[0-9]+'],
+                'function': self.op_intliteral
             }
         }
 
     # ===== Mathematical Operators ===== #
+    # the result replaces the second element before the first is popped, so if it
+    # does not fit on a compact stack the operator can be run again once promoted
     def op_add(self):
         '''The add operator.
         Pop the two topmost elements and add them.
         Pushing the result.
         '''
-        elem1 = self.stack.pop()
-        elem2 = self.stack.pop()
-        self.stack.append(elem1 + elem2)
+        stack = self.stack
+        stack[-2] = stack[-1] + stack[-2]
+        stack.pop()
 
     def op_subtract(self):
         '''The subtract operator.
         Pop two elements and subtract the first from the second.
         Push the result.
         '''
-        elem1 = self.stack.pop()
-        elem2 = self.stack.pop()
-        self.stack.append(elem2 - elem1)
+        stack = self.stack
+        stack[-2] = stack[-2] - stack[-1]
+        stack.pop()
 
     def op_multiply(self):
         '''The multiply operator.
         Pop two elements and multiply them.
         Push the result.
         '''
-        elem1 = self.stack.pop()
-        elem2 = self.stack.pop()
-        self.stack.append(elem1 * elem2)
+        stack = self.stack
+        stack[-2] = stack[-1] * stack[-2]
+        stack.pop()
 
     def op_divide(self):
         '''The division operator.
         Pops two elements and divides the second by the first.
         Pushes the quotient.
         '''
-        elem1 = self.stack.pop()
-        elem2 = self.stack.pop()
-        self.stack.append(elem2 // elem1)
+        stack = self.stack
+        stack[-2] = stack[-2] // stack[-1]
+        stack.pop()
 
     def op_modulo(self):
         '''The modulus operator.
         Pops two elements and divides the second by the first.
         Pushes the remainder.
         '''
-        elem1 = self.stack.pop()
-        elem2 = self.stack.pop()
-        self.stack.append(elem2 % elem1)
+        stack = self.stack
+        stack[-2] = stack[-2] % stack[-1]
+        stack.pop()
 
     def op_power(self):
         '''The power operator.
         Pops two elements and the second to the first power.
         Pushes the result.
         '''
-        elem1 = self.stack.pop()
-        elem2 = self.stack.pop()
-        self.stack.append(elem2 ** elem1)
+        stack = self.stack
+        stack[-2] = stack[-2] ** stack[-1]
+        stack.pop()
 
     # ===== Stack Operators ===== #
     def op_discard(self):
@@ -297,7 +412,6 @@ class TwoStackFeatureProvider(object):
         self.stack.append(elem1)
         self.stack.append(elem2)
         self.stack.append(elem3)
-        return 1
 
     def op_stackswap(self):
         '''The stackswap operator.
@@ -386,32 +500,21 @@ class TwoStackFeatureProvider(object):
     def op_execblock(self):
         '''Jump to an arbitrary location.
         Store the current location on the callstack.
-        Pop the top element from the stack and use that as the index.
+        Pop the top element from the stack and use that as the source offset to jump to.
         '''
         self.callstack.append(self.index)
-        self.index = self.stack.pop()
+        self.check_depth()
+        self.index = self.locate(self.stack.pop()) - 1
 
     # ===== Blocks ===== #
 
     def op_blockbegin(self):
         '''Signal the beginning of a code block.
-        Push the index to the stack.
-        Advance the index to the end of the block.
+        Push the source offset of the block to the stack.
+        Jump to the matching } stored in the jump table.
         '''
-        # find the index of the matching }
-        rest = self.program[self.index:]
-        depth = 1
-        offset = 1
-        while offset < len(rest) and depth > 0:
-            if rest[offset] == '}':
-                depth -= 1
-            elif rest[offset] == '{':
-                depth += 1
-            offset += 1
-
-        self.stack.append(self.index)
-
-        return offset - 1
+        self.stack.append(self.token.offset)
+        self.index = self.jumps[self.index]
 
     def op_blockend(self):
         '''Signals the end of a code block.
@@ -421,42 +524,18 @@ class TwoStackFeatureProvider(object):
 
     def op_loopbegin(self):
         '''Signals the beginning of a loop.
-        Checks if the loop is cached in self.loop, if not, find the matching ] and cache it.
         Peek the stack and checks if the value is equal to 0, if so,
-        jump to the matching ], otherwise continue the loop.
+        jump to the matching ] stored in the jump table, otherwise continue the loop.
         '''
-
-        # check if the loop does not exist in the cache
-        if self.index not in self.loop.keys():
-            rest = self.program[self.index:]
-
-            depth = 1
-            offset = 1
-            while offset < len(rest) and depth > 0:
-
-                if rest[offset] == ']':
-                    depth -= 1
-
-                elif rest[offset] == '[':
-                    depth += 1
-
-                offset += 1
-
-            offset -= 1
-
-            # set cache entries for the start and end of the loop
-            self.loop[self.index] = self.index + offset
-            self.loop[offset + self.index] = self.index
-
-        # check the loop condition
-        if not self.stack or (self.stack and self.stack[-1] == 0):
-            self.index = self.loop[self.index]
+        if not self.stack or self.stack[-1] == 0:
+            self.index = self.jumps[self.index]
 
     def op_loopend(self):
         '''Signals the end of the loop.
-        Jump to the matching [ stored in the cache.
+        Jump to the matching [ stored in the jump table.
         '''
-        self.index = self.loop[self.index] - 1
+        self.check_depth()
+        self.index = self.jumps[self.index] - 1
 
     # ===== Input/Output ===== #
 
@@ -464,34 +543,18 @@ class TwoStackFeatureProvider(object):
         '''The input operator.
         Pushes the ordinal value of the next character in the stream or -1 if the stream is empty.
         '''
-        try:
-            char = sys.stdin.read(1)
+        # make sure that an interactive user can see any prompt before typing
+        if self.output.line_buffered:
+            self.output.flush()
 
-        except KeyboardInterrupt:
-            char = ''
-
-        if char:
-            self.stack.append(ord(char))
-        else:
-            self.stack.append(-1)
+        self.stack.append(self.input.read())
 
     def op_output(self):
         '''The output operator.
         Prints the top element of the stack as an ascii character.
         This is peeked, not popped.
         '''
-        try:
-            char = chr(self.stack[-1])
-
-        except ValueError:
-            # handle out of range character values
-            char = ''
-
-        sys.stdout.write(char)
-
-        # flush if char is a newline character
-        if char in os.linesep:
-            sys.stdout.flush()
+        self.output.write(self.stack[-1])
 
     # ===== Miscellaneous ===== #
 
@@ -500,77 +563,40 @@ class TwoStackFeatureProvider(object):
         Push the alias value to the stack.
         If the alias does not exist, throw an error.
         '''
-        rest = self.program[self.index:]
-
-        # find the full alias name
-        last_char_index = 0
-        while last_char_index < len(rest) and rest[last_char_index].isalpha():
-            last_char_index += 1
+        value = self.store[self.token.value]
 
-        if last_char_index == 0:
-            self.error('alias cannot be empty')
-            return last_char_index
-
-        alias = rest[0:last_char_index]
-
-        # recall the alias name if possible
-        if alias in self.store.keys():
-            self.stack.append(self.store[alias])
+        # recall the alias if it has been defined
+        if value is not None:
+            self.stack.append(value)
         else:
             self.error('alias does not exist')
 
-        return last_char_index - 1
-
     def op_aliasdef(self):
         '''Alias definition operator.
         An alias represents an integer that can be recalled later.
         Pops the top element of the stack and assigns it to the alias.
         '''
-        rest = self.program[self.index:]
+        slot = self.token.value
 
-        last_char_index = 1
-        while last_char_index < len(rest) and rest[last_char_index].isalpha():
-            last_char_index += 1
-
-        if last_char_index == 1:
+        if slot < 0:
             self.error('alias definition cannot be empty')
-            return last_char_index
+            return
 
-        alias = rest[1:last_char_index]
         value = self.stack.pop()
 
-        self.store[alias] = value
-
-        return last_char_index - 1
+        self.store[slot] = value
 
     def op_stringliteral(self):
         '''Pushes a string to the stack character by character.
         If the string "hello" is pushed to the stack,
         the top element of the stack will be the integer representation of "o".
+        The characters were already converted into integers when the program was prepared.
         '''
-        rest = self.program[self.index:]
-
-        string_length = 1
-        while string_length < len(rest) and rest[string_length] != '"':
-            char_value = ord(rest[string_length])
-            self.stack.append(char_value)
-
-            string_length += 1
-
-        return string_length
+        self.stack.extend(self.token.value)
 
     def op_intliteral(self):
         '''Pushes an integer literal to the stack.'''
-        rest = self.program[self.index:]
-
-        string_length = 1
-        while string_length < len(rest) and rest[string_length].isdigit():
-            string_length += 1
-
-        int_value = int(rest[:string_length])
-        self.stack.append(int_value)
-
-        return string_length - 1
+        self.stack.append(self.token.value)
 
     def op_newline(self):
         '''A stub for newline handling.'''
@@ -579,4 +605,3 @@ class TwoStackFeatureProvider(object):
     def op_whitespace(self):
         '''A stub for space handling.'''
         pass
-    
\ No newline at end of file
@@ -5,9 +5,15 @@ TODO: Show command line arguments, etc...
 '''
 
 import sys
-import re
 
+from twostack_analysis import analyse
 from twostack_feature_provider import TwoStackFeatureProvider
+from twostack_lexer import lex, DEBUG
+from twostack_parser import strip_tokens, resolve_aliases, fold_constants
+from twostack_errors import TwoStackError, TwoStackSyntaxError, TwoStackBudgetError, TwoStackSnapshotError
+from twostack_profiler import TwoStackProfiler
+from twostack_program import Program, ExecutionState
+from twostack_source import load_source
 
 class TwoStackInterpreter(TwoStackFeatureProvider):
     '''The formal interpreter for TwoStack.'''
@@ -15,15 +21,15 @@ class TwoStackInterpreter(TwoStackFeatureProvider):
     def reset(self):
         '''Resets the interpreter state.'''
         self.program = ''
-        self.loop = {}
-        self.index = 0
-        self.stack = []
-        self.ztack = []
-        self.store = {}
-        self.callstack = []
+        self.tokens = []
+        self.offsets = []
+        self.token = None
+        self.jumps = []
+        self.load_state(ExecutionState())
 
     def debug(self):
         '''Presents the debug menu to the user.'''
+        self.output.flush()
         prompt = 'Debug: ((c)ontinue, (s)tack, (z)tack, (a)liases, (q)uit) > '
         while True:
             char = input(prompt)
@@ -42,103 +48,270 @@ class TwoStackInterpreter(TwoStackFeatureProvider):
 
     def print_stack(self):
         '''Prints the stack to the terminal.'''
+        self.output.flush()
         print('Stack: ')
         for i in range(len(self.stack)):
             print('  {}: {}'.format(i, self.stack[i]))
 
     def print_ztack(self):
         '''Prints the ztack to the terminal.'''
+        self.output.flush()
         print('Ztack: ')
         for i in range(len(self.ztack)):
             print('  {}: {}'.format(i, self.ztack[i]))
 
     def print_aliases(self):
         '''Print the aliases to the terminal.'''
+        self.output.flush()
         print('Aliases: ')
-        for alias, value in self.store.items():
-            print('  {}: {}'.format(alias, value))
+        for alias, value in zip(self.aliases, self.store):
+            if value is not None:
+                print('  {}: {}'.format(alias, value))
 
-    def error(self, message):
-        '''Prints detailed error information to the terminal.'''
+    def enable_profiling(self, profiler=None):
+        '''Turns on the profiling mode, every operator executed from now on is counted and timed.
+        Returns the profiler that collects the measurements.
+        '''
+        if profiler is None:
+            profiler = TwoStackProfiler()
+        self.profiler = profiler
+        return profiler
+
+    def print_profile(self, file=None):
+        '''Prints the report of the profiler, by default to the terminal.'''
+        self.output.flush()
+        if self.profiler is not None:
+            self.profiler.report(self.program, file)
+
+    def set_jit(self, jit):
+        '''Traces the hot loops and blocks of every run from now on with a TwoStackJit, None turns tracing off.
+        Tracing is left out while profiling or running with a budget.
+        '''
+        self.jit = jit
+
+    def print_jit(self, file=None):
+        '''Prints the statistics of the tracer, by default to the terminal.'''
+        self.output.flush()
+        if self.jit is not None:
+            self.jit.report(self.program, file)
+
+    def set_memo(self, memo):
+        '''Remembers the results of pure blocks in a TwoStackMemo from now on, None turns memoization off.
+        Only the virtual machine memoizes blocks, and not under a budget that limits anything but time.
+        '''
+        self.memo = memo
+
+    def set_budget(self, budget):
+        '''Limits every run from now on to the budget, None removes the limits.
+        A run that exceeds its budget raises a TwoStackBudgetError out of execute.
+        '''
+        self.budget = budget
+
+    def bind_aliases(self, aliases):
+        '''Lays the alias store out for the slots of a program.
+        The values of aliases that were defined by an earlier program are kept.
+        '''
+        if aliases == self.aliases[:len(aliases)]:
+            return
+
+        values = dict(zip(self.aliases, self.store))
+        known = set(aliases)
+        self.aliases = list(aliases) + [name for name in self.aliases if name not in known]
+        self.store = [values.get(name) for name in self.aliases]
+
+    def source_offset(self):
+        '''Returns the source offset of the token currently being executed.'''
+        if self.index < len(self.tokens):
+            return self.tokens[self.index].offset
+        return len(self.program)
+
+    def error(self, message, offset=None, kind='error'):
+        '''Prints detailed error information to the terminal.
+        The error is shown at the current instruction unless a source offset is given.
+        The kind labels the message, so that warnings can be shown the same way.
+        '''
         newline = '\n'
+        self.output.flush()
+        if offset is None:
+            offset = self.source_offset()
 
         # specifies the number amount of context characters to provide
         padding = 40
 
-        source_start = max(0, self.index - padding)
+        source_start = max(0, offset - padding)
 
-        start_newline = self.program.rfind(newline, source_start, self.index)
+        start_newline = self.program.rfind(newline, source_start, offset)
 
         if start_newline > -1:
             source_start = max(start_newline + 1, source_start)
 
-        source_end = min(len(self.program), self.index + padding)
+        source_end = min(len(self.program), offset + padding)
 
-        end_newline = self.program.find(newline, self.index, source_end)
+        end_newline = self.program.find(newline, offset, source_end)
 
         if end_newline > -1:
             source_end = min(source_end, end_newline)
 
-        line = self.program[:self.index].count(newline) + 1
-        column = self.index - source_start + 1
+        line = self.program.count(newline, 0, offset) + 1
+        column = offset - source_start + 1
 
         print(self.program[source_start:source_end])
         print((' ' * (column - 1)) + '^')
 
-        print('error: {} on line {}, column {}'.format(message, line, column))
+        print('{}: {} on line {}, column {}'.format(kind, message, line, column))
 
-    def execute_file(self, filename):
-        '''Executes a file through the interpreter.'''
+    def execute_file(self, filename, snapshot=None):
+        '''Executes a file through the interpreter, resuming from the snapshot if one is given.
+        The prepared form of the program is taken from the cache unless the cache is turned off.
+        Very large files are mapped rather than read, see load_source.
+        Exits with status 1 if the snapshot cannot be resumed with this engine and program.
+        '''
         try:
-            with open(filename) as file:
-                program = file.read()
-                self.execute(program)
+            program = load_source(filename)
+
+            # profiled programs are always interpreted, so there is nothing worth caching
+            if self.profiler is None:
+                self.execute(program, self.cache, snapshot)
+            else:
+                self.execute(program, None, snapshot)
+        except TwoStackBudgetError as error:
+            self.error(error.message)
+        except TwoStackSnapshotError as error:
+            print('error: {}'.format(error.message))
+            sys.exit(1)
         except SystemExit:
             pass
         except:
             print('An unexpected error occurred')
 
-    def execute(self, program):
-        '''Execute a string.'''
+    def execute(self, program, cache=None, snapshot=None):
+        '''Execute a string, preparing it through the cache if one is given.
+        The program continues from the current state of the interpreter, or from the snapshot if one is given,
+        in which case the input is read from where the snapshot was taken.
+        Raises a TwoStackSnapshotError if the snapshot was taken by another engine or of another program.
+        '''
+        try:
+            compiled = self.compile(program, cache)
+        except TwoStackSyntaxError as error:
+            self.program = program
+            self.error(error.message, error.offset)
+            return
+
+        state = self.save_state()
+        if snapshot is not None:
+            snapshot.check(self, program)
+            state = snapshot.fork()
+            self.input.skip(snapshot.input_position)
+            self.output.written = snapshot.output_position
+            if self.budget is not None:
+                self.budget.resume(snapshot.steps)
+
+        compiled.run(self.input, self.output, state, self)
+
+    def compile(self, program, cache=None):
+        '''Prepares a program for this engine as a Program, which any number of runs may share.
+        The program is prepared through the cache if one is given.
+        Raises a TwoStackSyntaxError if the brackets of the program are unbalanced.
+        '''
+        if cache is None:
+            prepared = self.prepare(program)
+        else:
+            prepared = cache.fetch(program, self)
+        return Program(type(self), program, prepared)
+
+    def disable_cache(self):
+        '''Turns off the cache, files are prepared from scratch every time they are executed.'''
+        self.cache = None
+
+    def check(self, program):
+        '''Prints a warning for every operator of a program that can never find the elements it needs,
+        assuming that the program starts with empty stacks. Returns the number of warnings.
+        '''
         self.program = program
 
-        while self.index < len(program):
-            rest = program[self.index:]
-            extra_advance = None
-            cmd = None
+        try:
+            tokens, jumps = strip_tokens(lex(program))
+        except TwoStackSyntaxError as error:
+            self.error(error.message, error.offset)
+            return 1
 
-            # check for 2 character operators
-            if rest[:2] in self.commands.keys():
-                cmd = self.commands[rest[:2]]
+        aliases, tokens = resolve_aliases(tokens)
+        diagnostics = analyse(tokens, jumps).diagnostics
 
-            # check for 1 character operators
-            elif rest[0] in self.commands.keys():
-                cmd = self.commands[rest[0]]
+        for offset, message in diagnostics:
+            self.error(message, offset, 'warning')
 
-            # check for regular expressions
-            else:
-                for key in self.commands:
-                    this_cmd = self.commands[key]
-                    if this_cmd.get('is_regex', False):
-                        if re.match(key, rest):
-                            cmd = this_cmd
-                            break
+        return len(diagnostics)
 
-            if cmd is not None:
-                if len(self.stack) >= cmd['min']:
-                    extra_advance = cmd['function']()
-                else:
-                    self.error('not enough elements on the stack')
-                    break
+    def prepare(self, program):
+        '''Parses a program into the form that run executes.
+        Raises a TwoStackSyntaxError if the brackets of the program are unbalanced.
+        '''
+        # whitespace and comments are never executed, constant expressions are evaluated only once
+        tokens, jumps = fold_constants(*strip_tokens(lex(program)))
+        aliases, tokens = resolve_aliases(tokens)
+        return program, tokens, jumps, aliases
 
-            elif rest[0] == '_':
-                self.debug()
+    def run(self, prepared):
+        '''Execute a prepared program.'''
+        self.program, tokens, self.jumps, aliases = prepared
+        self.bind_aliases(aliases)
+        self.tokens = tokens
+        self.offsets = [token.offset for token in tokens]
 
-            else:
-                self.error('unknown symbol \'{}\''.format(rest[0]))
-                break
+        self.interpret()
+
+    def interpret(self):
+        '''Runs the tokens of the current program from the current index until the program stops.'''
+        tokens = self.tokens
+
+        # budgets and profiling run a copy of the command manifest so that the loop itself is unchanged,
+        # the budget starts counting the steps of the run here
+        commands = self.commands
+        if self.budget is not None:
+            self.commands = self.budget.instrument(self)
+        if self.profiler is not None:
+            self.commands = self.profiler.instrument(self)
 
-            if extra_advance is None:
-                extra_advance = 0
+        # traces skip the steps that budgets and profiling look at
+        jit = self.jit if self.budget is None and self.profiler is None else None
+        if jit is not None:
+            self.commands = jit.instrument(self)
+
+        try:
+            while self.index < len(tokens):
+                self.token = token = tokens[self.index]
+                cmd = self.commands.get(token.key)
+
+                if cmd is not None:
+                    if len(self.stack) >= cmd['min']:
+                        try:
+                            cmd['function']()
+                        except OverflowError:
+                            # run the operator again once the stacks can hold the result
+                            if not self.promote_stacks():
+                                raise
+                            continue
+                        except TwoStackBudgetError:
+                            raise
+                        except TwoStackError as error:
+                            self.error(error.message)
+                            break
+                    else:
+                        self.error('not enough elements on the stack')
+                        break
+
+                elif token.key == DEBUG:
+                    self.debug()
+
+                else:
+                    self.error('unknown symbol \'{}\''.format(self.program[token.offset]))
+                    break
 
-            self.index += 1 + extra_advance
+                self.index += 1
+        finally:
+            self.commands = commands
+            if jit is not None:
+                jit.stop()
+            # everything the program wrote must be out before control returns
+            self.output.flush()
@@ -0,0 +1,224 @@
+'''TwoStackIO
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the buffered streams that the input and output operators use.
+'''
+
+import codecs
+import io
+import sys
+
+# the default number of bytes that are buffered before they are written out
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+# the encoding used for characters outside of ascii
+ENCODING = 'utf-8'
+ERRORS = 'surrogatepass'
+
+# the characters that cannot be decoded from the input are replaced
+INPUT_ERRORS = 'replace'
+
+NEWLINE = ord('\n')
+
+class StandardOutput(object):
+    '''A binary sink that writes to whatever sys.stdout is at the time of writing.
+    Falls back to writing text when sys.stdout has no underlying binary buffer.
+    '''
+
+    def write(self, data):
+        '''Writes bytes to stdout.'''
+        stream = sys.stdout
+        buffer = getattr(stream, 'buffer', None)
+
+        if buffer is None:
+            stream.write(data.decode(ENCODING, ERRORS))
+        else:
+            # anything printed as text must come out before these bytes
+            stream.flush()
+            buffer.write(data)
+
+    def flush(self):
+        '''Flushes stdout.'''
+        sys.stdout.flush()
+
+    def tell(self):
+        '''Returns the position of stdout, which counts whatever was printed to it as text as well,
+        or None if stdout is not a file that can be rewound.
+        '''
+        stream = sys.stdout
+        try:
+            stream.flush()
+            stream = getattr(stream, 'buffer', stream)
+            if not stream.seekable():
+                return None
+            return stream.tell()
+        except (AttributeError, OSError, ValueError):
+            return None
+
+    def isatty(self):
+        '''Checks whether stdout is a terminal.'''
+        isatty = getattr(sys.stdout, 'isatty', None)
+        return bool(isatty and isatty())
+
+class TwoStackOutput(object):
+    '''Buffers the characters written by a program and passes them on to a binary sink in bulk.
+    The buffer is written out once it holds buffer_size bytes, when it is flushed,
+    and in line buffered mode after every newline.
+    Line buffering is turned on by default when the sink is a terminal.
+    '''
+
+    def __init__(self, sink=None, buffer_size=DEFAULT_BUFFER_SIZE, line_buffered=None):
+        if sink is None:
+            sink = StandardOutput()
+
+        if line_buffered is None:
+            isatty = getattr(sink, 'isatty', None)
+            line_buffered = bool(isatty and isatty())
+
+        self.sink = sink
+        self.buffer_size = max(1, buffer_size)
+        self.line_buffered = line_buffered
+        self.buffer = bytearray()
+
+        # the number of bytes passed on to the sink so far
+        self.written = 0
+
+    def write(self, value):
+        '''Writes the character with the given ordinal value.
+        Values that are not valid characters are ignored.
+        '''
+        if 0 <= value < 128:
+            self.buffer.append(value)
+        else:
+            try:
+                char = chr(value)
+            except ValueError:
+                # handle out of range character values
+                return
+            self.buffer += char.encode(ENCODING, ERRORS)
+
+        if len(self.buffer) >= self.buffer_size or (self.line_buffered and value == NEWLINE):
+            self.flush()
+
+    def flush(self):
+        '''Writes everything in the buffer to the sink.'''
+        if self.buffer:
+            self.sink.write(bytes(self.buffer))
+            self.written += len(self.buffer)
+            del self.buffer[:]
+
+        flush = getattr(self.sink, 'flush', None)
+        if flush:
+            flush()
+
+    def tell(self):
+        '''Flushes the buffer and returns the position of the sink, which may hold more than was
+        written through this output, such as error messages. Sinks that cannot tell their position
+        fall back to the number of bytes written through this output.
+        '''
+        self.flush()
+        tell = getattr(self.sink, 'tell', None)
+        position = None
+        if tell is not None:
+            try:
+                position = tell()
+            except (OSError, ValueError):
+                position = None
+        return self.written if position is None else position
+
+class TwoStackInput(object):
+    '''Reads the input of a program in large chunks and hands it out one character at a time.
+    The source can be a binary or text stream, bytes or a string.
+    By default the input is read from stdin.
+    '''
+
+    def __init__(self, source=None, chunk_size=DEFAULT_BUFFER_SIZE):
+        self.chunk_size = max(1, chunk_size)
+        self.buffer = ''
+        self.position = 0
+        self.decoder = None
+
+        # the number of characters in the buffers before the current one
+        self.offset = 0
+
+        if isinstance(source, str):
+            # the whole input is already in memory
+            self.buffer = source
+            source = None
+            self.exhausted = True
+
+        else:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                source = io.BytesIO(source)
+            self.exhausted = False
+
+        self.source = source
+
+    def read(self):
+        '''Returns the ordinal value of the next character or -1 if the stream is empty.'''
+        if self.position >= len(self.buffer) and not self.fill():
+            return -1
+
+        char = self.buffer[self.position]
+        self.position += 1
+        return ord(char)
+
+    def tell(self):
+        '''Returns the number of characters that have been read.'''
+        return self.offset + self.position
+
+    def skip(self, count):
+        '''Reads past a number of characters without handing them out.
+        Returns False if the stream ended first.
+        '''
+        while count > 0:
+            if self.position >= len(self.buffer) and not self.fill():
+                return False
+
+            step = min(count, len(self.buffer) - self.position)
+            self.position += step
+            count -= step
+
+        return True
+
+    def fill(self):
+        '''Replaces the buffer with the next chunk of the stream.
+        Returns whether there are any characters left to read.
+        '''
+        while not self.exhausted:
+            try:
+                chunk = self.read_chunk()
+            except KeyboardInterrupt:
+                chunk = None
+
+            if not chunk:
+                self.exhausted = True
+                text = self.decoder.decode(b'', True) if self.decoder else ''
+            elif isinstance(chunk, str):
+                text = chunk
+            else:
+                if self.decoder is None:
+                    self.decoder = codecs.getincrementaldecoder(ENCODING)(INPUT_ERRORS)
+                text = self.decoder.decode(chunk)
+
+            if text:
+                self.offset += len(self.buffer)
+                self.buffer = text
+                self.position = 0
+                return True
+
+        return self.position < len(self.buffer)
+
+    def read_chunk(self):
+        '''Reads whatever is available from the stream, up to the chunk size.
+        Binary streams are preferred and read without blocking for a full chunk
+        so that interactive input is handed out as soon as a line is entered.
+        '''
+        stream = self.source if self.source is not None else sys.stdin
+        stream = getattr(stream, 'buffer', stream)
+
+        read1 = getattr(stream, 'read1', None)
+        if read1 is not None:
+            return read1(self.chunk_size)
+
+        return stream.read(self.chunk_size)
@@ -0,0 +1,520 @@
+'''TwoStackJit
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the tracing compiler which speeds up the hot loops and blocks of interpreted programs.
+The interpreter counts the back edges of every loop and the calls of every block. Once one of
+them is hot, the operators that run on its next pass are recorded and compiled into a Python
+function. Every decision that was made while recording becomes a guard, the trace gives
+control back to the interpreter at the token whose guard failed.
+'''
+
+import sys
+
+from twostack_lexer import ALIAS_DEF, ALIAS_RECALL
+from twostack_source import locate
+from twostack_transpiler import FunctionWriter
+
+# the number of back edges of a loop or calls of a block after which it is traced
+HOT_LOOP = 32
+HOT_BLOCK = 32
+
+# the longest trace that is recorded, longer ones are given up on
+TRACE_LIMIT = 500
+
+# the kinds of trace
+LOOP = 'loop'
+BLOCK = 'block'
+
+# the ways a [ went while it was recorded
+ENTERED = 'entered'
+SKIPPED = 'skipped'
+TRACED = 'traced'
+
+# the ways a } went while it was recorded
+INLINED = 'inlined'
+RETURNED = 'returned'
+
+class Trace(object):
+    '''A compiled trace.
+
+    kind: whether the trace runs a loop or a block
+    anchor: the index of the [ of the loop or of the first token of the block
+    steps: the number of operators that were recorded
+    source: the generated Python source
+    function: runs the trace, returning the index of the token that the interpreter runs next
+    runs: the number of times the trace was run
+    deopts: the number of times a guard failed
+    '''
+
+    def __init__(self, kind, anchor, steps):
+        self.kind = kind
+        self.anchor = anchor
+        self.steps = steps
+        self.source = None
+        self.function = None
+        self.runs = 0
+        self.deopts = 0
+
+class Recording(object):
+    '''A trace that is being recorded.
+
+    kind, anchor: as for Trace
+    depth: the depth of the callstack when the recording started
+    steps: the token index and the outcome of every operator that ran
+    frames: the call sites of the blocks that were called and have not returned yet
+    next: the index of the token that has to run next for the recording to continue
+    '''
+
+    def __init__(self, kind, anchor, depth):
+        self.kind = kind
+        self.anchor = anchor
+        self.depth = depth
+        self.steps = []
+        self.frames = []
+        self.next = anchor
+
+class TraceWriter(FunctionWriter):
+    '''Writes the Python source of a trace.
+    Wherever the transpiler would stop the program, the trace returns the token index instead,
+    so that the interpreter runs the token again and reports any error itself.
+    '''
+
+    def __init__(self, tokens, jumps):
+        FunctionWriter.__init__(self, tokens, 'trace', [])
+        self.jumps = jumps
+        self.line('callstack = vm.callstack')
+        self.line('store = vm.store')
+        self.line('write = vm.output.write')
+
+    def fail(self, index, message):
+        '''Leaves the trace at the token, leaving the stack as it would be.'''
+        if self.values:
+            self.line(self.flush_code())
+        self.line('return deopt({})'.format(index))
+
+    def guard(self, condition, index):
+        '''Leaves the trace at the token if the condition holds.'''
+        self.line('if {}:'.format(condition))
+        self.depth += 1
+        self.fail(index, None)
+        self.depth -= 1
+
+    def write_subtrace(self, table, anchor, expected):
+        '''Writes a call to another trace, the rest of this trace is skipped unless it finished normally.'''
+        self.flush()
+        self.line('index = {}[{}].function()'.format(table, anchor))
+        self.reload()
+        self.line('if index != {}:'.format(expected))
+        self.line('    return index')
+
+    def write_step(self, index, outcome):
+        '''Writes the code of a single recorded operator.'''
+        key = self.tokens[index].key
+
+        if key == '[':
+            self.flush()
+            if outcome == ENTERED:
+                self.guard('not stack or not stack[-1]', index)
+                self.known = max(self.known, 1)
+            elif outcome == SKIPPED:
+                self.guard('stack and stack[-1]', index)
+            else:
+                self.write_subtrace('loops', index, self.jumps[index] + 1)
+
+        elif key == ']':
+            self.flush()
+            self.guard('len(stack) > max_depth or len(ztack) > max_depth or len(callstack) > max_depth', index)
+
+        elif key == '{':
+            self.values.append(str(self.tokens[index].offset))
+
+        elif key == '}':
+            self.flush()
+            if outcome == INLINED:
+                self.line('callstack.pop()')
+            elif outcome == RETURNED:
+                self.line('return callstack.pop() + 1')
+            else:
+                # the block was called before the trace started
+                self.guard('not callstack or callstack[-1] != {}'.format(outcome), index)
+                self.line('callstack.pop()')
+
+        elif key == '@' or key == '?':
+            self.write_call(index, outcome)
+
+        elif key == ALIAS_RECALL:
+            name = self.temporary()
+            self.line('{} = store[{}]'.format(name, self.tokens[index].value))
+            self.guard('{} is None'.format(name), index)
+            self.values.append(name)
+
+        else:
+            if key == '/' or key == '%':
+                # dividing by zero is left to the interpreter
+                self.require(2, index)
+                self.guard('not {}'.format(self.peek()), index)
+            elif key == '**':
+                # negative powers are not integers
+                self.require(2, index)
+                self.guard('{} < 0'.format(self.peek()), index)
+
+            self.write_token(index)
+
+    def write_call(self, index, outcome):
+        '''Writes a @ or a ?, the block that was called is guarded on.'''
+        taken, target, traced = outcome
+        key = self.tokens[index].key
+
+        self.flush()
+        self.require(1 if key == '@' else 2, index)
+
+        if not taken:
+            self.guard('stack[-1]', index)
+            self.line('stack.pop()')
+            self.known -= 1
+            return
+
+        # the same checks as op_execblock once the condition has been popped
+        if key == '@':
+            self.guard('stack[-1] != {!r} or len(callstack) >= max_depth or len(stack) > max_depth '
+                'or len(ztack) > max_depth'.format(target), index)
+            self.line('stack.pop()')
+            self.known = max(0, self.known - 1)
+        else:
+            self.guard('not stack[-1] or stack[-2] != {!r} or len(callstack) >= max_depth '
+                'or len(stack) - 1 > max_depth or len(ztack) > max_depth'.format(target), index)
+            self.line('del stack[-2:]')
+            self.known = max(0, self.known - 2)
+
+        self.line('callstack.append({})'.format(index))
+
+        if traced is not None:
+            self.write_subtrace('blocks', traced, index + 1)
+
+class TwoStackJit(object):
+    '''Traces the hot loops and blocks of the programs run by an interpreter.
+    The traces are kept for as long as the interpreter runs the same prepared program.
+    Traces keep their values in lists of Python integers, so the stacks are promoted
+    before a trace runs.
+    '''
+
+    def __init__(self, hot_loop=HOT_LOOP, hot_block=HOT_BLOCK, limit=TRACE_LIMIT):
+        self.hot_loop = hot_loop
+        self.hot_block = hot_block
+        self.limit = limit
+        self.interpreter = None
+        self.tokens = None
+        self.jumps = None
+        self.reset()
+
+    def reset(self):
+        '''Forgets every trace.'''
+        # maps the anchor of every loop and block onto its number of back edges or calls
+        self.loop_hits = {}
+        self.block_hits = {}
+
+        # maps the anchor of every loop and block onto its trace
+        self.loops = {}
+        self.blocks = {}
+
+        # the anchors that could not be traced
+        self.rejected = set()
+
+        self.recording = None
+        self.aborted = 0
+
+        # set whenever a trace runs, so that a recording can see it
+        self.ran = None
+
+    def instrument(self, interpreter):
+        '''Returns a copy of the command manifest of the interpreter in which the loops and calls are counted
+        and the traces are run. The traces of an earlier program are dropped.
+        '''
+        if interpreter is not self.interpreter or interpreter.tokens is not self.tokens:
+            self.reset()
+            self.interpreter = interpreter
+            self.tokens = interpreter.tokens
+            self.jumps = interpreter.jumps
+
+        self.recording = None
+        self.commands = commands = dict(interpreter.commands)
+
+        for key, function in (('[', self.loop_begin), (']', self.loop_end), ('@', self.call), ('?', self.call)):
+            commands[key] = dict(commands[key], function=function(commands[key]['function']))
+
+        self.recorders = dict((key, dict(command, function=self.recorder(command['function'])))
+            for key, command in commands.items())
+
+        return commands
+
+    def stop(self):
+        '''Gives up on the recording that is still running when the program stops.'''
+        self.recording = None
+
+    # ===== Hooks ===== #
+    def loop_begin(self, function):
+        '''Runs the trace of a loop instead of the loop if it has one.'''
+        interpreter = self.interpreter
+
+        def operator():
+            trace = self.loops.get(interpreter.index)
+            if trace is None:
+                function()
+            else:
+                interpreter.index = self.run(trace) - 1
+
+        return operator
+
+    def loop_end(self, function):
+        '''Counts the back edges of every loop, recording the next pass through a hot one.'''
+        interpreter = self.interpreter
+        hits = self.loop_hits
+
+        def operator():
+            function()
+            anchor = interpreter.index + 1
+            count = hits[anchor] = hits.get(anchor, 0) + 1
+            if count >= self.hot_loop and self.recording is None and anchor not in self.rejected:
+                self.start(LOOP, anchor)
+
+        return operator
+
+    def call(self, function):
+        '''Counts the calls of every block, running its trace or recording it once it is hot.'''
+        interpreter = self.interpreter
+        hits = self.block_hits
+
+        def operator():
+            depth = len(interpreter.callstack)
+            function()
+            if len(interpreter.callstack) == depth:
+                return
+
+            # only calls that land at the beginning of a block are traced
+            anchor = interpreter.index + 1
+            if anchor == 0 or self.tokens[anchor - 1].key != '{':
+                return
+
+            trace = self.blocks.get(anchor)
+            if trace is not None:
+                interpreter.index = self.run(trace) - 1
+                return
+
+            count = hits[anchor] = hits.get(anchor, 0) + 1
+            if count >= self.hot_block and self.recording is None and anchor not in self.rejected:
+                self.start(BLOCK, anchor)
+
+        return operator
+
+    def run(self, trace):
+        '''Runs a trace, returning the index of the token that the interpreter runs next.'''
+        self.interpreter.promote_stacks()
+        trace.runs += 1
+        index = trace.function()
+        self.ran = (trace.anchor, index)
+        return index
+
+    # ===== Recording ===== #
+    def start(self, kind, anchor):
+        '''Starts recording at the anchor, which is the next token the interpreter runs.'''
+        self.recording = Recording(kind, anchor, len(self.interpreter.callstack))
+        self.interpreter.commands = self.recorders
+
+    def cancel(self, reject=True):
+        '''Gives up on the current recording, the anchor is never recorded again if it is rejected.'''
+        if reject:
+            self.rejected.add(self.recording.anchor)
+            self.aborted += 1
+        self.recording = None
+        self.interpreter.commands = self.commands
+
+    def recorder(self, function):
+        '''Wraps an operator so that it is recorded while it runs.'''
+        interpreter = self.interpreter
+
+        def operator():
+            recording = self.recording
+            index = interpreter.index
+
+            if recording is None:
+                function()
+                return
+
+            # something ran that the recording could not see, such as the debug menu
+            if index != recording.next:
+                self.cancel()
+                function()
+                return
+
+            if recording.kind == LOOP and index == recording.anchor and recording.steps:
+                self.finish()
+                self.commands['[']['function']()
+                return
+
+            outcome = self.observe(index, function)
+            if self.recording is None:
+                return
+
+            recording.steps.append((index, outcome))
+            recording.next = interpreter.index + 1
+
+            if outcome == RETURNED:
+                self.finish()
+            elif len(recording.steps) > self.limit:
+                self.cancel()
+
+        return operator
+
+    def observe(self, index, function):
+        '''Runs an operator, returning how it went. The recording is cancelled if it cannot be traced.'''
+        interpreter = self.interpreter
+        recording = self.recording
+        stack = interpreter.stack
+        callstack = interpreter.callstack
+        key = self.tokens[index].key
+
+        top = stack[-1] if stack else None
+        second = stack[-2] if len(stack) > 1 else None
+        depth = len(callstack)
+        self.ran = None
+
+        function()
+
+        if key == '[':
+            if self.ran is not None:
+                if self.ran[1] != self.jumps[index] + 1:
+                    self.cancel()
+                return TRACED
+
+            entered = interpreter.index == index
+            if index == recording.anchor and not entered:
+                # the loop ended before it could be recorded, try again later
+                self.cancel(False)
+            return ENTERED if entered else SKIPPED
+
+        if key == '@' or key == '?':
+            target = top if key == '@' else second
+            taken = self.ran is not None or len(callstack) > depth
+            if not taken:
+                return False, None, None
+
+            if self.ran is not None:
+                if self.ran[1] != index + 1:
+                    self.cancel()
+                return True, target, self.ran[0]
+
+            if self.tokens[interpreter.index].key != '{':
+                self.cancel()
+            recording.frames.append(index)
+            return True, target, None
+
+        if key == '}':
+            if recording.frames:
+                recording.frames.pop()
+                return INLINED
+            if recording.kind == BLOCK and len(callstack) < recording.depth:
+                return RETURNED
+            return interpreter.index
+
+        if key == ALIAS_DEF and self.tokens[index].value < 0:
+            self.cancel()
+
+        return None
+
+    def finish(self):
+        '''Compiles the recording into a trace.'''
+        recording = self.recording
+        interpreter = self.interpreter
+
+        if recording.frames or (recording.kind == LOOP and len(interpreter.callstack) != recording.depth):
+            self.cancel()
+            return
+
+        trace = self.compile(recording)
+        if recording.kind == LOOP:
+            self.loops[recording.anchor] = trace
+        else:
+            self.blocks[recording.anchor] = trace
+
+        self.recording = None
+        interpreter.commands = self.commands
+
+    def compile(self, recording):
+        '''Generates and compiles the function of a recording.'''
+        trace = Trace(recording.kind, recording.anchor, len(recording.steps))
+        writer = TraceWriter(self.tokens, self.jumps)
+        steps = recording.steps
+
+        if recording.kind == LOOP:
+            # every pass through the loop starts at the [
+            writer.line('while True:')
+            writer.depth += 1
+            writer.line('if not stack or not stack[-1]:')
+            writer.line('    return {}'.format(self.jumps[recording.anchor] + 1))
+            writer.known = 1
+            steps = steps[1:]
+
+        for index, outcome in steps:
+            writer.write_step(index, outcome)
+
+        def deopt(index):
+            # a guard failed, the interpreter takes over at the token
+            trace.deopts += 1
+            return index
+
+        trace.source = '\n'.join(writer.lines) + '\n'
+        namespace = {
+            'vm': self.interpreter,
+            'max_depth': self.interpreter.max_depth,
+            'loops': self.loops,
+            'blocks': self.blocks,
+            'deopt': deopt,
+            'read': self.read
+        }
+        exec(compile(trace.source, '<trace>', 'exec'), namespace)
+        trace.function = namespace['trace']
+        return trace
+
+    # ===== Runtime ===== #
+    def read(self):
+        '''Reads the next input character.'''
+        interpreter = self.interpreter
+        # make sure that an interactive user can see any prompt before typing
+        if interpreter.output.line_buffered:
+            interpreter.output.flush()
+        return interpreter.input.read()
+
+    # ===== Statistics ===== #
+    def statistics(self):
+        '''Returns the hit counts, the number of traces and the deopts.'''
+        traces = list(self.loops.values()) + list(self.blocks.values())
+        return {
+            'loop_hits': sum(self.loop_hits.values()),
+            'block_hits': sum(self.block_hits.values()),
+            'traces': len(traces),
+            'aborted': self.aborted,
+            'runs': sum(trace.runs for trace in traces),
+            'deopts': sum(trace.deopts for trace in traces)
+        }
+
+    def report(self, program, file=None):
+        '''Writes the statistics followed by every trace.'''
+        if file is None:
+            file = sys.stdout
+
+        statistics = self.statistics()
+        print('JIT:', file=file)
+        for name in ('loop_hits', 'block_hits', 'traces', 'aborted', 'runs', 'deopts'):
+            print('  {:<12} {:>10}'.format(name.replace('_', ' '), statistics[name]), file=file)
+
+        def location(index):
+            return '{}:{}'.format(*locate(program, self.tokens[index].offset))
+
+        traces = sorted(list(self.loops.values()) + list(self.blocks.values()), key=lambda trace: -trace.runs)
+        if traces:
+            print('Traces:', file=file)
+            print('  {:<10} {:<6} {:>10} {:>6} {:>10} {:>10}'.format('location', 'kind', 'hits', 'steps', 'runs', 'deopts'), file=file)
+            for trace in traces:
+                hits = (self.loop_hits if trace.kind == LOOP else self.block_hits).get(trace.anchor, 0)
+                print('  {:<10} {:<6} {:>10} {:>6} {:>10} {:>10}'.format(
+                    location(trace.anchor), trace.kind, hits, trace.steps, trace.runs, trace.deopts), file=file)
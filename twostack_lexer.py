@@ -0,0 +1,191 @@
+'''TwoStackLexer
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the lexer which turns TwoStack source code into a stream of tokens.
+The program is scanned exactly once, each token remembers where it came from
+in the source so that errors can still be reported with a line and column.
+Sources that are too large to hold in a string are lexed one chunk at a time.
+'''
+
+from collections import namedtuple
+
+# a single lexical unit of a program
+# key: the key of the operator in the command manifest (or DEBUG/UNKNOWN)
+# value: the decoded payload of literals and aliases, otherwise None
+# offset: the index of the first character of the token in the source
+# length: the number of source characters the token spans
+Token = namedtuple('Token', ['key', 'value', 'offset', 'length'])
+
+# ===== Token Keys ===== #
+# these match the keys used in the command manifest of TwoStackFeatureProvider
+ALIAS_DEF = '~'
+ALIAS_RECALL = '^[a-zA-Z]+'
+INTEGER = '^[0-9]+'
+STRING = '"'
+DEBUG = '_'
+UNKNOWN = None
+
+# operators that span two characters, these must be matched first
+TWO_CHAR_OPERATORS = ('**', '\\\\')
+
+# ===== Character Classes ===== #
+# every character is classified with a single table lookup
+CLASS_UNKNOWN = 0
+CLASS_OPERATOR = 1
+CLASS_DIGIT = 2
+CLASS_LETTER = 3
+CLASS_PREFIX = 4
+CLASS_ALIAS_DEF = 5
+CLASS_STRING = 6
+CLASS_DEBUG = 7
+
+CHAR_CLASSES = {}
+CHAR_CLASSES.update(dict.fromkeys('+-/%;:`$!=<>&|^?@{}[].,\n ', CLASS_OPERATOR))
+CHAR_CLASSES.update(dict.fromkeys('0123456789', CLASS_DIGIT))
+CHAR_CLASSES.update(dict.fromkeys('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ', CLASS_LETTER))
+# these characters are operators on their own but may also begin a two character operator
+CHAR_CLASSES.update(dict.fromkeys('*\\', CLASS_PREFIX))
+CHAR_CLASSES[ALIAS_DEF] = CLASS_ALIAS_DEF
+CHAR_CLASSES[STRING] = CLASS_STRING
+CHAR_CLASSES[DEBUG] = CLASS_DEBUG
+
+def lex(program):
+    '''Converts a program into a list of tokens.
+    The program is either a string or a source that is lexed one chunk at a time.
+    '''
+    if not isinstance(program, str):
+        return lex_chunks(program.chunks())
+    return scan(program)
+
+def lex_chunks(chunks):
+    '''Converts a program that arrives in pieces into a list of tokens.
+    Only the text that the last token may still continue into is held back, so a program is
+    never in memory as a whole. String literals that run over many pieces are collected piece
+    by piece, any other token that does is scanned again once the pieces behind it are at least
+    as long as itself, which keeps the total work linear however long the token grows.
+    '''
+    tokens = []
+    carry = ''
+    base = 0
+    pieces = []
+    waiting = 0
+
+    # the parts of a string literal that has not been closed yet, or None
+    string = None
+
+    for chunk in chunks:
+        if string is not None:
+            end = chunk.find(STRING)
+            if end == -1:
+                string.append(chunk)
+                continue
+
+            string.append(chunk[:end])
+            value = ''.join(string)
+            string = None
+            tokens.append(Token(STRING, value, base, len(value) + 2))
+            base += len(value) + 2
+            chunk = chunk[end + 1:]
+
+        pieces.append(chunk)
+        waiting += len(chunk)
+        if waiting < len(carry):
+            continue
+
+        text = carry + ''.join(pieces)
+        pieces = []
+        waiting = 0
+        scanned = scan(text, base)
+
+        # the last token may go on in the next piece, so it is held back
+        end = base + len(text)
+        carry = ''
+        if scanned and scanned[-1].offset + scanned[-1].length >= end:
+            last = scanned.pop()
+            if last.key == STRING and last.offset + last.length > end:
+                string = [last.value]
+            else:
+                carry = text[last.offset - base:]
+            base = last.offset
+        else:
+            base = end
+
+        tokens += scanned
+
+    if string is not None:
+        value = ''.join(string)
+        tokens.append(Token(STRING, value, base, len(value) + 2))
+        return tokens
+
+    text = carry + ''.join(pieces)
+    if text:
+        tokens += scan(text, base)
+    return tokens
+
+def scan(program, base=0):
+    '''Converts the text of a program into a list of tokens.
+    The offsets of the tokens are counted from base.
+    '''
+    tokens = []
+    append = tokens.append
+    classify = CHAR_CLASSES.get
+    length = len(program)
+    index = 0
+
+    while index < length:
+        char = program[index]
+        char_class = classify(char, CLASS_UNKNOWN)
+
+        if char_class == CLASS_OPERATOR:
+            append(Token(char, None, base + index, 1))
+            index += 1
+
+        elif char_class == CLASS_LETTER:
+            end = index + 1
+            while end < length and program[end].isalpha():
+                end += 1
+            append(Token(ALIAS_RECALL, program[index:end], base + index, end - index))
+            index = end
+
+        elif char_class == CLASS_DIGIT:
+            end = index + 1
+            while end < length and classify(program[end]) == CLASS_DIGIT:
+                end += 1
+            append(Token(INTEGER, int(program[index:end]), base + index, end - index))
+            index = end
+
+        elif char_class == CLASS_PREFIX:
+            if program.startswith(TWO_CHAR_OPERATORS, index):
+                append(Token(program[index:index + 2], None, base + index, 2))
+                index += 2
+            else:
+                append(Token(char, None, base + index, 1))
+                index += 1
+
+        elif char_class == CLASS_ALIAS_DEF:
+            end = index + 1
+            while end < length and program[end].isalpha():
+                end += 1
+
+            # an empty alias definition still swallows the following character
+            span = max(end - index, min(2, length - index))
+            append(Token(ALIAS_DEF, program[index + 1:end], base + index, span))
+            index += span
+
+        elif char_class == CLASS_STRING:
+            end = program.find(STRING, index + 1)
+            if end == -1:
+                end = length
+            append(Token(STRING, program[index + 1:end], base + index, end + 1 - index))
+            index = end + 1
+
+        elif char_class == CLASS_DEBUG:
+            append(Token(DEBUG, None, base + index, 1))
+            index += 1
+
+        else:
+            # unknown symbols only become an error when they are executed
+            append(Token(UNKNOWN, char, base + index, 1))
+            index += 1
+
+    return tokens
@@ -0,0 +1,84 @@
+'''TwoStackMemo
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the cache which remembers the results of pure blocks.
+A pure block only works on the top elements of the stack, so calling it again with the same
+elements on top always leaves the same elements behind. The virtual machine looks the result
+up instead of running the block again.
+'''
+
+import collections
+
+from twostack_stack import MACHINE_LIMIT
+
+# the number of results that are remembered by default
+DEFAULT_SIZE = 4096
+
+# a block that misses this many times in a row is not worth looking up any more
+GIVE_UP_MISSES = 1024
+
+class TwoStackMemo(object):
+    '''A least recently used cache of the results of pure blocks, keyed by the block and the
+    elements that it consumed. The cache only ever holds the results of a single program.
+    Blocks that are rarely called with the same elements are given up on, so that they only
+    pay for the lookups until that becomes clear.
+    '''
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = size
+        self.program = None
+        self.entries = collections.OrderedDict()
+        self.streaks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def bind(self, program):
+        '''Prepares the cache for a program, forgetting the results of any other program.'''
+        if program != self.program:
+            self.entries.clear()
+            self.streaks.clear()
+            self.program = program
+
+    def get(self, key):
+        '''Returns the elements left behind by a block, or None if they are not known.
+        The key is the block followed by the elements that it consumed.
+        '''
+        block = key[0]
+        values = self.entries.get(key)
+        if values is None:
+            self.misses += 1
+            self.streaks[block] = self.streaks.get(block, 0) + 1
+            return None
+
+        self.hits += 1
+        self.streaks[block] = 0
+        self.entries.move_to_end(key)
+        return values
+
+    def hopeless(self, block):
+        '''Checks whether a block has missed too many times in a row to be worth looking up.'''
+        return self.streaks.get(block, 0) >= GIVE_UP_MISSES
+
+    def put(self, key, values):
+        '''Remembers the elements left behind by a block, forgetting the least recently used result if the cache is full.'''
+        if self.size <= 0:
+            return
+
+        # only results that fit back onto a stack of machine integers are remembered
+        for value in values:
+            if not -MACHINE_LIMIT <= value < MACHINE_LIMIT:
+                return
+
+        self.entries[key] = values
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        '''Forgets every result.'''
+        self.entries.clear()
+        self.streaks.clear()
+        self.program = None
+
+    def statistics(self):
+        '''Returns the number of hits, misses and remembered results.'''
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'size': self.size}
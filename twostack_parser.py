@@ -0,0 +1,221 @@
+'''TwoStackParser
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the passes which run over the token stream before a program is executed.
+'''
+
+import operator
+from array import array
+
+from twostack_errors import TwoStackSyntaxError
+from twostack_lexer import Token, ALIAS_DEF, ALIAS_RECALL, INTEGER, STRING
+
+# the brackets that are matched, opening brackets map to their closing bracket
+BRACKETS = {
+    '{': '}',
+    '[': ']'
+}
+
+# tokens that do nothing when executed
+NO_OPERATION = ('\n', ' ')
+
+# the binary operators that are evaluated ahead of time when both operands are integer literals
+# each is given the second and then the top element of the stack, just like the operator itself
+FOLDABLE = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.floordiv,
+    '%': operator.mod,
+    '**': operator.pow,
+    '=': lambda second, top: int(second == top),
+    '<': lambda second, top: int(second < top),
+    '>': lambda second, top: int(second > top),
+    '&': lambda second, top: int(top and second),
+    '|': lambda second, top: int(top or second),
+    '^': lambda second, top: int(top ^ second)
+}
+
+# folded values are kept small enough for a machine integer, anything larger is computed when the program runs
+FOLD_BITS = 63
+
+def match_brackets(tokens):
+    '''Builds the jump table for a list of tokens in a single pass.
+    The entry of every bracket is the index of its matching bracket, all other entries are -1.
+    Blocks and loops are matched independently of each other, just like they are executed.
+    Raises a TwoStackSyntaxError for the first unbalanced bracket.
+    '''
+    jumps = array('i', [-1]) * len(tokens)
+    closing = dict((close, open) for open, close in BRACKETS.items())
+
+    # the indexes of the brackets that are still waiting for a match
+    pending = dict((open, []) for open in BRACKETS)
+
+    for index, token in enumerate(tokens):
+        key = token.key
+
+        if key in BRACKETS:
+            pending[key].append(index)
+
+        elif key in closing:
+            opened = pending[closing[key]]
+            if not opened:
+                raise TwoStackSyntaxError('unmatched \'{}\''.format(key), token.offset)
+
+            start = opened.pop()
+            jumps[start] = index
+            jumps[index] = start
+
+    # report the outermost bracket that was never closed
+    unclosed = [indexes[0] for indexes in pending.values() if indexes]
+    if unclosed:
+        token = tokens[min(unclosed)]
+        raise TwoStackSyntaxError('unmatched \'{}\''.format(token.key), token.offset)
+
+    return jumps
+
+def resolve_aliases(tokens):
+    '''Gives every alias name an integer slot in the order the names first appear.
+    Returns the list of names indexed by slot and a copy of the tokens
+    in which the value of every alias token has been replaced by its slot.
+    Empty alias definitions are given the slot -1.
+    '''
+    aliases = []
+    slots = {}
+    resolved = []
+
+    for token in tokens:
+        if token.key == ALIAS_RECALL or token.key == ALIAS_DEF:
+            name = token.value
+            if not name:
+                slot = -1
+            elif name in slots:
+                slot = slots[name]
+            else:
+                slot = slots[name] = len(aliases)
+                aliases.append(name)
+            token = token._replace(value=slot)
+
+        resolved.append(token)
+
+    return aliases, resolved
+
+def find_comment(tokens, jumps, index):
+    '''Checks whether a comment 0[ ... ]; begins at the token index.
+    Returns the index of the token after the comment or -1 if there is none.
+    The loop of a comment is never entered, but blocks inside of it may still be matched
+    with braces outside of it, so only comments that contain whole blocks are reported.
+    '''
+    if tokens[index].key != INTEGER or tokens[index].value != 0:
+        return -1
+
+    if index + 1 >= len(tokens) or tokens[index + 1].key != '[':
+        return -1
+
+    end = jumps[index + 1]
+    if end + 1 >= len(tokens) or tokens[end + 1].key != ';':
+        return -1
+
+    for inner in range(index + 2, end):
+        if tokens[inner].key in ('{', '}') and not index < jumps[inner] < end:
+            return -1
+
+    return end + 2
+
+def strip_tokens(tokens):
+    '''Removes the whitespace and the comments from a list of tokens.
+    Returns the remaining tokens along with their jump table.
+    The tokens keep their source offsets, so errors are still reported
+    against the original program and blocks are still found by their offset.
+    Raises a TwoStackSyntaxError for the first unbalanced bracket.
+    '''
+    tokens = [token for token in tokens if token.key not in NO_OPERATION]
+    jumps = match_brackets(tokens)
+
+    # the new index of every token that is kept, -1 for those that are removed
+    kept = []
+    renumbered = array('i', [-1]) * len(tokens)
+
+    index = 0
+    while index < len(tokens):
+        end = find_comment(tokens, jumps, index)
+        if end >= 0:
+            index = end
+            continue
+
+        renumbered[index] = len(kept)
+        kept.append(tokens[index])
+        index += 1
+
+    stripped_jumps = array('i', [-1]) * len(kept)
+    for index, jump in enumerate(jumps):
+        if jump >= 0 and renumbered[index] >= 0:
+            stripped_jumps[renumbered[index]] = renumbered[jump]
+
+    return kept, stripped_jumps
+
+def evaluate(key, second, top):
+    '''Returns the result of a binary operator applied to two integer literals,
+    or None if the operator has to be left for the program to run.
+    '''
+    if key in ('/', '%') and top == 0:
+        # dividing by zero has to fail when the program runs, not when it is parsed
+        return None
+
+    if key == '**' and (top < 0 or (second.bit_length() - 1) * top >= FOLD_BITS):
+        # negative powers are not integers and the others would be too large
+        return None
+
+    value = FOLDABLE[key](second, top)
+    if value.bit_length() > FOLD_BITS:
+        return None
+    return value
+
+def fold_constants(tokens, jumps):
+    '''Evaluates the operators whose operands are all integer literals ahead of time,
+    so that 0 1- becomes the single literal -1, and turns the value of every string literal
+    into the tuple of integers that it pushes.
+    Returns the remaining tokens along with their jump table.
+    A folded literal spans the source of the whole expression it replaces, so a jump to an offset
+    inside the expression continues after all of it. Brackets are never folded, so the jumps to blocks
+    that programs make always land where they did.
+    '''
+    folded = []
+    renumbered = array('i', [-1]) * len(tokens)
+
+    # the number of integer literals at the end of the folded tokens
+    literals = 0
+
+    for index, token in enumerate(tokens):
+        key = token.key
+        value = None
+        operands = 0
+
+        if key in FOLDABLE and literals >= 2:
+            operands = 2
+            value = evaluate(key, folded[-2].value, folded[-1].value)
+        elif key == '!' and literals >= 1:
+            operands = 1
+            value = int(not folded[-1].value)
+
+        if value is not None:
+            first = folded[-operands]
+            del folded[-operands:]
+            literals -= operands
+            token = Token(INTEGER, value, first.offset, token.offset + token.length - first.offset)
+            key = INTEGER
+
+        elif key == STRING:
+            token = token._replace(value=tuple(map(ord, token.value)))
+
+        renumbered[index] = len(folded)
+        folded.append(token)
+        literals = literals + 1 if key == INTEGER else 0
+
+    # only brackets have jumps and they are never folded
+    folded_jumps = array('i', [-1]) * len(folded)
+    for index, jump in enumerate(jumps):
+        if jump >= 0:
+            folded_jumps[renumbered[index]] = renumbered[jump]
+
+    return folded, folded_jumps
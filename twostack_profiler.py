@@ -0,0 +1,152 @@
+'''TwoStackProfiler
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the profiler which counts and times every operator a program executes.
+'''
+
+import sys
+import time
+
+from twostack_source import locate
+
+# the number of source offsets shown in the hot spot listing
+HOTSPOT_LIMIT = 20
+
+# the longest symbol shown in the hot spot listing
+SYMBOL_WIDTH = 16
+
+class TwoStackProfiler(object):
+    '''Collects the number of executions and the time spent per operator and per source offset.
+    The time spent in a block is also added up per block and per call site, recursive calls
+    are counted at every level of the recursion.
+    '''
+
+    def __init__(self, timer=time.perf_counter):
+        self.timer = timer
+
+        # the name of each operator in the command manifest
+        self.names = {}
+
+        # maps the key of an operator onto [count, seconds]
+        self.operators = {}
+
+        # maps a source offset onto [count, seconds, inclusive seconds, length]
+        self.offsets = {}
+
+        # maps the source offset of a block onto [calls, seconds]
+        self.blocks = {}
+
+        # the call site, block and start time of every block that is still running
+        self.frames = []
+
+    def instrument(self, interpreter):
+        '''Returns a copy of the command manifest of the interpreter in which every operator is timed.'''
+        commands = {}
+
+        for key, command in interpreter.commands.items():
+            command = dict(command)
+            command['function'] = self.timed(interpreter, key, command['function'])
+            commands[key] = command
+            self.names[key] = command['name']
+
+        return commands
+
+    def timed(self, interpreter, key, function):
+        '''Wraps an operator so that every call to it is recorded.'''
+        timer = self.timer
+
+        def operator():
+            token = interpreter.token
+            depth = len(interpreter.callstack)
+
+            start = timer()
+            function()
+            end = timer()
+
+            self.record(key, token, end - start)
+
+            # @ and ? push onto the callstack when they run a block, } pops off of it
+            if len(interpreter.callstack) > depth:
+                index = interpreter.index
+                block = interpreter.tokens[index].offset if index >= 0 else -1
+                self.frames.append((token.offset, block, start))
+            elif len(interpreter.callstack) < depth:
+                self.leave(end)
+
+        return operator
+
+    def record(self, key, token, seconds):
+        '''Adds a single execution of an operator.'''
+        operator = self.operators.get(key)
+        if operator is None:
+            operator = self.operators[key] = [0, 0.0]
+        operator[0] += 1
+        operator[1] += seconds
+
+        offset = self.offsets.get(token.offset)
+        if offset is None:
+            offset = self.offsets[token.offset] = [0, 0.0, 0.0, token.length]
+        offset[0] += 1
+        offset[1] += seconds
+
+    def leave(self, end):
+        '''Adds the time spent in the block that was most recently called.'''
+        if not self.frames:
+            return
+
+        call, block, start = self.frames.pop()
+        seconds = end - start
+
+        if call in self.offsets:
+            self.offsets[call][2] += seconds
+
+        totals = self.blocks.get(block)
+        if totals is None:
+            totals = self.blocks[block] = [0, 0.0]
+        totals[0] += 1
+        totals[1] += seconds
+
+    def finish(self):
+        '''Closes the blocks that were still running when the program stopped.'''
+        end = self.timer()
+        while self.frames:
+            self.leave(end)
+
+    def report(self, program, file=None, limit=HOTSPOT_LIMIT):
+        '''Writes a flat report of the operators followed by the hot spots of the program.'''
+        if file is None:
+            file = sys.stdout
+
+        self.finish()
+
+        def location(offset):
+            return '{}:{}'.format(*locate(program, offset))
+
+        def symbol(offset, length):
+            text = program[offset:offset + length].replace('\n', '\\n')
+            if len(text) > SYMBOL_WIDTH:
+                text = text[:SYMBOL_WIDTH - 3] + '...'
+            return text
+
+        total = sum(seconds for count, seconds in self.operators.values()) or 1.0
+
+        print('Operators:', file=file)
+        print('  {:<20} {:>10} {:>12} {:>10} {:>7}'.format('operator', 'count', 'total ms', 'mean us', 'time'), file=file)
+        for key, (count, seconds) in sorted(self.operators.items(), key=lambda item: -item[1][1]):
+            print('  {:<20} {:>10} {:>12.3f} {:>10.3f} {:>7.1%}'.format(
+                self.names.get(key, key), count, seconds * 1000, seconds / count * 1e6, seconds / total), file=file)
+
+        print('Hot spots:', file=file)
+        print('  {:<10} {:<16} {:>10} {:>12} {:>7} {:>12}'.format('location', 'symbol', 'count', 'self ms', 'time', 'incl ms'), file=file)
+        hotspots = sorted(self.offsets.items(), key=lambda item: -item[1][1])[:limit]
+        for offset, (count, seconds, inclusive, length) in hotspots:
+            print('  {:<10} {:<16} {:>10} {:>12.3f} {:>7.1%} {:>12}'.format(
+                location(offset), symbol(offset, length), count, seconds * 1000, seconds / total,
+                '{:.3f}'.format(inclusive * 1000) if inclusive else ''), file=file)
+
+        if self.blocks:
+            print('Blocks:', file=file)
+            print('  {:<10} {:>10} {:>12} {:>10}'.format('location', 'calls', 'total ms', 'mean ms'), file=file)
+            for offset, (calls, seconds) in sorted(self.blocks.items(), key=lambda item: -item[1][1]):
+                print('  {:<10} {:>10} {:>12.3f} {:>10.3f}'.format(
+                    location(offset) if offset >= 0 else '?', calls, seconds * 1000, seconds / calls * 1000), file=file)
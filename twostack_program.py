@@ -0,0 +1,99 @@
+'''TwoStackProgram
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the Program, the prepared form of a program that running it never changes,
+and the ExecutionState, which holds everything that a single run of a program changes.
+A program can be run by many threads at once or on many inputs in a row,
+each run with a state of its own, without being prepared again.
+'''
+
+import threading
+
+from twostack_io import TwoStackInput, TwoStackOutput
+from twostack_stack import new_stack
+
+class ExecutionState(object):
+    '''Everything that a run of a program changes, a fresh state has empty stacks.
+
+    stack, ztack: the two stacks
+    aliases: the name of each alias slot
+    store: the value of each alias slot, None if the alias has not been defined
+    callstack: the instruction that each running block returns to
+    index: the instruction that the run continues from
+    '''
+
+    def __init__(self):
+        self.stack = new_stack()
+        self.ztack = new_stack()
+        self.aliases = []
+        self.store = []
+        self.callstack = []
+        self.index = 0
+
+    def copy(self):
+        '''Returns a copy of the state that can be run without changing this one.'''
+        state = ExecutionState()
+        state.stack = self.stack[:]
+        state.ztack = self.ztack[:]
+        state.aliases = list(self.aliases)
+        state.store = list(self.store)
+        state.callstack = list(self.callstack)
+        state.index = self.index
+        return state
+
+class Program(object):
+    '''A program prepared by one of the engines.
+
+    engine: the engine class that prepared the program, or any function that creates such an engine
+    source: the source of the program
+    prepared: the form of the program that the engine runs
+
+    Every thread that runs the program gets an engine of its own the first time it does,
+    which is kept for its later runs so that the command manifest is only built once per thread.
+    '''
+
+    def __init__(self, engine, source, prepared):
+        self.engine = engine
+        self.source = source
+        self.prepared = prepared
+        self.local = threading.local()
+
+    def interpreter(self):
+        '''Returns the engine of the current thread, creating it the first time.'''
+        interpreter = getattr(self.local, 'interpreter', None)
+        if interpreter is None:
+            interpreter = self.engine()
+            interpreter.disable_cache()
+            self.local.interpreter = interpreter
+        return interpreter
+
+    def run(self, input=None, output=None, state=None, interpreter=None):
+        '''Runs the program, returning the state that it finished in.
+        The input and output are the same as those of the engine, by default stdin and stdout.
+        The run continues from the state if one is given, which it then changes, otherwise
+        it starts with empty stacks. The engine of the current thread is used unless another
+        one is given, for instance one that has a budget, which is then left in the final state.
+        '''
+        shared = interpreter is None
+        if shared:
+            interpreter = self.interpreter()
+        if state is None:
+            state = ExecutionState()
+
+        if not isinstance(output, TwoStackOutput):
+            output = TwoStackOutput(output)
+        if not isinstance(input, TwoStackInput):
+            input = TwoStackInput(input)
+
+        interpreter.output = output
+        interpreter.input = input
+        interpreter.load_state(state)
+        try:
+            interpreter.run(self.prepared)
+        finally:
+            # the stacks may have been swapped or replaced during the run
+            interpreter.save_state(state)
+            if shared:
+                interpreter.reset()
+
+        return state
@@ -0,0 +1,487 @@
+'''TwoStackServer
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the server which keeps prepared programs and interpreters warm between runs,
+and the client which sends it programs over a Unix domain socket.
+
+A request is a single line of JSON followed by the bytes of its stdin:
+    {"source": "...", "engine": "vm", "stdin": 5}
+    {"path": "/absolute/path/to/program.ts", "stdin": 0}
+    {"stats": true}
+A run request may also carry "limits" with any of max_steps, seconds, max_depth and max_bits,
+these can only tighten the limits that the server applies to every run.
+The response is a sequence of frames, each made of a one byte kind, a four byte length and the payload.
+Output frames (o) carry stdout, message frames (e) carry the error messages of the program,
+and the final frame (d) carries a JSON summary of the run or the statistics of the server.
+'''
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import errno
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+import threading
+import time
+
+from twostack_budget import TwoStackBudget
+from twostack_errors import TwoStackSyntaxError, TwoStackBudgetError
+from twostack_interpreter import TwoStackInterpreter
+from twostack_io import TwoStackInput, TwoStackOutput
+from twostack_transpiler import TwoStackTranspiler
+from twostack_vm import TwoStackVirtualMachine
+
+# the engines that a request can ask for
+ENGINES = {
+    'interpreter': TwoStackInterpreter,
+    'vm': TwoStackVirtualMachine,
+    'transpiler': TwoStackTranspiler
+}
+
+DEFAULT_ENGINE = 'vm'
+
+DEFAULT_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or '/tmp', 'twostack.sock')
+
+# the number of programs that run at the same time
+DEFAULT_WORKERS = 4
+
+# the number of seconds after which a run is stopped unless the server is told otherwise
+DEFAULT_TIME_LIMIT = 60.0
+
+# the limits of a run, named as the arguments of TwoStackBudget
+LIMITS = ('max_steps', 'seconds', 'max_depth', 'max_bits')
+
+# the number of prepared programs that are kept in memory
+PROGRAM_LIMIT = 256
+
+# the number of recent runs that the latency percentiles are taken from
+LATENCY_WINDOW = 1000
+
+LATENCY_PERCENTILES = (50, 90, 99)
+
+# output is sent back to the client in chunks of at most this many bytes
+STREAM_BUFFER_SIZE = 4096
+
+# the number of bytes a worker queues for a client before it waits for them to be sent
+DRAIN_LIMIT = 64 * 1024
+
+# the number of seconds a worker waits for a client to read its output, unless the budget runs out first
+DRAIN_TIMEOUT = 30.0
+
+# ===== Frames ===== #
+FRAME_HEADER = struct.Struct('>cI')
+FRAME_OUTPUT = b'o'
+FRAME_MESSAGES = b'e'
+FRAME_DONE = b'd'
+
+def encode_frame(kind, payload):
+    '''Returns a frame ready to be written to the socket.'''
+    return FRAME_HEADER.pack(kind, len(payload)) + payload
+
+class ClientStalled(Exception):
+    '''Raised from a worker thread when its client has stopped reading the output of its program.'''
+
+class FrameSink(object):
+    '''A binary sink that sends everything written to it to the client as frames.
+    It is written to from a worker thread, the frames are queued on the event loop.
+    Once DRAIN_LIMIT bytes have been queued, the worker waits until the transport has
+    caught up, so a client that reads slowly holds up its program instead of filling memory.
+
+    The worker waits for at most DRAIN_TIMEOUT seconds and never past the deadline of the budget,
+    which cannot stop a program that is stuck in a write. A client that keeps it waiting any longer
+    is disconnected, the run is stopped with a ClientStalled and nothing more is sent.
+    '''
+
+    def __init__(self, loop, writer, kind, budget=None):
+        self.loop = loop
+        self.writer = writer
+        self.kind = kind
+        self.budget = budget
+        self.queued = 0
+        self.stalled = False
+
+    def timeout(self):
+        '''Returns the number of seconds to wait for the client.'''
+        timeout = DRAIN_TIMEOUT
+        budget = self.budget
+        if budget is not None and budget.deadline is not None:
+            timeout = max(0.0, min(timeout, budget.deadline - budget.timer()))
+        return timeout
+
+    def write(self, data):
+        if self.stalled:
+            return
+        if isinstance(data, str):
+            data = data.encode('utf-8', 'replace')
+        if not data:
+            return
+
+        frame = encode_frame(self.kind, data)
+        self.loop.call_soon_threadsafe(self.writer.write, frame)
+        self.queued += len(frame)
+
+        if self.queued >= DRAIN_LIMIT:
+            self.queued = 0
+            drained = asyncio.run_coroutine_threadsafe(self.writer.drain(), self.loop)
+            try:
+                drained.result(self.timeout())
+            except concurrent.futures.TimeoutError:
+                drained.cancel()
+                self.stalled = True
+                self.loop.call_soon_threadsafe(self.writer.transport.abort)
+                raise ClientStalled('the client stopped reading the output')
+
+    def flush(self):
+        pass
+
+class MessageRouter(object):
+    '''Stands in for sys.stdout so that the error messages printed by each worker thread
+    go to the client whose program is running on that thread.
+    '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def target(self):
+        return getattr(self.local, 'sink', None) or self.stream
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def remove_stale_socket(path):
+    '''Removes a socket that was left behind by a server that is no longer running.
+    Raises an OSError if something other than a socket is at the path,
+    or if a server is still listening on it.
+    '''
+    try:
+        info = os.lstat(path)
+    except FileNotFoundError:
+        return
+
+    if not stat.S_ISSOCK(info.st_mode):
+        raise OSError(errno.EEXIST, 'not a socket', path)
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.remove(path)
+        return
+    finally:
+        probe.close()
+
+    raise OSError(errno.EADDRINUSE, 'another server is listening on the socket', path)
+
+def percentile(values, percent):
+    '''Returns the value below which the given percentage of the sorted values fall.'''
+    if not values:
+        return 0.0
+    index = max(0, int(round(percent / 100.0 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+class TwoStackServer(object):
+    '''Runs programs on behalf of clients connected to a Unix domain socket.
+    Every run gets an execution state of its own on the engine that its thread keeps for the program,
+    so no state is shared between runs. Programs run on a pool of threads,
+    at most workers of them at the same time, the others wait in the queue.
+    Every run is limited to a budget made of the limits of the server, tightened by those of its request.
+    A budget of nothing but a time limit, such as the default one, still lets the transpiler translate
+    and the virtual machine memoize, any other limit makes them count steps as the interpreter does.
+    '''
+
+    def __init__(self, path=DEFAULT_SOCKET, workers=DEFAULT_WORKERS, limits=None):
+        self.path = path
+        self.workers = workers
+        self.limits = dict(seconds=DEFAULT_TIME_LIMIT) if limits is None else dict(limits)
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.router = None
+
+        # maps (engine, source) onto the Program
+        self.programs = collections.OrderedDict()
+        self.programs_lock = threading.Lock()
+
+        self.slots = None
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def prepare(self, engine, source):
+        '''Returns a program as a Program, preparing it only the first time it is seen.
+        Raises a TwoStackSyntaxError if the brackets of the program are unbalanced.
+        '''
+        key = (engine, source)
+
+        with self.programs_lock:
+            program = self.programs.get(key)
+            if program is not None:
+                self.programs.move_to_end(key)
+                return program
+
+        program = ENGINES[engine]().compile(source)
+
+        with self.programs_lock:
+            self.programs[key] = program
+            while len(self.programs) > PROGRAM_LIMIT:
+                self.programs.popitem(last=False)
+
+        return program
+
+    def budget(self, request):
+        '''Returns the budget of a run, or None if neither the server nor the request sets any limits.
+        Raises a ValueError if the limits of the request are malformed.
+        '''
+        limits = dict((name, value) for name, value in self.limits.items() if value is not None)
+        requested = request.get('limits') or {}
+        if not isinstance(requested, dict):
+            raise ValueError('limits must be an object')
+
+        for name, value in requested.items():
+            if name not in LIMITS:
+                raise ValueError('unknown limit \'{}\''.format(name))
+            if value is None:
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                raise ValueError('limit \'{}\' must be a non-negative number'.format(name))
+            limits[name] = min(value, limits.get(name, value))
+
+        if not limits:
+            return None
+        return TwoStackBudget(**limits)
+
+    def run_job(self, loop, writer, request, data):
+        '''Runs a single program on a worker thread, returning the summary of the run.'''
+        engine = request.get('engine', DEFAULT_ENGINE)
+        if engine not in ENGINES:
+            return {'status': 'error', 'error': 'unknown engine \'{}\''.format(engine)}
+
+        try:
+            budget = self.budget(request)
+        except ValueError as error:
+            return {'status': 'error', 'error': str(error)}
+
+        messages = FrameSink(loop, writer, FRAME_MESSAGES, budget)
+        self.router.local.sink = messages
+
+        try:
+            if 'path' in request:
+                with open(request['path']) as file:
+                    source = file.read()
+            else:
+                source = request['source']
+
+            try:
+                program = self.prepare(engine, source)
+            except TwoStackSyntaxError as error:
+                interpreter = ENGINES[engine]()
+                interpreter.program = source
+                interpreter.error(error.message, error.offset)
+                return {'status': 'error', 'error': error.message}
+
+            output = TwoStackOutput(FrameSink(loop, writer, FRAME_OUTPUT, budget), STREAM_BUFFER_SIZE, False)
+
+            # the engine belongs to this thread, so the budget only ever limits this run
+            interpreter = program.interpreter()
+            interpreter.set_budget(budget)
+            try:
+                program.run(TwoStackInput(data), output)
+            finally:
+                interpreter.set_budget(None)
+
+        except TwoStackBudgetError as error:
+            return {'status': 'budget', 'error': error.message}
+        except ClientStalled as error:
+            return {'status': 'stalled', 'error': str(error)}
+        except SystemExit:
+            # the debug menu quits the program, not the server
+            pass
+        except Exception as error:
+            return {'status': 'failed', 'error': '{}: {}'.format(type(error).__name__, error)}
+        finally:
+            self.router.local.sink = None
+
+        return {'status': 'ok'}
+
+    def statistics(self):
+        '''Returns the queue depth, the number of runs and the latency percentiles in milliseconds.'''
+        latencies = sorted(self.latencies)
+        return {
+            'queued': self.waiting,
+            'running': self.running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'programs': len(self.programs),
+            'latency_ms': dict(('p{}'.format(percent), percentile(latencies, percent) * 1000)
+                for percent in LATENCY_PERCENTILES)
+        }
+
+    async def handle(self, reader, writer):
+        '''Serves a single request.'''
+        loop = asyncio.get_running_loop()
+
+        try:
+            request = json.loads(await reader.readline())
+            data = await reader.readexactly(int(request.get('stdin', 0)))
+        except (ValueError, asyncio.IncompleteReadError):
+            writer.write(encode_frame(FRAME_DONE, json.dumps({'status': 'error', 'error': 'malformed request'}).encode()))
+            writer.close()
+            return
+
+        if request.get('stats'):
+            writer.write(encode_frame(FRAME_DONE, json.dumps(self.statistics()).encode()))
+            await writer.drain()
+            writer.close()
+            return
+
+        start = time.perf_counter()
+
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        try:
+            summary = await loop.run_in_executor(self.executor, self.run_job, loop, writer, request, data)
+        finally:
+            self.running -= 1
+            self.slots.release()
+
+        # the latency covers the time spent in the queue as well as the run itself
+        summary['seconds'] = time.perf_counter() - start
+        self.latencies.append(summary['seconds'])
+        self.completed += 1
+        self.failed += summary['status'] != 'ok'
+
+        try:
+            writer.write(encode_frame(FRAME_DONE, json.dumps(summary).encode()))
+            await writer.drain()
+            writer.close()
+        except ConnectionError:
+            pass
+
+    async def serve(self):
+        '''Listens on the socket until the server is cancelled.
+        Raises an OSError if the path is taken by anything but the socket of a server that has stopped.
+        '''
+        remove_stale_socket(self.path)
+        self.slots = asyncio.Semaphore(self.workers)
+
+        # error messages are printed by the interpreters, route them to the right client
+        self.router = MessageRouter(sys.stdout)
+        sys.stdout = self.router
+
+        server = await asyncio.start_unix_server(self.handle, self.path)
+
+        # stop cleanly when the server is terminated, so that the socket is removed
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            sys.stdout = self.router.stream
+            self.executor.shutdown()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+async def request(path, message, data=b'', output=None, messages=None):
+    '''Sends a request to the server, writing the streamed output and messages as they arrive.
+    Returns the final summary sent by the server.
+    '''
+    reader, writer = await asyncio.open_unix_connection(path)
+
+    message = dict(message, stdin=len(data))
+    writer.write(json.dumps(message).encode() + b'\n' + data)
+    await writer.drain()
+
+    try:
+        while True:
+            kind, length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+            payload = await reader.readexactly(length)
+
+            if kind == FRAME_DONE:
+                return json.loads(payload)
+            elif kind == FRAME_OUTPUT and output is not None:
+                output.write(payload)
+                output.flush()
+            elif kind == FRAME_MESSAGES and messages is not None:
+                messages.write(payload.decode('utf-8', 'replace'))
+                messages.flush()
+    finally:
+        writer.close()
+
+def main():
+    '''The main entrypoint for the server and its client.'''
+    parser = argparse.ArgumentParser(description='Keeps TwoStack interpreters warm behind a Unix domain socket.')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='the path of the socket (default %(default)s)')
+    commands = parser.add_subparsers(dest='command')
+
+    serve = commands.add_parser('serve', help='run the server')
+    serve.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+        help='the number of programs that run at the same time (default %(default)s)')
+    serve.add_argument('--max-steps', type=int, help='stop any run after this many steps')
+    serve.add_argument('--time-limit', type=float, metavar='SECONDS', default=DEFAULT_TIME_LIMIT,
+        help='stop any run after this many seconds, 0 turns the limit off (default %(default)s)')
+    serve.add_argument('--max-elements', type=int, help='stop any run once its stacks hold this many elements together')
+    serve.add_argument('--max-bits', type=int, help='stop any run before it computes an integer larger than this')
+
+    run = commands.add_parser('run', help='run a program on the server, stdin is passed on to it')
+    run.add_argument('filename', help='the program to run')
+    run.add_argument('--engine', choices=sorted(ENGINES), default=DEFAULT_ENGINE,
+        help='the engine that runs the program (default %(default)s)')
+    run.add_argument('--max-steps', type=int, help='stop the program after this many steps')
+    run.add_argument('--time-limit', type=float, metavar='SECONDS', help='stop the program after this many seconds')
+    run.add_argument('--max-elements', type=int, help='stop the program once its stacks hold this many elements together')
+    run.add_argument('--max-bits', type=int, help='stop the program before it computes an integer larger than this')
+
+    commands.add_parser('stats', help='print the queue depth and latency percentiles of the server')
+
+    options = parser.parse_args()
+
+    if options.command == 'serve':
+        # the debug menu would otherwise wait for input on the terminal of the server
+        sys.stdin = open(os.devnull)
+        try:
+            limits = dict(zip(LIMITS, (options.max_steps, options.time_limit or None, options.max_elements, options.max_bits)))
+            asyncio.run(TwoStackServer(options.socket, options.workers, limits).serve())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+        except OSError as error:
+            print('error: cannot serve on {}: {}'.format(options.socket, error.strerror or error), file=sys.stderr)
+            sys.exit(1)
+
+    elif options.command == 'run':
+        message = {'path': os.path.abspath(options.filename), 'engine': options.engine}
+        limits = dict(zip(LIMITS, (options.max_steps, options.time_limit, options.max_elements, options.max_bits)))
+        if any(value is not None for value in limits.values()):
+            message['limits'] = limits
+        data = b'' if sys.stdin.isatty() else sys.stdin.buffer.read()
+        summary = asyncio.run(request(options.socket, message, data, sys.stdout.buffer, sys.stdout))
+        if summary['status'] not in ('ok', 'error'):
+            print(summary.get('error', summary['status']), file=sys.stderr)
+        sys.exit(0 if summary['status'] == 'ok' else 1)
+
+    elif options.command == 'stats':
+        print(json.dumps(asyncio.run(request(options.socket, {'stats': True})), indent=2))
+
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+'''TwoStackSnapshot
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the snapshots which store the state of a run in a compact binary form, so that a long run
+can be resumed after it was stopped, and the checkpoint which takes them while a program runs.
+
+A snapshot is made of the header, the engine that took it, the version of the interpreter,
+the digest of the program source,
+the step count, the positions of the input and output, the instruction index, both stacks,
+the callstack and the aliases. Compact stacks are stored as packed 64 bit integers, stacks that
+were promoted to Python integers and every other number are stored as variable length integers,
+so integers of any size survive a snapshot.
+'''
+
+import hashlib
+import os
+import sys
+import time
+from array import array
+
+from twostack_cache import interpreter_version
+from twostack_errors import TwoStackSnapshotError
+from twostack_program import ExecutionState
+from twostack_source import source_chunks
+from twostack_stack import TYPECODE, is_compact
+
+# the first bytes of every snapshot
+MAGIC = b'2STK'
+
+# increase this whenever the layout of snapshots changes
+SNAPSHOT_FORMAT = 2
+
+# the length of the program digest
+DIGEST_SIZE = 32
+
+# the kinds of stack
+PACKED_STACK = 0
+PROMOTED_STACK = 1
+
+# the number of seconds between snapshots when neither interval is given
+DEFAULT_CHECKPOINT_SECONDS = 60
+
+def program_digest(program):
+    '''Returns the digest that ties a snapshot to the source of its program.'''
+    digest = hashlib.sha256()
+    for text in source_chunks(program):
+        digest.update(text.encode('utf-8', 'surrogatepass'))
+    return digest.digest()
+
+class SnapshotWriter(object):
+    '''Builds the bytes of a snapshot.'''
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def unsigned(self, value):
+        '''Writes a non-negative integer of any size, seven bits per byte.'''
+        while value > 0x7f:
+            self.data.append((value & 0x7f) | 0x80)
+            value >>= 7
+        self.data.append(value)
+
+    def signed(self, value):
+        '''Writes an integer of any size, the sign is moved into the lowest bit.'''
+        self.unsigned(value * 2 if value >= 0 else -value * 2 - 1)
+
+    def text(self, value):
+        '''Writes a string along with its length.'''
+        encoded = value.encode('utf-8', 'surrogatepass')
+        self.unsigned(len(encoded))
+        self.data += encoded
+
+    def stack(self, stack):
+        '''Writes a stack, keeping it compact if it is.'''
+        if is_compact(stack):
+            values = array(TYPECODE, stack)
+            if sys.byteorder == 'big':
+                values.byteswap()
+            self.data.append(PACKED_STACK)
+            self.unsigned(len(values))
+            self.data += values.tobytes()
+        else:
+            self.data.append(PROMOTED_STACK)
+            self.unsigned(len(stack))
+            for value in stack:
+                self.signed(value)
+
+class SnapshotReader(object):
+    '''Reads the bytes of a snapshot back, raising a TwoStackSnapshotError if they are cut short.'''
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def take(self, count):
+        '''Reads a number of bytes.'''
+        end = self.position + count
+        if end > len(self.data):
+            raise TwoStackSnapshotError('the snapshot is incomplete')
+        chunk = self.data[self.position:end]
+        self.position = end
+        return chunk
+
+    def byte(self):
+        '''Reads a single byte.'''
+        return self.take(1)[0]
+
+    def unsigned(self):
+        '''Reads a non-negative integer.'''
+        value = 0
+        shift = 0
+        while True:
+            byte = self.byte()
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                return value
+
+    def signed(self):
+        '''Reads an integer.'''
+        value = self.unsigned()
+        return value >> 1 if value & 1 == 0 else -((value + 1) >> 1)
+
+    def text(self):
+        '''Reads a string.'''
+        return bytes(self.take(self.unsigned())).decode('utf-8', 'surrogatepass')
+
+    def stack(self):
+        '''Reads a stack, which is compact again if it was compact when it was written.'''
+        kind = self.byte()
+        count = self.unsigned()
+
+        if kind == PACKED_STACK:
+            values = array(TYPECODE)
+            values.frombytes(self.take(count * values.itemsize))
+            if sys.byteorder == 'big':
+                values.byteswap()
+            return values
+
+        if kind == PROMOTED_STACK:
+            return [self.signed() for _ in range(count)]
+
+        raise TwoStackSnapshotError('the snapshot holds an unknown kind of stack')
+
+class Snapshot(object):
+    '''The state of a run between two instructions, from which it can be resumed.
+
+    engine: the name of the engine class that took the snapshot, instruction indexes are only
+        meaningful to the same engine
+    digest: the digest of the program source
+    version: the version of the interpreter that took the snapshot, see interpreter_version
+    state: the ExecutionState of the run
+    input_position: the number of characters that had been read
+    output_position: the position of the output stream, or the number of bytes written if it had none
+    steps: the number of steps counted by the budget of the run
+    '''
+
+    def __init__(self, engine, digest, state, input_position=0, output_position=0, steps=0, version=None):
+        if version is None:
+            version = interpreter_version()
+
+        self.engine = engine
+        self.digest = digest
+        self.version = version
+        self.state = state
+        self.input_position = input_position
+        self.output_position = output_position
+        self.steps = steps
+
+    def fork(self):
+        '''Returns a copy of the state to continue from, every fork runs without changing the others.
+        A fork continues with whatever input and output it is run with.
+        '''
+        return self.state.copy()
+
+    def check(self, interpreter, program):
+        '''Raises a TwoStackSnapshotError unless the snapshot can be resumed by the engine with the program source.
+        Instruction indexes may mean something else to another version of the interpreter,
+        so the snapshot must have been taken by this very version.
+        '''
+        if self.version != interpreter_version():
+            raise TwoStackSnapshotError('the snapshot was taken by another version of the interpreter')
+        if self.engine != type(interpreter).__name__:
+            raise TwoStackSnapshotError('the snapshot was taken by {}'.format(self.engine))
+        if self.digest != program_digest(program):
+            raise TwoStackSnapshotError('the snapshot was taken of a different program')
+
+    def encode(self):
+        '''Returns the snapshot as bytes.'''
+        state = self.state
+        writer = SnapshotWriter()
+        writer.data += MAGIC
+        writer.unsigned(SNAPSHOT_FORMAT)
+        writer.text(self.engine)
+        writer.text(self.version)
+        writer.data += self.digest
+
+        for value in (self.steps, self.input_position, self.output_position, state.index):
+            writer.unsigned(value)
+
+        writer.stack(state.stack)
+        writer.stack(state.ztack)
+
+        writer.unsigned(len(state.callstack))
+        for value in state.callstack:
+            writer.unsigned(value)
+
+        writer.unsigned(len(state.aliases))
+        for name, value in zip(state.aliases, state.store):
+            writer.text(name)
+            if value is None:
+                writer.data.append(0)
+            else:
+                writer.data.append(1)
+                writer.signed(value)
+
+        return bytes(writer.data)
+
+    def save(self, filename):
+        '''Writes the snapshot to a file, which is replaced in one step so that it is never left half written.'''
+        temporary = filename + '.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(self.encode())
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, filename)
+
+def decode_snapshot(data):
+    '''Reads a snapshot from bytes.
+    Raises a TwoStackSnapshotError if the bytes are not a snapshot of this format.
+    '''
+    reader = SnapshotReader(memoryview(data))
+    if bytes(reader.take(len(MAGIC))) != MAGIC:
+        raise TwoStackSnapshotError('not a snapshot')
+    if reader.unsigned() != SNAPSHOT_FORMAT:
+        raise TwoStackSnapshotError('the snapshot was written by another version')
+
+    engine = reader.text()
+    version = reader.text()
+    digest = bytes(reader.take(DIGEST_SIZE))
+    steps, input_position, output_position, index = [reader.unsigned() for _ in range(4)]
+
+    state = ExecutionState()
+    state.index = index
+    state.stack = reader.stack()
+    state.ztack = reader.stack()
+    state.callstack = [reader.unsigned() for _ in range(reader.unsigned())]
+
+    for _ in range(reader.unsigned()):
+        state.aliases.append(reader.text())
+        state.store.append(reader.signed() if reader.byte() else None)
+
+    return Snapshot(engine, digest, state, input_position, output_position, steps, version)
+
+def load_snapshot(filename):
+    '''Reads a snapshot from a file.
+    Raises a TwoStackSnapshotError if the file is not a snapshot of this format.
+    '''
+    with open(filename, 'rb') as file:
+        return decode_snapshot(file.read())
+
+def take_snapshot(interpreter, steps=0, digest=None, version=None):
+    '''Returns a snapshot of an interpreter between two instructions, writing out its buffered output first.
+    The output position is where the output stream stands, so that anything else printed to it,
+    such as warnings, is kept when the output is rewound.
+    The digest of the program and the version of the interpreter are computed unless they are given.
+    '''
+    output_position = interpreter.output.tell()
+    if digest is None:
+        digest = program_digest(interpreter.program)
+
+    return Snapshot(type(interpreter).__name__, digest, interpreter.save_state(),
+        interpreter.input.tell(), output_position, steps, version)
+
+def rewind_output(stream, position):
+    '''Cuts a file that the output of a run went to back to where a snapshot was taken,
+    dropping whatever was written after it. Streams that cannot be rewound are left alone.
+    Returns whether the stream was rewound.
+    '''
+    stream = getattr(stream, 'buffer', stream)
+    try:
+        if not stream.seekable():
+            return False
+        stream.flush()
+        stream.truncate(position)
+        stream.seek(position)
+    except (AttributeError, OSError, ValueError):
+        return False
+    return True
+
+class TwoStackCheckpoint(object):
+    '''Takes snapshots of a run at an interval of steps, seconds or both and saves them to a file.
+    The checkpoint is driven by the budget of the run, which looks at it every time it checks its limits.
+    By default a snapshot is taken every DEFAULT_CHECKPOINT_SECONDS seconds.
+    '''
+
+    def __init__(self, filename, steps=None, seconds=None, timer=time.monotonic):
+        if steps is None and seconds is None:
+            seconds = DEFAULT_CHECKPOINT_SECONDS
+
+        self.filename = filename
+        self.steps = None if steps is None else max(1, steps)
+        self.seconds = seconds
+        self.timer = timer
+
+        self.next_step = None
+        self.next_time = None
+        self.snapshots = 0
+
+        # the digest is only computed again when the program changes
+        self.program = None
+        self.digest = None
+
+        # the version of the interpreter is only computed once
+        self.version = None
+
+    def start(self, steps=0):
+        '''Starts the intervals of a run that has already taken a number of steps.'''
+        self.next_step = None if self.steps is None else steps + self.steps
+        self.next_time = None
+        if self.seconds is not None:
+            self.next_time = self.timer() + self.seconds
+
+    def check(self, interpreter, steps):
+        '''Saves a snapshot of the interpreter if one of the intervals has passed.'''
+        now = None
+        due = self.next_step is not None and steps >= self.next_step
+        if self.next_time is not None:
+            now = self.timer()
+            due = due or now >= self.next_time
+
+        if not due:
+            return
+
+        if interpreter.program is not self.program:
+            self.program = interpreter.program
+            self.digest = program_digest(self.program)
+
+        if self.version is None:
+            self.version = interpreter_version()
+
+        take_snapshot(interpreter, steps, self.digest, self.version).save(self.filename)
+        self.snapshots += 1
+
+        if self.steps is not None:
+            self.next_step = steps + self.steps
+        if self.seconds is not None:
+            self.next_time = now + self.seconds
@@ -0,0 +1,219 @@
+'''TwoStackSource
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the loader which keeps the source of very large programs in a memory map of their file.
+The source is decoded one chunk at a time while it is lexed, so that only the prepared form of
+the program stays in memory. Errors still show their context, because any part of the source
+can be decoded again from the mapping.
+'''
+
+import mmap
+import os
+from array import array
+from bisect import bisect_right
+
+# files smaller than this are simply read into a string
+MAP_THRESHOLD = 16 * 1024 * 1024
+
+# the number of bytes decoded at a time
+CHUNK_SIZE = 1024 * 1024
+
+# chunks always hold at least one whole character
+MIN_CHUNK_SIZE = 16
+
+def load_source(filename, threshold=MAP_THRESHOLD):
+    '''Returns the source of a program file, as a TwoStackSource if the file is at least
+    threshold bytes long and as a string otherwise.
+    '''
+    if os.path.getsize(filename) < threshold:
+        with open(filename) as file:
+            return file.read()
+    return TwoStackSource(filename)
+
+def locate(program, offset):
+    '''Returns the line and column of an offset in a program, whether it is a string or a TwoStackSource.'''
+    line = program.count('\n', 0, offset) + 1
+    column = offset - (program.rfind('\n', 0, offset) + 1) + 1
+    return line, column
+
+def source_chunks(program):
+    '''Returns the text of a program in pieces, whether it is a string or a TwoStackSource.'''
+    if isinstance(program, str):
+        return (program,)
+    return program.chunks()
+
+class TwoStackSource(object):
+    '''The source of a program, kept in a memory map of its UTF-8 encoded file.
+
+    Line breaks are translated to '\\n' just as they are for files read into a string,
+    and offsets count characters, so that tokens point at the same places either way.
+    The source offers the parts of the string interface that the engines use to report
+    errors and hot spots: len, indexing, slicing, iteration, find, rfind and count.
+    The first full pass over the chunks records where each one begins, anything that
+    needs an offset before that makes the pass first.
+    '''
+
+    def __init__(self, filename, chunk_size=CHUNK_SIZE):
+        self.filename = filename
+        self.chunk_size = max(MIN_CHUNK_SIZE, chunk_size)
+
+        # the character offset and the byte position at which every chunk begins
+        self.starts = None
+        self.positions = None
+        self.length = None
+
+        self.open()
+
+    def open(self):
+        '''Maps the file, which is never read into memory as a whole.'''
+        with open(self.filename, 'rb') as file:
+            # empty files cannot be mapped, but there is nothing to map anyway
+            if os.fstat(file.fileno()).st_size:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.map = b''
+        self.size = len(self.map)
+
+    def close(self):
+        '''Unmaps the file.'''
+        if self.size:
+            self.map.close()
+
+    def __getstate__(self):
+        # the mapping cannot be pickled, the file is mapped again instead
+        state = self.__dict__.copy()
+        del state['map']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def boundary(self, end):
+        '''Moves the end of a chunk back so that it splits neither a character nor a \\r\\n pair.'''
+        if end >= self.size:
+            return self.size
+
+        data = self.map
+        while data[end] & 0xc0 == 0x80:
+            end -= 1
+        if data[end - 1] == 0x0d and data[end] == 0x0a:
+            end -= 1
+        return end
+
+    def decode(self, position, end):
+        '''Decodes the bytes between two chunk boundaries.'''
+        text = self.map[position:end].decode('utf-8')
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        return text
+
+    def chunks(self):
+        '''Yields the text of the source one chunk at a time.'''
+        if self.starts is not None:
+            for chunk in range(len(self.starts)):
+                yield self.chunk(chunk)
+            return
+
+        starts = array('q')
+        positions = array('q')
+        offset = 0
+        position = 0
+
+        while position < self.size:
+            end = self.boundary(position + self.chunk_size)
+            text = self.decode(position, end)
+            starts.append(offset)
+            positions.append(position)
+            offset += len(text)
+            position = end
+            yield text
+
+        self.starts = starts
+        self.positions = positions
+        self.length = offset
+
+    def index(self):
+        '''Makes sure that the beginning of every chunk is known.'''
+        if self.starts is None:
+            for _ in self.chunks():
+                pass
+
+    def chunk(self, chunk):
+        '''Returns the text of a single chunk.'''
+        end = self.positions[chunk + 1] if chunk + 1 < len(self.positions) else self.size
+        return self.decode(self.positions[chunk], end)
+
+    def locate(self, offset):
+        '''Returns the chunk that holds the character at an offset.'''
+        return max(0, bisect_right(self.starts, offset) - 1)
+
+    def __len__(self):
+        self.index()
+        return self.length
+
+    def __iter__(self):
+        for text in self.chunks():
+            yield from text
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError('source index out of range')
+            return self[key:key + 1]
+
+        start, stop, step = key.indices(len(self))
+        if start >= stop:
+            return ''
+
+        first = self.locate(start)
+        last = self.locate(stop - 1)
+        text = ''.join(self.chunk(chunk) for chunk in range(first, last + 1))
+        base = self.starts[first]
+        return text[start - base:stop - base:step]
+
+    def find(self, char, start=0, end=None):
+        '''Returns the lowest offset of a character between start and end, or -1,
+        decoding one chunk at a time.
+        '''
+        start, end, _ = slice(start, end).indices(len(self))
+        if start >= end:
+            return -1
+
+        for chunk in range(self.locate(start), self.locate(end - 1) + 1):
+            base = self.starts[chunk]
+            index = self.chunk(chunk).find(char, max(0, start - base), end - base)
+            if index != -1:
+                return base + index
+        return -1
+
+    def rfind(self, char, start=0, end=None):
+        '''Returns the highest offset of a character between start and end, or -1,
+        decoding one chunk at a time.
+        '''
+        start, end, _ = slice(start, end).indices(len(self))
+        if start >= end:
+            return -1
+
+        for chunk in range(self.locate(end - 1), self.locate(start) - 1, -1):
+            base = self.starts[chunk]
+            index = self.chunk(chunk).rfind(char, max(0, start - base), end - base)
+            if index != -1:
+                return base + index
+        return -1
+
+    def count(self, char, start=0, end=None):
+        '''Returns the number of times a character occurs between start and end,
+        decoding one chunk at a time.
+        '''
+        start, end, _ = slice(start, end).indices(len(self))
+        total = 0
+        for chunk in range(self.locate(start), self.locate(end) + 1):
+            base = self.starts[chunk]
+            if base >= end:
+                break
+            text = self.chunk(chunk)
+            total += text.count(char, max(0, start - base), end - base)
+        return total
@@ -0,0 +1,137 @@
+'''TwoStackStack
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the helpers for the stacks that hold the values of a program.
+A stack is an array of machine integers until a value no longer fits into one,
+after which it is a list of Python integers. Both support the same operations.
+
+The bulk operations hand large compact stacks to numpy when it is installed.
+'''
+
+import math
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    # numpy only makes the bulk operations faster, they work the same without it
+    numpy = None
+
+# the typecode of the machine integers stored on a compact stack
+TYPECODE = 'q'
+
+# the default number of elements a single stack may hold
+DEFAULT_MAX_DEPTH = 1 << 24
+
+# the number of elements that are searched first when looking for the topmost 0
+SEARCH_SIZE = 64
+
+# the number of elements from which the bulk operations are handed to numpy
+VECTOR_SIZE = 256
+
+# the magnitude from which a sum may no longer fit into a machine integer
+MACHINE_LIMIT = 1 << 63
+
+def new_stack(values=()):
+    '''Creates a compact stack holding the values.'''
+    return array(TYPECODE, values)
+
+def is_compact(stack):
+    '''Checks whether a stack still holds machine integers.'''
+    return isinstance(stack, array)
+
+def promote(stack):
+    '''Returns a stack with the same values that can hold integers of any size.'''
+    return list(stack)
+
+def view(stack, start, end):
+    '''Returns a numpy array sharing the elements of a compact stack from start to end,
+    or None if numpy is not installed, the stack holds Python integers or the part is small.
+    The stack cannot be resized until the view is gone.
+    '''
+    if numpy is None or not is_compact(stack) or end - start < VECTOR_SIZE:
+        return None
+    return numpy.frombuffer(stack, numpy.int64, end - start, start * stack.itemsize)
+
+def find_zero(stack, end=None):
+    '''Returns the index of the topmost 0 below end on the stack or -1 if there is none.
+    The stack is searched from the top in chunks of doubling size.
+    '''
+    if end is None:
+        end = len(stack)
+    size = SEARCH_SIZE
+
+    while end > 0:
+        start = max(0, end - size)
+        values = view(stack, start, end)
+        if values is not None:
+            zeros = numpy.flatnonzero(values == 0)
+            if len(zeros):
+                return start + int(zeros[-1])
+        else:
+            chunk = stack[start:end]
+            if 0 in chunk:
+                chunk.reverse()
+                return end - 1 - chunk.index(0)
+        end = start
+        size *= 2
+
+    return -1
+
+def transfer(source, target):
+    '''Moves every element above the topmost 0 of source onto target.
+    This has the same result as crosspopping them one at a time.
+    Returns the number of elements that were moved.
+    '''
+    start = find_zero(source) + 1
+    moved = source[start:]
+    moved.reverse()
+    del source[start:]
+    target.extend(moved)
+    return len(moved)
+
+def total(stack, start, end):
+    '''Returns the sum of the elements of a stack from start to end.'''
+    values = view(stack, start, end)
+
+    # numpy wraps around on overflow, so it is only used when the sum is certain to fit
+    if values is not None and max(-int(values.min()), int(values.max())) * len(values) < MACHINE_LIMIT:
+        return int(values.sum())
+
+    return sum(stack[start:end])
+
+def reduce_loop(stack, multiply=False, limit=None):
+    '''Has the same result as running [\\+\\] on the stack, or [\\*\\] if multiply is set.
+    The loop folds the top element and the elements beneath the second one, down to the topmost 0,
+    into the second element. If there is no 0 the bottom element ends up on top, so that the rest
+    of the loop fails just like it would have. The stack is left alone if an OverflowError is raised.
+    Returns the number of elements that were folded, or None if that would be more than the limit,
+    in which case the stack is left alone as well.
+    '''
+    if len(stack) < 3 or stack[-1] == 0:
+        return 0
+
+    end = len(stack) - 2
+    zero = find_zero(stack, end)
+    start = zero + 1 if zero >= 0 else 1
+    if limit is not None and len(stack) - start > limit:
+        return None
+
+    if multiply:
+        result = math.prod(stack[start:])
+    else:
+        result = total(stack, start, len(stack))
+
+    below = stack[start - 1]
+    stack[start - 1] = result
+    stack[start] = below
+    count = len(stack) - start
+    del stack[start + 1:]
+    return count
+
+def push_range(stack, count):
+    '''Pushes every value from count - 1 down to 0, the same as running [:1-] with count on top.'''
+    if numpy is not None and is_compact(stack) and count >= VECTOR_SIZE:
+        stack.frombytes(numpy.arange(count - 1, -1, -1, dtype=numpy.int64).tobytes())
+    else:
+        stack.extend(range(count - 1, -1, -1))
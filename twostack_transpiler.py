@@ -0,0 +1,527 @@
+'''TwoStackTranspiler
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the transpiler which translates a TwoStack program into Python source,
+and the interpreter which runs the translated programs.
+Loops become while loops and blocks become nested functions. The values pushed by
+straight line code are kept in local variables until the stack is needed as a whole.
+'''
+
+import marshal
+import threading
+from collections import namedtuple
+
+from twostack_errors import TwoStackError, TwoStackBudgetError
+from twostack_feature_provider import MINIMUM
+from twostack_interpreter import TwoStackInterpreter
+from twostack_lexer import lex, ALIAS_DEF, ALIAS_RECALL, INTEGER, STRING, DEBUG
+from twostack_parser import strip_tokens, resolve_aliases, fold_constants
+
+# the number of nested blocks after which the rest of the program is interpreted,
+# every nested block takes up two frames of the Python stack
+CALL_LIMIT = 200
+
+# the expression of each operator that pops two elements and pushes one
+# a is the second element and b is the top element
+BINARY_OPERATORS = {
+    '+': '{a} + {b}',
+    '-': '{a} - {b}',
+    '*': '{a} * {b}',
+    '/': '{a} // {b}',
+    '%': '{a} % {b}',
+    '**': '{a} ** {b}',
+    '=': 'int({b} == {a})',
+    '<': 'int({a} < {b})',
+    '>': 'int({a} > {b})',
+    '&': 'int({b} and {a})',
+    '|': 'int({b} or {a})',
+    '^': '{b} ^ {a}'
+}
+
+# a loop or a block of a program
+# key: the opening bracket
+# index, end: the token indexes of the opening and closing brackets
+# body: the token indexes and regions inside of the brackets
+Region = namedtuple('Region', ['key', 'index', 'end', 'body'])
+
+class ProgramStopped(Exception):
+    '''Raised by translated code to stop the program once an error has been reported.'''
+
+class Fallback(Exception):
+    '''Raised by translated code to hand the rest of the program over to the interpreter.'''
+
+class Translation(object):
+    '''A program that has been translated into Python.
+
+    program: the source of the program
+    tokens, jumps, offsets, aliases: the parsed program, these are interpreted
+        whenever the translated code cannot continue
+    source: the generated Python source or None if the program could not be translated
+    code: the compiled source
+    load: binds the generated code to an interpreter and returns the function that runs it
+    '''
+
+    def __init__(self, program):
+        self.program = program
+        self.tokens = []
+        self.jumps = []
+        self.offsets = []
+        self.aliases = []
+        self.source = None
+        self.code = None
+        self.load = None
+
+    def __getstate__(self):
+        # functions cannot be pickled, but code objects can be marshalled
+        state = dict(self.__dict__)
+        del state['load']
+        if self.code is not None:
+            state['code'] = marshal.dumps(self.code)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load = None
+        if self.code is not None:
+            self.code = marshal.loads(self.code)
+            self.load = define(self.code)
+
+def build_tree(tokens, jumps):
+    '''Nests the loops and blocks of a program.
+    Returns a list of token indexes and regions,
+    or None if a loop and a block overlap without one being inside of the other.
+    '''
+    tree = []
+    regions = [(None, -1, tree)]
+
+    for index, token in enumerate(tokens):
+        key = token.key
+
+        if key == '[' or key == '{':
+            regions.append((key, index, []))
+
+        elif key == ']' or key == '}':
+            opened, start, body = regions.pop()
+            if start < 0 or jumps[start] != index:
+                return None
+            regions[-1][2].append(Region(opened, start, index, body))
+
+        else:
+            regions[-1][2].append(index)
+
+    return tree
+
+class FunctionWriter(object):
+    '''Writes the Python source of the function that runs the main program or a single block.
+    The values that are pushed are kept in a list of Python expressions and only written
+    to the stack when control flow or an error needs the stack to be complete.
+    '''
+
+    def __init__(self, tokens, name, blocks):
+        self.tokens = tokens
+        self.blocks = blocks
+        self.lines = ['def {}():'.format(name)]
+        self.depth = 1
+
+        # the expressions of the values that belong on top of the stack
+        self.values = []
+
+        # the number of elements that are certainly on the stack
+        self.known = 0
+
+        self.temporaries = 0
+        self.reload()
+
+    def line(self, text):
+        '''Adds a line at the current indentation.'''
+        self.lines.append('    ' * self.depth + text)
+
+    def temporary(self):
+        '''Returns the name of a new local variable.'''
+        self.temporaries += 1
+        return 't{}'.format(self.temporaries)
+
+    def reload(self):
+        '''Fetches the stacks again after they may have been changed elsewhere.'''
+        self.line('stack = vm.stack')
+        self.line('ztack = vm.ztack')
+        self.known = 0
+
+    def flush_code(self):
+        '''Returns the statement that writes the pending values to the stack.'''
+        if len(self.values) == 1:
+            return 'stack.append({})'.format(self.values[0])
+        return 'stack += ({},)'.format(', '.join(self.values))
+
+    def flush(self):
+        '''Writes the pending values to the stack.'''
+        if self.values:
+            self.line(self.flush_code())
+            self.known += len(self.values)
+            self.values = []
+
+    def fail(self, index, message):
+        '''Stops the program with an error at the token, leaving the stack as it would be.'''
+        if self.values:
+            self.line(self.flush_code())
+        self.line('fail({}, {!r})'.format(index, message))
+
+    def require(self, count, index):
+        '''Makes sure that there are enough elements for the operator at the token.'''
+        missing = count - len(self.values)
+        if missing > self.known:
+            self.line('if len(stack) < {}:'.format(missing))
+            self.depth += 1
+            self.fail(index, 'not enough elements on the stack')
+            self.depth -= 1
+            self.known = missing
+
+    def pop(self):
+        '''Removes the top value, returning its expression.'''
+        if self.values:
+            return self.values.pop()
+
+        name = self.temporary()
+        self.line('{} = stack.pop()'.format(name))
+        self.known = max(0, self.known - 1)
+        return name
+
+    def peek(self):
+        '''Returns the expression of the top value.'''
+        if self.values:
+            return self.values[-1]
+
+        name = self.temporary()
+        self.line('{} = stack[-1]'.format(name))
+        return name
+
+    def push(self, expression):
+        '''Pushes the value of an expression, it is evaluated into a local variable first.'''
+        name = self.temporary()
+        self.line('{} = {}'.format(name, expression))
+        self.values.append(name)
+
+    def write_body(self, body):
+        '''Writes the code of a list of token indexes and regions.'''
+        for item in body:
+            if isinstance(item, Region):
+                if item.key == '[':
+                    self.write_loop(item)
+                else:
+                    # the block itself becomes a function of its own
+                    self.values.append(str(self.tokens[item.index].offset))
+                    self.blocks.append(item)
+            else:
+                self.write_token(item)
+
+    def write_loop(self, region):
+        '''Writes a loop as a while loop.'''
+        self.flush()
+        self.line('while stack and stack[-1]:')
+        self.depth += 1
+
+        # the loop is only entered when there is something on the stack
+        self.known = 1
+        self.write_body(region.body)
+        self.flush()
+
+        self.line('if len(stack) > max_depth or len(ztack) > max_depth:')
+        self.line('    depth({})'.format(region.end))
+        self.depth -= 1
+        self.known = 0
+
+    def write_call(self, index):
+        '''Writes a call to the block whose offset is on top of the stack.'''
+        self.flush()
+        self.line('call({})'.format(index))
+        self.reload()
+
+    def write_token(self, index):
+        '''Writes the code of a single operator.'''
+        token = self.tokens[index]
+        key = token.key
+
+        if key == DEBUG:
+            self.flush()
+            self.line('vm.index = {}'.format(index))
+            self.line('vm.debug()')
+            return
+
+        if key not in MINIMUM:
+            self.fail(index, 'unknown symbol \'{}\''.format(token.value))
+            return
+
+        self.require(MINIMUM[key], index)
+
+        if key == INTEGER:
+            self.values.append(repr(token.value))
+
+        elif key == STRING:
+            codes = token.value
+            if codes:
+                self.flush()
+                self.line('stack += {!r}'.format(codes))
+                self.known += len(codes)
+
+        elif key == ALIAS_RECALL:
+            self.flush()
+            name = self.temporary()
+            self.line('{} = store[{}]'.format(name, token.value))
+            self.line('if {} is None:'.format(name))
+            self.line('    warn({}, \'alias does not exist\')'.format(index))
+            self.line('else:')
+            self.line('    stack.append({})'.format(name))
+
+        elif key == ALIAS_DEF:
+            if token.value < 0:
+                self.line('warn({}, \'alias definition cannot be empty\')'.format(index))
+            else:
+                self.line('store[{}] = {}'.format(token.value, self.pop()))
+
+        elif key == '$':
+            self.flush()
+            self.line('stack, ztack = ztack, stack')
+            self.line('vm.stack = stack')
+            self.line('vm.ztack = ztack')
+            self.known = 0
+
+        elif key == ':':
+            self.values.append(self.peek())
+
+        elif key == ';':
+            if self.values:
+                self.values.pop()
+            else:
+                self.line('stack.pop()')
+                self.known = max(0, self.known - 1)
+
+        elif key == '\\':
+            top = self.pop()
+            second = self.pop()
+            self.values += [top, second]
+
+        elif key == '\\\\':
+            top = self.pop()
+            second = self.pop()
+            third = self.pop()
+            self.values += [top, second, third]
+
+        elif key == '`':
+            self.line('ztack.append({})'.format(self.pop()))
+
+        elif key == '.':
+            self.line('write({})'.format(self.peek()))
+
+        elif key == ',':
+            self.push('read()')
+
+        elif key == '!':
+            self.push('int(not {})'.format(self.pop()))
+
+        elif key in BINARY_OPERATORS:
+            top = self.pop()
+            second = self.pop()
+            self.push(BINARY_OPERATORS[key].format(a=second, b=top))
+
+        elif key == '@':
+            self.write_call(index)
+
+        elif key == '?':
+            condition = self.pop()
+            self.flush()
+            self.line('if {}:'.format(condition))
+            self.depth += 1
+            self.write_call(index)
+            self.depth -= 1
+            self.known = 0
+
+def generate(tokens, tree):
+    '''Generates the Python source of a program.
+    The source defines load(vm) which returns the function that runs the program,
+    and the function that makes every loop stop at its next iteration.
+    '''
+    lines = [
+        'def load(vm):',
+        '    blocks = {}',
+        '    fail, warn, call, read, depth = runtime(vm, blocks)',
+        '    callstack = vm.callstack',
+        '    store = vm.store',
+        '    write = vm.output.write',
+        '    max_depth = vm.max_depth',
+        '    def expire():',
+        '        nonlocal max_depth',
+        '        max_depth = -1'
+    ]
+
+    blocks = []
+    writer = FunctionWriter(tokens, 'main', blocks)
+    writer.write_body(tree)
+    writer.flush()
+    lines.extend('    ' + line for line in writer.lines)
+
+    while blocks:
+        region = blocks.pop()
+        offset = tokens[region.index].offset
+        name = 'block_{}'.format(offset)
+
+        writer = FunctionWriter(tokens, name, blocks)
+        writer.write_body(region.body)
+        writer.flush()
+
+        # the } returns to the call site
+        writer.line('callstack.pop()')
+
+        lines.extend('    ' + line for line in writer.lines)
+        lines.append('    blocks[{}] = {}'.format(offset, name))
+
+    lines.append('    return main, expire')
+    return '\n'.join(lines) + '\n'
+
+def runtime(vm, blocks):
+    '''Returns the helpers that translated code calls, bound to an interpreter.'''
+    callstack = vm.callstack
+    output = vm.output
+
+    def fail(index, message):
+        vm.index = index
+        vm.error(message)
+        raise ProgramStopped()
+
+    def warn(index, message):
+        vm.index = index
+        vm.error(message)
+
+    def call(index):
+        # the same steps as op_execblock, but the block is run by its function
+        vm.index = index
+        callstack.append(index)
+        vm.check_depth()
+        target = vm.stack.pop()
+
+        block = blocks.get(target)
+        if block is None or len(callstack) > CALL_LIMIT:
+            # the blocks that are still running return to their call sites through the callstack
+            vm.index = vm.locate(target) - 1
+            raise Fallback()
+
+        block()
+
+    def read():
+        # make sure that an interactive user can see any prompt before typing
+        if output.line_buffered:
+            output.flush()
+        return vm.input.read()
+
+    def depth(index):
+        vm.index = index
+        vm.check_depth()
+
+        # the stacks are within their limits, so the loops were stopped because time ran out
+        budget = vm.budget
+        if budget is not None and budget.expired():
+            raise budget.out_of_time()
+
+    return fail, warn, call, read, depth
+
+def transpile(program):
+    '''Translates a program into Python.
+    Raises a TwoStackSyntaxError if the brackets of the program are unbalanced.
+    Programs in which loops and blocks overlap are not translated and are interpreted instead.
+    '''
+    translation = Translation(program)
+
+    tokens, jumps = fold_constants(*strip_tokens(lex(program)))
+    translation.aliases, tokens = resolve_aliases(tokens)
+    translation.tokens = tokens
+    translation.jumps = jumps
+    translation.offsets = [token.offset for token in tokens]
+
+    tree = build_tree(tokens, jumps)
+    if tree is None:
+        return translation
+
+    source = generate(tokens, tree)
+
+    try:
+        code = compile(source, '<twostack>', 'exec')
+    except (SyntaxError, RecursionError, MemoryError):
+        # python limits how deeply loops can be nested
+        return translation
+
+    translation.source = source
+    translation.code = code
+    translation.load = define(code)
+    return translation
+
+def define(code):
+    '''Runs compiled source, returning the load function that it defines.'''
+    namespace = {'runtime': runtime}
+    exec(code, namespace)
+    return namespace['load']
+
+class TwoStackTranspiler(TwoStackInterpreter):
+    '''Executes programs by translating them into Python first.
+    The results are identical to those of TwoStackInterpreter.
+    Translated programs keep their values in lists of Python integers.
+    Under a budget that limits anything but time the programs are interpreted instead,
+    as those limits need the steps that the interpreter counts.
+    '''
+
+    def prepare(self, program):
+        '''Translates a program, or parses it for the interpreter while profiling.
+        Raises a TwoStackSyntaxError if the brackets of the program are unbalanced.
+        '''
+        if self.profiler is not None:
+            return TwoStackInterpreter.prepare(self, program)
+        return transpile(program)
+
+    def run(self, translation):
+        '''Execute a translated program.'''
+        if not isinstance(translation, Translation):
+            TwoStackInterpreter.run(self, translation)
+            return
+
+        self.program = translation.program
+        self.tokens = translation.tokens
+        self.jumps = translation.jumps
+        self.offsets = translation.offsets
+        self.bind_aliases(translation.aliases)
+
+        # the translated code always starts at the beginning of the program,
+        # and has no steps between which a budget could be checked, only its deadline can be kept
+        budget = self.budget
+        if translation.load is None or self.index != 0 or (budget is not None and not budget.deadline_only()):
+            self.interpret()
+            return
+
+        self.promote_stacks()
+        main, expire = translation.load(self)
+
+        # once time runs out, a timer stops the loops of the translated code
+        timer = None
+        if budget is not None:
+            budget.start()
+            if budget.deadline is not None:
+                timer = threading.Timer(max(0, budget.deadline - budget.timer()), expire)
+                timer.daemon = True
+                timer.start()
+
+        try:
+            main()
+            self.index = len(self.tokens)
+        except ProgramStopped:
+            pass
+        except TwoStackBudgetError:
+            raise
+        except TwoStackError as error:
+            self.error(error.message)
+        except Fallback:
+            # the interpreter carries on with what is left of the time
+            if budget is not None:
+                budget.resume(0, budget.deadline)
+            self.index += 1
+            self.interpret()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            self.output.flush()
@@ -0,0 +1,388 @@
+'''TwoStackVirtualMachine
+Author: Jesse Sheehan <jesse@sheehan.nz>
+
+Contains the virtual machine which executes compiled TwoStack bytecode.
+'''
+
+from bisect import bisect_left
+
+from twostack_interpreter import TwoStackInterpreter
+from twostack_compiler import *
+from twostack_budget import StepCounter, bits
+from twostack_errors import TwoStackError, TwoStackBudgetError
+from twostack_stack import find_zero, transfer, reduce_loop, push_range
+
+def oversized_literals(bytecode, max_bits):
+    '''Returns the instructions of a program that push a literal larger than max_bits.'''
+    code = bytecode.code
+    args = bytecode.args
+    pool = bytecode.pool
+    oversized = []
+
+    for pc, op in enumerate(code):
+        if op == OP_INT:
+            values = (pool[args[pc]],)
+        elif op == OP_MODADD:
+            values = pool[args[pc]]
+        else:
+            continue
+        if any(bits(value) > max_bits for value in values):
+            oversized.append(pc)
+
+    return oversized
+
+class TwoStackVirtualMachine(TwoStackInterpreter):
+    '''Executes programs by compiling them to bytecode first.
+    The results are identical to those of TwoStackInterpreter.
+    When profiling is turned on programs are interpreted instead, so that the operators
+    of the command manifest can be timed.
+    '''
+
+    def reset(self):
+        '''Resets the virtual machine state.'''
+        TwoStackInterpreter.reset(self)
+        self.bytecode = None
+
+    def source_offset(self):
+        '''Returns the source offset of the instruction currently being executed.'''
+        if self.bytecode is None:
+            return TwoStackInterpreter.source_offset(self)
+        if self.index < len(self.bytecode):
+            return self.bytecode.offsets[self.index]
+        return len(self.program)
+
+    def prepare(self, program):
+        '''Compiles a program into bytecode, or parses it for the interpreter while profiling.
+        Raises a TwoStackSyntaxError if the brackets of the program are unbalanced.
+        '''
+        if self.profiler is not None:
+            return TwoStackInterpreter.prepare(self, program)
+        return compile_program(program)
+
+    def enter_pure_block(self, pc, pure):
+        '''Looks up the result of the pure block beginning at the instruction pc, which has just been called.
+        Returns the instruction to continue from along with the pending result to remember once the block ends.
+        When the result is already known it replaces the consumed elements and the block returns straight away.
+        Blocks that the memo has given up on are removed from pure for the rest of the run.
+        '''
+        stack = self.stack
+        base = len(stack) - pure[pc]
+        if base < 0:
+            # the block will fail as normal
+            return pc, None
+
+        key = (pc, tuple(stack[base:]))
+        values = self.memo.get(key)
+        if values is None:
+            if self.memo.hopeless(pc):
+                del pure[pc]
+            return pc, (key, base)
+
+        del stack[base:]
+        stack.extend(values)
+        return self.callstack.pop(), None
+
+    def run(self, bytecode):
+        '''Execute compiled bytecode.'''
+        if not isinstance(bytecode, Bytecode):
+            self.bytecode = None
+            TwoStackInterpreter.run(self, bytecode)
+            return
+
+        self.program = bytecode.program
+        self.bytecode = bytecode
+        self.bind_aliases(bytecode.aliases)
+
+        code = bytecode.code
+        args = bytecode.args
+        pool = bytecode.pool
+        offsets = bytecode.offsets
+        size = len(code)
+
+        stack = self.stack
+        ztack = self.ztack
+        callstack = self.callstack
+        store = self.store
+        write = self.output.write
+        max_depth = self.max_depth
+        pc = self.index
+
+        # the checks that the analysis left out only hold for runs from the start of the program
+        # in which blocks are called at their beginning, otherwise every instruction is checked
+        required = bytecode.required if pc == 0 else bytecode.arity
+
+        # budgeted runs count their steps while looking up the elements that each instruction requires,
+        # so runs without a budget do no extra work per instruction
+        budget = self.budget
+        counter = None
+        max_bits = None
+        if budget is not None:
+            max_bits = budget.max_bits
+            oversized = () if max_bits is None else oversized_literals(bytecode, max_bits)
+            counter = required = StepCounter(budget, self, required, oversized)
+
+        # the results of pure blocks are remembered unless the steps of the run are limited,
+        # a replayed block skips its steps but still leaves the deadline to be checked
+        memo = self.memo if budget is None or budget.deadline_only() else None
+        pure = dict(bytecode.pure)
+        pending = None
+        if memo is not None:
+            memo.bind(bytecode.program)
+
+        try:
+            while pc < size:
+                try:
+                    op = code[pc]
+
+                    # most instructions were proven safe, so they skip the check altogether
+                    need = required[pc]
+                    if need and len(stack) < need:
+                        self.index = pc
+                        self.error('not enough elements on the stack')
+                        break
+
+                    # the opcodes are dispatched in groups of eight to keep the chains short
+                    if op < 8:
+                        if op == OP_INT:
+                            stack.append(pool[args[pc]])
+
+                        elif op == OP_ALIAS:
+                            value = store[args[pc]]
+                            if value is not None:
+                                stack.append(value)
+                            else:
+                                self.index = pc
+                                self.error('alias does not exist')
+
+                        elif op == OP_STACKSWAP:
+                            stack, ztack = ztack, stack
+                            self.stack = stack
+                            self.ztack = ztack
+
+                        elif op == OP_DUPLICATE:
+                            stack.append(stack[-1])
+
+                        elif op == OP_DISCARD:
+                            stack.pop()
+
+                        elif op == OP_LOOPBEGIN:
+                            if not stack or stack[-1] == 0:
+                                pc = args[pc]
+
+                        elif op == OP_LOOPEND:
+                            if len(stack) > max_depth or len(ztack) > max_depth:
+                                self.check_depth()
+                            pc = args[pc] - 1
+
+                        else:
+                            ztack.append(stack.pop())
+
+                    elif op < 16:
+                        if op == OP_OUTPUT:
+                            write(stack[-1])
+
+                        elif op == OP_ADD:
+                            stack[-2] += stack[-1]
+                            stack.pop()
+
+                        elif op == OP_SUBTRACT:
+                            stack[-2] -= stack[-1]
+                            stack.pop()
+
+                        elif op == OP_MODULO:
+                            stack[-2] %= stack[-1]
+                            stack.pop()
+
+                        elif op == OP_DIVIDE:
+                            stack[-2] //= stack[-1]
+                            stack.pop()
+
+                        elif op == OP_EQUAL:
+                            elem1 = stack.pop()
+                            stack[-1] = int(stack[-1] == elem1)
+
+                        elif op == OP_SWAP:
+                            stack[-1], stack[-2] = stack[-2], stack[-1]
+
+                        else:
+                            callstack.append(pc)
+                            self.check_depth()
+                            pc = bisect_left(offsets, stack.pop() + 1) - 1
+                            if code[pc] != OP_BLOCKBEGIN:
+                                if counter is None:
+                                    required = bytecode.arity
+                                else:
+                                    counter.required = bytecode.arity
+                            elif memo is not None and pc in pure:
+                                pc, pending = self.enter_pure_block(pc, pure)
+
+                    elif op < 24:
+                        if op == OP_CONDJUMP:
+                            if stack.pop():
+                                callstack.append(pc)
+                                self.check_depth()
+                                pc = bisect_left(offsets, stack.pop() + 1) - 1
+                                if code[pc] != OP_BLOCKBEGIN:
+                                    if counter is None:
+                                        required = bytecode.arity
+                                    else:
+                                        counter.required = bytecode.arity
+                                elif memo is not None and pc in pure:
+                                    pc, pending = self.enter_pure_block(pc, pure)
+
+                        elif op == OP_BLOCKBEGIN:
+                            stack.append(offsets[pc])
+                            pc = args[pc]
+
+                        elif op == OP_BLOCKEND:
+                            pc = callstack.pop()
+                            if pending is not None:
+                                # a pure block has no calls, so this is always the end of the pending one
+                                memo.put(pending[0], tuple(stack[pending[1]:]))
+                                pending = None
+
+                        elif op == OP_STRING:
+                            stack.extend(pool[args[pc]])
+
+                        elif op == OP_MULTIPLY:
+                            if max_bits is None:
+                                stack[-2] *= stack[-1]
+                            else:
+                                stack[-2] = budget.multiply(stack[-2], stack[-1])
+                            stack.pop()
+
+                        elif op == OP_LESSTHAN:
+                            elem1 = stack.pop()
+                            stack[-1] = int(stack[-1] < elem1)
+
+                        elif op == OP_GREATERTHAN:
+                            elem1 = stack.pop()
+                            stack[-1] = int(stack[-1] > elem1)
+
+                        else:
+                            stack[-1] = int(not stack[-1])
+
+                    elif op < 32:
+                        if op == OP_AND:
+                            elem1 = stack.pop()
+                            stack[-1] = int(elem1 and stack[-1])
+
+                        elif op == OP_OR:
+                            elem1 = stack.pop()
+                            stack[-1] = int(elem1 or stack[-1])
+
+                        elif op == OP_XOR:
+                            elem1 = stack.pop()
+                            stack[-1] = int(elem1 ^ stack[-1])
+
+                        elif op == OP_3SWAP:
+                            stack[-1], stack[-3] = stack[-3], stack[-1]
+
+                        elif op == OP_POWER:
+                            if max_bits is None:
+                                stack[-2] **= stack[-1]
+                            else:
+                                stack[-2] = budget.power(stack[-2], stack[-1])
+                            stack.pop()
+
+                        elif op == OP_INPUT:
+                            self.op_input()
+
+                        elif op == OP_ALIASDEF:
+                            slot = args[pc]
+                            if slot >= 0:
+                                store[slot] = stack.pop()
+                            else:
+                                self.index = pc
+                                self.error('alias definition cannot be empty')
+
+                        else:
+                            self.index = pc
+                            self.debug()
+
+                    # ===== Superinstructions ===== #
+                    # on success these continue after the instructions of their idiom,
+                    # otherwise they fall through to those instructions
+                    elif op == OP_JUMP:
+                        pc = args[pc] - 1
+
+                    elif op == OP_CROSSALL:
+                        # [`] moves everything above the topmost 0 onto the ztack
+                        transfer(stack, ztack)
+                        pc = args[pc] - 1
+
+                    elif op == OP_PRINTALL:
+                        # [.;] prints and discards everything above the topmost 0
+                        # a value that cannot be written stays on the stack with everything below it,
+                        # so that running the instruction again never prints anything twice
+                        start = find_zero(stack) + 1
+                        end = len(stack)
+                        try:
+                            for value in reversed(stack[start:]):
+                                write(value)
+                                end -= 1
+                        finally:
+                            del stack[end:]
+                        pc = args[pc] - 1
+
+                    elif op == OP_MODADD:
+                        if stack:
+                            modulus, addend = pool[args[pc]]
+                            stack[-1] = stack[-1] % modulus + addend
+                            pc += 4
+
+                    elif op == OP_SUMLOOP or op == OP_PRODUCTLOOP:
+                        # [\+\] and [\*\] fold the elements above the topmost 0 into the second element,
+                        # products are left to the instructions of the idiom when integer sizes are limited
+                        if op == OP_SUMLOOP or max_bits is None:
+                            if counter is None:
+                                reduce_loop(stack, op == OP_PRODUCTLOOP)
+                            else:
+                                # a budgeted run pays for every element, folds that are too large
+                                # for the budget are left to the instructions of the idiom
+                                folded = reduce_loop(stack, op == OP_PRODUCTLOOP, counter.allowance())
+                                if folded:
+                                    counter.charge(folded)
+
+                        # the loop is not finished if the stack ran out, so let it fail as normal
+                        if not stack or stack[-1] == 0:
+                            pc = args[pc] - 1
+
+                    elif op == OP_RANGELOOP:
+                        # [:1-] counts the top element down to 0, pushing every value on the way,
+                        # negative counts never finish and are left to fail as normal
+                        if stack and 0 < stack[-1] <= max_depth - len(stack):
+                            count = stack[-1]
+                            if counter is None:
+                                push_range(stack, count)
+                                pc = args[pc] - 1
+                            elif count <= counter.allowance(True):
+                                push_range(stack, count)
+                                counter.charge(count)
+                                pc = args[pc] - 1
+
+                    else:
+                        self.index = pc
+                        self.error('unknown symbol \'{}\''.format(pool[args[pc]]))
+                        break
+
+                except OverflowError:
+                    # run the instruction again once the stacks can hold the result
+                    if not self.promote_stacks():
+                        raise
+                    stack = self.stack
+                    ztack = self.ztack
+                    if counter is not None:
+                        counter.refund()
+                    continue
+                except TwoStackBudgetError:
+                    raise
+                except TwoStackError as error:
+                    self.index = pc
+                    self.error(error.message)
+                    break
+
+                pc += 1
+        finally:
+            self.index = pc
+            self.output.flush()